@@ -0,0 +1,50 @@
+''' Time of the automatic determination of the covariance shrinkage
+(covShrinkage=None in ScatData.getTotalAverages/getDiffAverages) as a function
+of the subsample of curves used for the estimation.
+
+Usage:
+    python benchmarks/bench_cov_shrinkage.py [nqpt] [nCurves]
+'''
+import sys
+import time
+
+import numpy as np
+
+from covar import cov_shrink_ss
+
+
+def benchmarkCovShrinkage(nqpt=1000, nCurves=50000, subsamples=(None, 10000, 2000)):
+    ''' Function for measuring the time of the automatic determination of the
+    covariance shrinkage (covShrinkage=None in getTotalAverages/getDiffAverages)
+    on random correlated curves.
+
+    You need:
+        nqpt - number of q points
+        nCurves - number of curves
+        subsamples - numbers of curves used for the estimation of the shrinkage
+        (see covar.cov_shrink_ss); None stands for all curves
+
+    Output:
+        subsamples - tested subsamples
+        shrinkage - estimated shrinkage intensities
+        runTime - run times in seconds
+    '''
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal((nCurves, nqpt))
+    x[:, 1:] += 0.5 * x[:, :-1]  # correlation of the neighbouring q points
+    shrinkage = np.zeros(len(subsamples))
+    runTime = np.zeros(len(subsamples))
+
+    print('subsample \t shrinkage \t time, s')
+    for i, subsample in enumerate(subsamples):
+        startTime = time.perf_counter()
+        _, shrinkage[i] = cov_shrink_ss(x, subsample=subsample)
+        runTime[i] = time.perf_counter() - startTime
+        print(subsample if subsample else nCurves, '\t\t %.3e' % shrinkage[i], '\t %.2f' % runTime[i])
+    return subsamples, shrinkage, runTime
+
+
+if __name__ == '__main__':
+    nqpt = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    nCurves = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    benchmarkCovShrinkage(nqpt, nCurves)
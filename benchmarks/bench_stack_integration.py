@@ -0,0 +1,65 @@
+''' Integration throughput as a function of the number of images K integrated in
+one pass over the operator (batchSize in ScatData.integrate), compared to the
+image by image mat-vec (batchSize=None).
+
+Usage:
+    python benchmarks/bench_stack_integration.py [image size] [K1 K2 ...]
+'''
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from pytrx.scatdata import AIGeometry
+
+
+def benchmarkStackIntegration(aiGeometry, image, batchSizes=(8, 16, 24, 32, 64, 128), nImages=256):
+    ''' Function for measuring the integration throughput as a function of the
+    number of images K integrated in one pass over the operator.
+    The operator must be prepared with aiGeometry.getOperator.
+
+    You need:
+        aiGeometry - AIGeometry instance with the operator
+        image - a representative image
+        batchSizes - values of K to test
+        nImages - number of images integrated for each K
+
+    Output:
+        batchSizes - tested values of K
+        fps - integration throughput (frames per second)
+    '''
+    batchSizes = np.array(batchSizes)
+    fps = np.zeros(batchSizes.size)
+    images = [image.ravel().copy() for _ in range(8)]  # copies, so that the images are not read from the cache
+
+    startTime = time.perf_counter()
+    for j in range(nImages):
+        aiGeometry.operator @ images[j % 8]
+    print('single image mat-vec: %.0f frames/s' % (nImages / (time.perf_counter() - startTime)))
+
+    aiGeometry.integrateStack(aiGeometry.getStack(image, 1))  # compilation of _integrateStack
+    print('K \t frames/s \t memory, MB')
+    for i, batchSize in enumerate(batchSizes):
+        stack = aiGeometry.getStack(image, batchSize)
+        startTime = time.perf_counter()
+        for j in range(nImages):
+            stack[j % batchSize] = images[j % 8]
+            if j % batchSize == batchSize - 1:
+                aiGeometry.integrateStack(stack)
+        fps[i] = nImages / (time.perf_counter() - startTime)
+        print(batchSize, '\t %.0f' % fps[i], '\t\t %.1f' % (stack.nbytes / 2 ** 20))
+    return batchSizes, fps
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    batchSizes = [int(k) for k in sys.argv[2:]] or (8, 16, 24, 32, 64, 128)
+
+    aiGeometry = AIGeometry(energy=12, distance=100, pixelSize=80e-6, centerX=size / 2, centerY=size / 2,
+                            qRange=[0.1, 4.0], nqpt=1000)
+    rng = np.random.default_rng(0)
+    image = rng.poisson(1000, (size, size)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as operatorDir:
+        aiGeometry.getOperator(image.shape, 1000, [0.1, 4.0], operatorDir=operatorDir)
+    benchmarkStackIntegration(aiGeometry, image, batchSizes)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+caches - on-disk caches of the data reduction: parsed log data (LogCache),
+integrated curves (CurveCache) and checkpoints of long integrations
+(IntegrationCheckpoint).
+"""
+from pathlib import Path
+import os
+import re
+import hashlib
+import time
+
+import numpy as np
+import pandas as pd
+
+from pytrx.utils import lazy_import
+from pytrx.imageio import _readImageData, _splitFramePath
+
+h5py = lazy_import('h5py')
+
+default_cache_dir = Path.home() / '.pytrx'
+
+
+class LogCache:
+    ''' Binary copy of the parsed log data of one log file (see
+    ScatData._readLogFile). The table is stored column by column with np.savez
+    next to the log file (<log file>.cache.npz; in ~/.pytrx/logs if the log
+    directory is not writable) together with the size and modification time of
+    the log file, the log file style and the local time zone (the numerical time
+    stamps are in local time). The cached table is used only if all of these
+    match, so that an edited or appended log file is parsed again. The cache is
+    best-effort: if it cannot be read or written, the log file is parsed.
+    '''
+    version = 3
+
+    def __init__(self, logFile, logFileStyle):
+        self.logFile = logFile
+        self.logFileStyle = logFileStyle
+        fallbackName = hashlib.sha1(os.path.abspath(logFile).encode()).hexdigest() + '.npz'
+        self.paths = [Path(logFile + '.cache.npz'), default_cache_dir / 'logs' / fallbackName]
+        self.path = self.paths[0]
+
+    def _getKey(self):
+        stat = os.stat(self.logFile)
+        return '%d|%d|%s|%s|%d' % (stat.st_size, stat.st_mtime_ns, self.logFileStyle,
+                                   '/'.join(time.tzname + (str(time.timezone), str(time.altzone))), self.version)
+
+    def load(self):
+        ''' Returns the cached log data or None if there is no valid cache.
+        '''
+        key = self._getKey()
+        for path in self.paths:
+            if not path.is_file():
+                continue
+            try:
+                with np.load(path, allow_pickle=False) as f:
+                    if str(f['key']) != key:
+                        continue
+                    logData = pd.DataFrame()
+                    for i, column in enumerate(f['columns']):
+                        values = f['column_%d' % i]
+                        if 'isnull_%d' % i in f:  # text column
+                            values = values.astype(object)
+                            values[f['isnull_%d' % i]] = np.nan
+                        logData[column] = values
+                self.path = path
+                return logData
+            except Exception:  # unreadable or incomplete cache
+                pass
+        return None
+
+    def save(self, logData):
+        arrays = {'key': np.array(self._getKey()), 'columns': np.array(logData.columns, dtype=str)}
+        for i, column in enumerate(logData.columns):
+            values = logData[column].to_numpy()
+            if values.dtype == object:
+                isNull = pd.isna(values)
+                arrays['column_%d' % i] = np.where(isNull, '', values).astype(str)
+                arrays['isnull_%d' % i] = isNull
+            else:
+                arrays['column_%d' % i] = values
+        for path in self.paths:
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmpPath = path.with_name(path.name + '.tmp')
+                with open(tmpPath, 'wb') as f:
+                    np.savez(f, **arrays)
+                os.replace(tmpPath, path)
+                self.path = path
+                return
+            except Exception:
+                continue
+        print('could not write the log cache for', self.logFile)
+
+
+class CurveCache:
+    ''' On-disk cache of integrated curves. The curves are kept in an HDF5 file
+    named after the hash of the integration settings (geometry, mask,
+    corrections) and are looked up by image keys, which combine the image path
+    with its size and modification time (or are the hash of the image content).
+    The cache also stores the sums of the images integrated together, so that
+    the average image can be restored without reading the images again.
+    '''
+
+    def __init__(self, cacheDir, settingsHash):
+        if cacheDir is None:
+            cacheDir = default_cache_dir / 'curves'
+        self.path = Path(cacheDir) / (settingsHash + '.h5')
+
+    def getImageKeys(self, impaths, byContent=False):
+        keys = []
+        for impath in impaths:
+            path, frame = _splitFramePath(impath)
+            if byContent and (frame is not None):
+                keys.append(hashlib.sha1(_readImageData(impath).tobytes()).hexdigest())
+            elif byContent:
+                with open(impath, 'rb') as f:
+                    keys.append(hashlib.sha1(f.read()).hexdigest())
+            else:
+                stat = os.stat(path)
+                key = '%s|%d|%d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+                keys.append(key if frame is None else '%s::%d' % (key, frame))
+        return np.array(keys)
+
+    def load(self, imageKeys, s_raw):
+        ''' Method for reading the cached curves into the corresponding columns
+        of s_raw. Returns a bool array marking the images found in the cache and
+        q (None if the cache is empty).
+        '''
+        isCached = np.zeros(imageKeys.size, dtype=bool)
+        if not self.path.is_file():
+            return isCached, None
+
+        with h5py.File(self.path, 'r') as f:
+            rows = {key: i for i, key in enumerate(f['keys'].asstr()[:])}
+            cachedRows = np.array([rows.get(key, -1) for key in imageKeys])
+            isCached = cachedRows >= 0
+            if np.any(isCached):
+                # read the contiguous block of rows covering the requested curves
+                rowMin, rowMax = cachedRows[isCached].min(), cachedRows[isCached].max()
+                s_cached = f['s_raw'][rowMin:rowMax + 1]
+                s_raw[:, isCached] = s_cached[cachedRows[isCached] - rowMin].T
+            q = f['q'][:]
+        return isCached, q
+
+    def save(self, imageKeys, s_raw, q):
+        ''' Method for appending curves (columns of s_raw) of the images with
+        imageKeys to the cache. Images which are already cached are skipped.
+        '''
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(self.path, 'a') as f:
+            if 'keys' not in f:
+                f.create_dataset('q', data=q)
+                f.create_dataset('keys', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(1024,))
+                f.create_dataset('s_raw', shape=(0, q.size), maxshape=(None, q.size), chunks=(256, q.size),
+                                 dtype=s_raw.dtype)
+            n = f['keys'].shape[0]
+            isNew = ~np.isin(imageKeys, f['keys'].asstr()[:])
+            imageKeys, s_raw = imageKeys[isNew], s_raw[:, isNew]
+            f['keys'].resize((n + imageKeys.size,))
+            f['keys'][n:] = imageKeys.astype(object)
+            f['s_raw'].resize((n + imageKeys.size, q.size))
+            f['s_raw'][n:] = s_raw.T
+
+    def loadImageSum(self, imageKeys):
+        ''' Method for reading the sum of the images with imageKeys. Returns None if
+        this set of images was never integrated together.
+        '''
+        if not self.path.is_file():
+            return None
+        with h5py.File(self.path, 'r') as f:
+            name = 'imageSums/' + self._getSetHash(imageKeys)
+            if name in f:
+                return f[name][:]
+        return None
+
+    def saveImageSum(self, imageKeys, imageSum):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(self.path, 'a') as f:
+            name = 'imageSums/' + self._getSetHash(imageKeys)
+            if name not in f:
+                f.create_dataset(name, data=imageSum, compression='gzip')
+
+    def _getSetHash(self, imageKeys):
+        return hashlib.sha1('\n'.join(sorted(imageKeys)).encode()).hexdigest()
+
+
+class IntegrationCheckpoint:
+    ''' HDF5 side files keeping the state of a running integration: the curves
+    integrated so far, the indices of the processed images and the partial sum
+    of the images. The main file (path) holds the list of images and q; every
+    checkpointEvery processed images the new curves and the current sum of the
+    images are written to a new part file (<path>.000001, <path>.000002, ...),
+    so that an interrupted integration can be resumed (see ScatData.integrate).
+    Every file is written under a temporary name and renamed when complete, so
+    an interruption during a write leaves the previous checkpoint intact.
+    '''
+
+    def __init__(self, path, impaths, settingsHash, checkpointEvery=1000):
+        self.path = Path(path)
+        self.impaths = impaths
+        self.settingsHash = settingsHash
+        self.checkpointEvery = checkpointEvery
+        self.pending = []  # processed images not yet written to the file
+        self.nImageSum = 0
+        self.nParts = 0
+
+    def _getPartPath(self, i):
+        return self.path.with_name('%s.%06d' % (self.path.name, i))
+
+    def _getPartPaths(self):
+        pattern = re.compile(re.escape(self.path.name) + r'\.\d{6}$')
+        return sorted(path for path in self.path.parent.glob(self.path.name + '.*') if pattern.match(path.name))
+
+    def _writeFile(self, path, write):
+        ''' Writes the file with write(f) under a temporary name and renames it.
+        '''
+        tmpPath = path.with_name(path.name + '.tmp')
+        with h5py.File(tmpPath, 'w') as f:
+            write(f)
+        os.replace(tmpPath, path)
+
+    def start(self, done, nImageSum):
+        ''' Method for starting a new checkpoint. done are the indices of the
+        images with known curves (e.g. taken from the cache) and nImageSum is the
+        number of images already summed.
+        '''
+        self._removeFiles()
+        self.pending = list(done)
+        self.nImageSum = nImageSum
+        self.nParts = 0
+
+    def add(self, idx, s_raw, imageSum, q):
+        ''' Method for registering the images idx whose curves are written in s_raw
+        and which are added to imageSum. Writes the checkpoint when enough images
+        were processed.
+        '''
+        self.pending.extend(idx)
+        self.nImageSum += len(idx)
+        if len(self.pending) >= self.checkpointEvery:
+            self.write(s_raw, imageSum, q)
+
+    def write(self, s_raw, imageSum, q):
+        startTime = time.perf_counter()
+        idx = np.unique(self.pending)
+        if not self.path.is_file():
+            def writeMain(f):
+                f.attrs['settingsHash'] = self.settingsHash
+                f.create_dataset('impaths', data=self.impaths.astype(object), dtype=h5py.string_dtype())
+                f.create_dataset('q', data=q)
+            self._writeFile(self.path, writeMain)
+
+        def writePart(f):
+            f.create_dataset('idx', data=idx)
+            f.create_dataset('s_raw', data=s_raw[:, idx].T)
+            if imageSum is not None:
+                f.create_dataset('imageSum', data=imageSum)
+            f.attrs['nImageSum'] = self.nImageSum
+        self._writeFile(self._getPartPath(self.nParts + 1), writePart)
+        self.nParts += 1
+        self.pending = []
+        print('Checkpoint: %d images saved to' % self.nImageSum, self.path,
+              '( %3.f' % ((time.perf_counter() - startTime) * 1000), 'ms )')
+
+    def load(self, s_raw):
+        ''' Method for reading the checkpoint. The curves of the processed images
+        are put in the corresponding columns of s_raw.
+        Returns the indices of the processed images (bool array), the partial sum
+        of the images, the number of summed images and q.
+        '''
+        with h5py.File(self.path, 'r') as f:
+            assert f.attrs['settingsHash'] == self.settingsHash, \
+                'checkpoint was created with different geometry/mask/corrections'
+            assert np.array_equal(f['impaths'].asstr()[:], self.impaths), \
+                'checkpoint was created for a different list of images'
+            q = f['q'][:]
+        isDone = np.zeros(self.impaths.size, dtype=bool)
+        imageSum = None
+        self.nImageSum = 0
+        partPaths = self._getPartPaths()
+        for partPath in partPaths:
+            with h5py.File(partPath, 'r') as f:
+                idx = f['idx'][:]
+                s_raw[:, idx] = f['s_raw'][:].T
+                isDone[idx] = True
+                if 'imageSum' in f:
+                    imageSum = f['imageSum'][:]
+                self.nImageSum = int(f.attrs['nImageSum'])
+        self.nParts = len(partPaths) and int(partPaths[-1].suffix[1:])
+        self.pending = []
+        return isDone, imageSum, self.nImageSum, q
+
+    def _removeFiles(self):
+        pattern = re.compile(re.escape(self.path.name) + r'(\.\d{6})?(\.tmp)?$')  # including unfinished writes
+        for path in self.path.parent.glob(self.path.name + '*'):
+            if pattern.match(path.name) and path.is_file():
+                path.unlink()
+
+    def remove(self):
+        if self.path.is_file():
+            self._removeFiles()
+            print('Integration finished, checkpoint', self.path, 'removed')
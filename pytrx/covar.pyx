@@ -1,12 +1,17 @@
+# Compiled with OpenMP (the flags are added by setup.py for the compilers which
+# support it) the element-wise loops run on all cores (the number of threads is
+# set by OMP_NUM_THREADS); without it they run serially. The O(n*p^2)
+# products go through BLAS dsyrk/dgemm, which is blocked and threaded by itself.
 import numpy as np
 cimport cython
-from scipy.linalg.cython_blas cimport dgemm
+from cython.parallel cimport prange
+from scipy.linalg.cython_blas cimport dgemm, dsyrk
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-def cov_shrink_ss(const double[:, ::1] X, shrinkage=None):
+def cov_shrink_ss(const double[:, ::1] X, shrinkage=None, subsample=None, seed=0):
     r"""Compute a shrinkage estimate of the covariance matrix using
     the Schafer and Strimmer (2005) method.
     Parameters
@@ -19,6 +24,12 @@ def cov_shrink_ss(const double[:, ::1] X, shrinkage=None):
         specified (the default) it is estimated using an analytic formula
         from Schafer and Strimmer (2005). For ``shrinkage=0`` the empirical
         correlations are recovered.
+    subsample : int, optional
+        Number of randomly chosen data points used for the estimation of
+        :math:`\hat{Var}(r_{ij})` when the shrinkage intensity is determined
+        automatically. By default all the ``n`` data points are used.
+    seed : int, optional
+        Seed of the random choice of the subsample.
     Returns
     -------
     cov : array, shape=(p, p)
@@ -71,6 +82,15 @@ def cov_shrink_ss(const double[:, ::1] X, shrinkage=None):
     This method is equivalent to the ``cov.shrink`` method in the R package
     ``corpcor``, if the argument ``lambda.var`` is set to ``0``. See
     https://cran.r-project.org/web/packages/corpcor/ for details.
+    The sum over :math:`k` is evaluated as
+    .. math::
+        \sum_{k=1}^n (w_{kij} - \bar{w}_{ij})^2 = \sum_{k=1}^n
+            (x_{ki} - \bar{x}_i)^2 (x_{kj} - \bar{x}_j)^2 - n \bar{w}^2_{ij},
+    i.e. with a single matrix product of the squared centered data, so the cost
+    of the automatic estimation is the same as the cost of the covariance
+    itself. With ``subsample=m`` the sum is taken over :math:`m` random data
+    points and multiplied by :math:`n/m`, which makes the estimation :math:`n/m`
+    times cheaper.
     See Also
     --------
     cov_shrink_rblw : similar method, using a different shrinkage target,
@@ -78,61 +98,79 @@ def cov_shrink_ss(const double[:, ::1] X, shrinkage=None):
     sklearn.covariance.ledoit_wolf : very similar approach, but uses a different
         shrinkage target, :math:`T`.
     """
-    cdef int n, p, i, j, k
+    cdef Py_ssize_t n, p, m, i, j
     n, p = X.shape[0], X.shape[1]
 
     cdef double gamma_num = 0
     cdef double gamma_den = 0
-    cdef double s_ij, s_ii, gamma
+    cdef double s_ij, gamma, f_n, f_var, r_ij, var_ij
 
     cdef double[::1] X_mean = np.mean(X, axis=0)
     cdef double[::1] X_std = np.std(X, axis=0)
     cdef double[:, ::1] X_meaned = np.empty_like(X)
     cdef double[:, ::1] w_ij_bar = np.zeros((p, p))
-    cdef double[:, ::1] r = np.zeros((p, p))
-    cdef double[:, ::1] var_r = np.zeros((p, p))
+    cdef double[:, ::1] w_ij_sum
+    cdef double[:, ::1] w2_ij_sum
+    cdef double[:, ::1] Y
+    cdef double[:, ::1] Y2
     cdef double[:, ::1] out = np.zeros((p, p))
 
-    for i in range(n):
-        for j in range(p):
-            X_meaned[i, j] = X[i, j] - X_mean[j]
+    with nogil:
+        for i in prange(n):
+            for j in range(p):
+                X_meaned[i, j] = X[i, j] - X_mean[j]
 
-    cy_dgemm_TN(X_meaned, X_meaned, w_ij_bar, 1.0/n)
+    cy_dsyrk_TN(X_meaned, w_ij_bar, 1.0/n)
 
     if shrinkage is not None:
         gamma = max(0.0, min(1.0, float(shrinkage)))
     else:
-        for i in range(p):
-            for j in range(p):
-                r[i, j] = (n / ((n - 1.0) * X_std[i] * X_std[j])) * w_ij_bar[i, j]
+        if subsample is None or subsample >= n:
+            m = n
+            Y = X_meaned
+        else:
+            m = max(int(subsample), 2)
+            idx = np.sort(np.random.default_rng(seed).choice(n, m, replace=False))
+            Y = np.asarray(X_meaned)[idx]
 
-        for k in range(n):
-            for i in range(p):
+        Y2 = np.empty((m, p))
+        with nogil:
+            for i in prange(m):
                 for j in range(p):
-                    var_r[i,j] += (X_meaned[k,i]*X_meaned[k,j] - w_ij_bar[i,j])**2
-
-
-        for i in range(p):
-            for j in range(p):
-                var_r[i,j] *= (n / ((n-1.0)**3 * X_std[i]*X_std[i]*X_std[j]*X_std[j]))
+                    Y2[i, j] = Y[i, j] * Y[i, j]
 
+        # sum_k (w_kij - w_ij_bar)^2 = sum_k w_kij^2 - 2 w_ij_bar sum_k w_kij + m w_ij_bar^2
+        w2_ij_sum = np.empty((p, p))
+        cy_dsyrk_TN(Y2, w2_ij_sum)
+        if m == n:
+            w_ij_sum = np.multiply(w_ij_bar, n)
+        else:
+            w_ij_sum = np.empty((p, p))
+            cy_dsyrk_TN(Y, w_ij_sum)
 
-        for i in range(p):
-            for j in range(p):
-                if i != j:
-                    gamma_num += var_r[i,j]
-                    gamma_den += r[i,j]**2
+        f_n = n / (n - 1.0)
+        f_var = (<double> n / m) * n / ((n - 1.0)**3)
+        with nogil:
+            for i in prange(p):
+                for j in range(p):
+                    if i != j:
+                        r_ij = f_n * w_ij_bar[i, j] / (X_std[i] * X_std[j])
+                        var_ij = (w2_ij_sum[i, j] - 2 * w_ij_bar[i, j] * w_ij_sum[i, j]
+                                  + m * w_ij_bar[i, j] * w_ij_bar[i, j])
+                        gamma_num += max(var_ij, 0.0) * f_var / (X_std[i]*X_std[i]*X_std[j]*X_std[j])
+                        gamma_den += r_ij * r_ij
 
         gamma =  max(0, min(1, gamma_num / gamma_den))
 
-    for i in range(p):
-        for j in range(p):
-            s_ij = (n / (n-1.0)) * w_ij_bar[i, j]
-            out[i, j] = (1.0-gamma) * s_ij
-            if i == j:
-                out[i, i] += gamma * s_ij
-        if out[i, j] == -0:
-            out[i, j] = 0
+    with nogil:
+        for i in prange(p):
+            for j in range(p):
+                s_ij = (n / (n-1.0)) * w_ij_bar[i, j]
+                out[i, j] = (1.0-gamma) * s_ij
+                if i == j:
+                    out[i, i] += gamma * s_ij
+            if out[i, p - 1] == -0:
+                out[i, p - 1] = 0
 
     return np.asarray(out), gamma
 
@@ -204,23 +242,28 @@ def cov_shrink_rblw(const double[:, ::1] S, int n, shrinkage=None):
         shrinkage target, :math:`T`, but a different method for estimating the
         shrinkage intensity, :math:`gamma`.
     """
-    cdef int i, j
-    cdef int p = S.shape[0]
+    cdef Py_ssize_t i, j
+    cdef Py_ssize_t p = S.shape[0]
     if S.shape[1] != p:
         raise ValueError('S must be a (p x p) matrix')
 
-    cdef double alpha = (n-2)/(n*(n+2))
-    cdef double beta = ((p+1)*n - 2) / (n*(n+2))
+    cdef double alpha = (n - 2.0) / (n * (n + 2.0))
+    cdef double beta = ((p + 1.0) * n - 2.0) / (n * (n + 2.0))
 
-    cdef double trace_S       # np.trace(S)
+    cdef double trace_S = 0   # np.trace(S)
     cdef double trace_S2 = 0  # np.trace(S.dot(S))
-    for i in range(p):
-        trace_S += S[i,i]
-        for j in range(p):
-            trace_S2 += S[i,j]*S[i,j]
+    with nogil:
+        for i in prange(p):
+            trace_S += S[i,i]
+            for j in range(p):
+                trace_S2 += S[i,j]*S[i,j]
 
     cdef double U = ((p * trace_S2 / (trace_S*trace_S)) - 1)
-    cdef double rho = min(alpha + beta/U, 1)
+    cdef double rho
+    if shrinkage is not None:
+        rho = max(0.0, min(1.0, float(shrinkage)))
+    else:
+        rho = min(alpha + beta/U, 1)
 
     F = (trace_S / p) * np.eye(p)
     return (1-rho)*np.asarray(S) + rho*F, rho
@@ -230,6 +273,7 @@ def cov_shrink_rblw(const double[:, ::1] S, int n, shrinkage=None):
 #############################  Private utilities #############################
 
 @cython.boundscheck(False)
+@cython.wraparound(False)
 cdef inline int cy_dgemm_TN(double[:, ::1] a, double[:, ::1] b, double[:, ::1] c, double alpha=1.0, double beta=0.0) nogil:
     """C = beta*C + alpha*dot(A.T, B)
     """
@@ -241,4 +285,23 @@ cdef inline int cy_dgemm_TN(double[:, ::1] a, double[:, ::1] b, double[:, ::1] c
         return -1
 
     dgemm("N", "T", &n, &m, &k, &alpha, &b[0,0], &n, &a[0,0], &m, &beta, &c[0,0], &n)
-    return 0
\ No newline at end of file
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline int cy_dsyrk_TN(double[:, ::1] a, double[:, ::1] c, double alpha=1.0) nogil:
+    """C = alpha*dot(A.T, A), computing half of the matrix and copying it to the other half
+    """
+    cdef int n, k, i, j
+    n = a.shape[1]
+    k = a.shape[0]
+    if a.shape[1] != c.shape[0] or a.shape[1] != c.shape[1]:
+        return -1
+    cdef double beta = 0.0
+
+    dsyrk("U", "N", &n, &k, &alpha, &a[0,0], &n, &beta, &c[0,0], &n)
+    for i in prange(n):
+        for j in range(i + 1, n):
+            c[i, j] = c[j, i]
+    return 0
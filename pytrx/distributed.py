@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+distributed - reduction of the data by several processes or nodes which
+share a filesystem (DistributedReduction).
+"""
+from pathlib import Path
+import os
+import json
+import socket
+import threading
+import traceback
+import time
+
+import numpy as np
+from scipy import sparse
+
+from pytrx.scatdata import ScatData, IntensityContainer
+
+
+class DistributedReduction:
+    ''' Reduction of the data by several processes, possibly on different nodes,
+    which share a filesystem. The images are split into shards (scans or ranges
+    of images of the scans). The workers claim the shards one by one, integrate
+    them and save the curves to the job directory. The reducer combines the
+    shards and calculates the total and difference averages of all the data,
+    which are the same as the ones obtained on a single node.
+
+    The coordination goes only through the files in the job directory:
+        job.json - the shards and the settings (see prepare)
+        shard_NNNN.lock.G - the claim of the shard by a worker (created
+        exclusively). The worker updates its modification time every
+        heartbeatInterval seconds; when it is older than staleTimeout seconds
+        (the worker died), the shard is claimed again by creating the lock of
+        the next generation G + 1, which only one worker can do
+        shard_NNNN.h5 - the processed shard (renamed into place when complete)
+        shard_NNNN.failed - the traceback if the processing failed (delete the
+        file to process the shard again)
+
+    Usage:
+        DistributedReduction(jobDir).prepare(logFiles, integration=dict(...), ...)
+        on every worker: DistributedReduction(jobDir).runWorker()
+        data = DistributedReduction(jobDir).reduce()
+    '''
+
+    def __init__(self, jobDir, staleTimeout=600, heartbeatInterval=30):
+        self.jobDir = Path(jobDir)
+        self.staleTimeout = staleTimeout
+        self.heartbeatInterval = heartbeatInterval
+
+    def prepare(self, logFile, dataInDir=None, logFileStyle='biocars', ignoreFirst=False, shardSize=None,
+                integration=None, differences=None, totalAverages=None, diffAverages=None):
+        ''' Method for splitting the data into shards and writing the job file.
+
+        You need:
+        logFile, dataInDir, logFileStyle, ignoreFirst - see ScatData.__init__
+        shardSize - number of images in a shard; if None, every scan (log file)
+        is a shard
+        integration - dictionary with the keyword arguments of ScatData.integrate
+        (energy, distance, qRange, maskPath, workers, etc); the values should be
+        numbers, strings or lists, as they are stored in json
+        differences - dictionary with the keyword arguments of getDifferences
+        (toff_str, subtractFlag); if None, the differences are not calculated
+        totalAverages, diffAverages - dictionaries with the keyword arguments of
+        getTotalAverages and getDiffAverages
+        '''
+        logFiles = [str(log) for log in np.atleast_1d(logFile)]
+        if dataInDir is None:
+            dataInDirs = [None] * len(logFiles)
+        else:
+            dataInDirs = [str(dataDir) for dataDir in np.atleast_1d(dataInDir)]
+        assert len(dataInDirs) == len(logFiles), 'provide dataInDir for every log file'
+
+        shards = []
+        for log, dataDir in zip(logFiles, dataInDirs):
+            if shardSize is None:
+                shards.append(dict(logFile=log, dataInDir=dataDir, start=None, stop=None))
+            else:
+                nFiles = ScatData(log, logFileStyle=logFileStyle, ignoreFirst=ignoreFirst, dataInDir=dataDir).nFiles
+                for start in range(0, nFiles, shardSize):
+                    shards.append(dict(logFile=log, dataInDir=dataDir, start=start,
+                                       stop=min(start + shardSize, nFiles)))
+
+        job = dict(shards=shards, logFileStyle=logFileStyle, ignoreFirst=ignoreFirst,
+                   integration=integration or {}, differences=differences,
+                   totalAverages=totalAverages or {}, diffAverages=diffAverages or {})
+        self.jobDir.mkdir(parents=True, exist_ok=True)
+        tmpPath = self.jobDir / 'job.json.tmp'
+        tmpPath.write_text(json.dumps(job, indent=1))
+        os.replace(tmpPath, self.jobDir / 'job.json')
+        print('*** Prepared', len(shards), 'shards in', self.jobDir, '***')
+
+    def runWorker(self, workerName=None):
+        ''' Method for processing the shards until all of them are claimed. It
+        can be run in any number of processes on any nodes. Returns the list of
+        the shards processed by the worker.
+        '''
+        job = self._readJob()
+        if workerName is None:
+            workerName = '%s_%d' % (socket.gethostname(), os.getpid())
+        processed = []
+        while True:
+            claim = self._claimShard(job, workerName)
+            if claim is None:
+                break
+            i, lock = claim
+            stopHeartbeat = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(lock, stopHeartbeat), daemon=True)
+            heartbeat.start()
+            try:
+                self._processShard(job, i, workerName)
+                processed.append(i)
+            except Exception:
+                self._getPath(i, '.failed').write_text(traceback.format_exc())
+                print('Shard', i, 'failed, see', self._getPath(i, '.failed'))
+            finally:
+                stopHeartbeat.set()
+                heartbeat.join()
+                self._releaseShard(lock)
+        print('*** Worker', workerName, 'finished: processed shards', processed, '***')
+        return processed
+
+    def reduce(self, wait=True, pollInterval=10, timeout=None, savePath=None):
+        ''' Method for combining the processed shards. The total curves of the
+        shards are concatenated, and the averaging (getTotalAverages), the
+        differences (getDifferences) and their averaging (getDiffAverages) are
+        done for all the data with the settings of the job.
+
+        You need:
+        wait - if True, waits until all the shards are processed
+        pollInterval - time between the checks of the shards (s)
+        timeout - maximum waiting time (s); if None, waits forever
+        savePath - if given, the result is saved there (see ScatData.save)
+
+        Output:
+        ScatData object with the reduced data
+        '''
+        job = self._readJob()
+        nShards = len(job['shards'])
+        startTime = time.time()
+        while True:
+            failed = [i for i in range(nShards) if self._getPath(i, '.failed').is_file()]
+            assert not failed, f'shards {failed} failed, see the .failed files in {self.jobDir}'
+            missing = [i for i in range(nShards) if not self._getPath(i, '.h5').is_file()]
+            if not missing:
+                break
+            assert wait, f'shards {missing} are not processed yet'
+            assert (timeout is None) or (time.time() - startTime < timeout), \
+                f'shards {missing} were not processed in {timeout} s'
+            time.sleep(pollInterval)
+
+        print('*** Reducing', nShards, 'shards ***')
+        parts = []
+        for i in range(nShards):
+            part = ScatData(str(self._getPath(i, '.h5')))
+            part.diff = IntensityContainer()  # the differences are calculated for all the data
+            parts.append(part)
+        data = parts[0]
+        for part in parts[1:]:
+            data._appendData(part)
+
+        delays = {}
+        for part in parts:
+            delays.update(zip(np.atleast_1d(part.t_str), np.atleast_1d(part.t)))
+        t_str = np.array(list(delays.keys()))
+        t = np.array(list(delays.values()))
+        data.t_str, data.t, data.nDelays = t_str[np.argsort(t)], np.sort(t), t_str.size
+        data.logFileStyle = job['logFileStyle']
+        data.integrationSettings = {key: value for key, value in job['integration'].items() if key != 'plotting'}
+        data.total.isOutlier = np.zeros(data.nFiles, dtype=bool)
+        data.total.covii = sparse.diags(1 / data.total.normInt / np.median(1 / data.total.normInt), format='csr')
+        print('*** Done ***\n')
+
+        data.getTotalAverages(**{'plotting': False, **job['totalAverages']})
+        if job['differences']:
+            data.getDifferences(**job['differences'])
+            data.getDiffAverages(**{'plotting': False, **job['diffAverages']})
+        if savePath is not None:
+            data.save(savePath)
+        return data
+
+    def _readJob(self):
+        path = self.jobDir / 'job.json'
+        assert path.is_file(), f'{path} not found, prepare the job first'
+        return json.loads(path.read_text())
+
+    def _getPath(self, i, suffix):
+        return self.jobDir / ('shard_%04d%s' % (i, suffix))
+
+    def _getLocks(self, i):
+        ''' Returns the lock files of the shard i by generation.
+        '''
+        locks = {}
+        for lock in self.jobDir.glob('shard_%04d.lock.*' % i):
+            generation = lock.name.rpartition('.')[2]
+            if generation.isdigit():
+                locks[int(generation)] = lock
+        return locks
+
+    def _claimShard(self, job, workerName):
+        ''' Claims the first shard which is neither processed nor claimed by a
+        living worker. Returns the index of the shard and its lock file or None
+        if there are no shards left.
+        '''
+        for i in range(len(job['shards'])):
+            if self._getPath(i, '.h5').is_file() or self._getPath(i, '.failed').is_file():
+                continue
+            locks = self._getLocks(i)
+            generation = max(locks, default=0)
+            if generation:
+                try:
+                    if time.time() - locks[generation].stat().st_mtime < self.staleTimeout:
+                        continue
+                except FileNotFoundError:  # released or claimed again in the meantime
+                    continue
+            # the lock of the next generation is created exclusively, so only one of
+            # the workers which found the shard free (or abandoned) claims it
+            lock = self._getPath(i, '.lock.%d' % (generation + 1))
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(workerName)
+            if generation:
+                print('Shard', i, 'was abandoned, claiming it again')
+                self._releaseShard(locks[generation])
+            if self._getPath(i, '.h5').is_file() or self._getPath(i, '.failed').is_file():
+                self._releaseShard(lock)  # finished between the check and the claim
+                continue
+            return i, lock
+        return None
+
+    def _releaseShard(self, lock):
+        try:
+            lock.unlink()
+        except FileNotFoundError:  # the shard was claimed again as abandoned
+            pass
+
+    def _heartbeat(self, lock, stop):
+        while not stop.wait(self.heartbeatInterval):
+            try:
+                os.utime(lock)
+            except FileNotFoundError:
+                pass
+
+    def _processShard(self, job, i, workerName):
+        shard = job['shards'][i]
+        print('*** Worker', workerName, 'processes shard', i, ':', shard['logFile'],
+              '' if shard['start'] is None else 'images %d:%d' % (shard['start'], shard['stop']), '***')
+        data = ScatData(shard['logFile'], logFileStyle=job['logFileStyle'], ignoreFirst=job['ignoreFirst'],
+                        dataInDir=shard['dataInDir'])
+        if shard['start'] is not None:
+            data._selectFiles(shard['start'], shard['stop'])
+        data.integrate(**{'plotting': False, **job['integration']})
+        data.diff = IntensityContainer()  # the averaging and differences are done by reduce
+
+        tmpPath = self._getPath(i, '.h5.tmp.' + workerName)
+        data.save(str(tmpPath))
+        os.replace(tmpPath, self._getPath(i, '.h5'))
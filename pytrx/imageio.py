@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+imageio - reading of the detector images for the data reduction: single
+images (memory-mapped EDF or fabio), frames of multi-frame HDF5/NeXus files
+(FrameFiles) and consolidated image archives (ImageArchive).
+"""
+import os
+import sys
+import re
+import zlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
+
+import numpy as np
+
+from pytrx.utils import lazy_import
+
+h5py = lazy_import('h5py')
+fabio = lazy_import('fabio')
+
+# extensions of the multi-frame detector files (see ScatData._mapFrames)
+frame_file_extensions = ('.h5', '.hdf5', '.hdf', '.nxs', '.nx5')
+
+
+class ImageArchive:
+    ''' Single HDF5 file with the images of a data set, made by
+    ScatData.archiveImages. The file contains:
+        images - stack of the images (nFrames x ny x nx), chunked and compressed
+        scan, file - scan (log file) name and file name of each frame, i.e. the
+        frame index of the log data
+        logData - log data of the archived images (pandas)
+    The images of a ScatData object are found in the archive by their scan and
+    file names (see setImages). Sequential images are read in blocks of whole
+    chunks (about blockBytes bytes), which is much faster on parallel
+    filesystems than opening many small files.
+    '''
+
+    def __init__(self, path, blockBytes=2 ** 26):
+        self.path = str(path)
+        self.blockBytes = blockBytes
+        self.frames = {}  # image path -> frame index
+        self._file = None
+
+    def __getstate__(self):
+        # the open file is not sent to worker processes; they open it themselves
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def _open(self):
+        if self._file is None:
+            self._file = h5py.File(self.path, 'r')
+        return self._file
+
+    def setImages(self, impaths, scans, files):
+        ''' Method for associating the image paths with the frames of the archive
+        which have the same scan and file names.
+        '''
+        f = self._open()
+        index = {key: i for i, key in enumerate(zip(f['scan'].asstr()[:], f['file'].asstr()[:]))}
+        missing = [(scan, file) for scan, file in zip(scans, files) if (scan, file) not in index]
+        assert not missing, '%d images are not in the archive %s (e.g. %s)' % (len(missing), self.path, missing[0])
+        self.frames = {impath: index[(scan, file)] for impath, scan, file in zip(impaths, scans, files)}
+
+    def getShape(self):
+        return self._open()['images'].shape[1:]
+
+    def readImages(self, impaths, prefetch=None, readerThreads=2):
+        ''' Generator reading the images impaths (see setImages) in this order
+        (see readImages). Consecutive frames are read with one request per block
+        of chunks (see _readFrames); if prefetch is given, the next block is read
+        by a thread while the current one is used and the chunks are decoded by
+        readerThreads threads.
+        '''
+        images = self._open()['images']
+        frames = np.array([self.frames[impath] for impath in impaths], dtype=int)
+        blockFrames = _getBlockFrames(images, self.blockBytes)
+        # blocks of consecutive increasing frames within the same block of chunks
+        newBlock = np.ones(frames.size, dtype=bool)
+        newBlock[1:] = (np.diff(frames) <= 0) | (frames[1:] // blockFrames != frames[:-1] // blockFrames)
+        blocks = np.split(frames, np.where(newBlock)[0][1:]) if frames.size else []
+
+        decoder = ThreadPoolExecutor(max_workers=readerThreads) if prefetch else None
+        try:
+            yield from _iterBlocks(blocks, lambda block: _readFrames(images, block, decoder), prefetch)
+        finally:
+            if decoder:
+                decoder.shutdown(wait=True)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class FrameFiles:
+    ''' Reader of the frames of multi-frame HDF5/NeXus detector files (e.g.
+    Eiger master files), which are referred to as <path>::<frame> (see
+    ScatData._mapFrames). The frames are never read file by file: consecutive
+    frames of a dataset are read in chunk-aligned blocks of about blockBytes
+    bytes with direct chunk reads (see _readFrames), so the containers are not
+    loaded into memory. Up to maxOpenFiles files are kept open. The images
+    which are not frames are read with _readImageData.
+    '''
+
+    def __init__(self, blockBytes=2 ** 26, maxOpenFiles=16):
+        self.blockBytes = blockBytes
+        self.maxOpenFiles = maxOpenFiles
+        self._files = {}  # path -> (h5py.File, frame datasets, cumulative numbers of frames)
+
+    def _getDatasets(self, path):
+        if path not in self._files:
+            if len(self._files) >= self.maxOpenFiles:
+                oldest = next(iter(self._files))
+                self._files.pop(oldest)[0].close()
+            f = h5py.File(path, 'r')
+            datasets = _getFrameDatasets(f)
+            self._files[path] = (f, datasets, np.cumsum([0] + [dataset.shape[0] for dataset in datasets]))
+        return self._files[path]
+
+    def readImages(self, impaths, prefetch=None, readerThreads=2, memoryMap=True):
+        ''' Generator reading the images impaths in this order (see readImages).
+        If prefetch is given, the next block is read by a thread while the
+        current one is used and the chunks are decoded by readerThreads threads.
+        '''
+        blocks = []  # [path, dataset index, frames in the dataset] or [impath, None, None]
+        lastBlockId = None
+        for impath in impaths:
+            path, frame = _splitFramePath(impath)
+            if frame is None:
+                blocks.append([impath, None, None])
+                lastBlockId = None
+                continue
+            _, datasets, nFrames = self._getDatasets(path)
+            k = np.searchsorted(nFrames, frame, side='right') - 1
+            frame -= nFrames[k]
+            blockId = (path, k, frame // _getBlockFrames(datasets[k], self.blockBytes))
+            if (blockId == lastBlockId) and (frame > blocks[-1][2][-1]):
+                blocks[-1][2].append(frame)
+            else:
+                blocks.append([path, k, [frame]])
+            lastBlockId = blockId
+
+        decoder = ThreadPoolExecutor(max_workers=readerThreads) if prefetch else None
+
+        def readBlock(block):
+            path, k, frames = block
+            if k is None:
+                return [_readImageData(path, memoryMap)]
+            return _readFrames(self._getDatasets(path)[1][k], np.array(frames), decoder)
+
+        try:
+            yield from _iterBlocks(blocks, readBlock, prefetch)
+        finally:
+            if decoder:
+                decoder.shutdown(wait=True)
+            self.close()
+
+    def close(self):
+        for f, _, _ in self._files.values():
+            f.close()
+        self._files = {}
+
+
+def _listFiles(directory):
+    ''' Set of the names of the files in the directory (empty if it can not be
+    listed), obtained with a single listing instead of a metadata request per file.
+    '''
+    try:
+        with os.scandir(directory if directory else '.') as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except OSError:
+        return set()
+
+
+def readImages(impaths, prefetch=None, readerThreads=2, memoryMap=True, archive=None):
+    ''' Generator reading images one by one in the order of impaths (see
+    _readImageData for memoryMap). If archive (ImageArchive) is given, the
+    images are read from it (see ImageArchive.readImages); frames of
+    multi-frame files (<path>::<frame>) are read in blocks by FrameFiles.
+
+    If prefetch is given, up to prefetch decoded images are read ahead by a pool
+    of readerThreads threads, so that reading overlaps with whatever the caller
+    does with the current image.
+
+    Yields:
+        image - image data
+        readTime - time spent on reading the image or, with prefetch, the time
+        spent waiting for it to arrive from the queue (read stall), in s
+    '''
+    if archive is not None:
+        yield from archive.readImages(impaths, prefetch, readerThreads)
+        return
+    if any('::' in str(impath) for impath in impaths):  # frames of multi-frame files
+        yield from FrameFiles().readImages(impaths, prefetch, readerThreads, memoryMap)
+        return
+
+    if not prefetch:
+        for impath in impaths:
+            startReadTime = time.perf_counter()
+            image = _readImageData(impath, memoryMap)
+            yield image, time.perf_counter() - startReadTime
+        return
+
+    executor = ThreadPoolExecutor(max_workers=readerThreads)
+    queue = deque()
+    try:
+        impaths = iter(impaths)
+        for impath in islice(impaths, prefetch):
+            queue.append(executor.submit(_readImageData, impath, memoryMap))
+        while queue:
+            startReadTime = time.perf_counter()
+            image = queue.popleft().result()
+            readTime = time.perf_counter() - startReadTime
+            for impath in islice(impaths, 1):
+                queue.append(executor.submit(_readImageData, impath, memoryMap))
+            yield image, readTime
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _readImageData(impath, memoryMap=True):
+    ''' Function reading the image data. Frames of multi-frame HDF5/NeXus files
+    are given as <path>::<frame> (see FrameFiles). If memoryMap is True,
+    uncompressed single-frame EDF files are memory-mapped (see _mapEdfImage);
+    other files (compressed, multi-frame, other formats) are read with fabio.
+    '''
+    path, frame = _splitFramePath(impath)
+    if frame is not None:
+        with h5py.File(path, 'r') as f:
+            dataset, frame = _locateFrame(_getFrameDatasets(f), frame)
+            return _readFrames(dataset, np.array([frame]))[0]
+    if memoryMap:
+        image = _mapEdfImage(impath)
+        if image is not None:
+            return image
+    return fabio.open(impath).data
+
+
+def _splitFramePath(impath):
+    ''' Splits <path>::<frame> into the path and the frame index (None for the
+    single-image files).
+    '''
+    path, sep, frame = str(impath).rpartition('::')
+    if not sep:
+        return str(impath), None
+    return path, int(frame)
+
+
+def _getFrameDatasets(f):
+    ''' Function finding the datasets with the frames of a multi-frame HDF5/NeXus
+    file f: the data, data_000001, data_000002, ... datasets of the entry/data
+    group (as in the Eiger master files, where they are external links to the
+    data files), the signal of the NeXus default NXdata group, or the first 3D
+    dataset of the file.
+    Returns a list of the datasets in the order of the frames.
+    '''
+    datasets = []
+    if isinstance(f.get('entry/data'), h5py.Group):
+        group = f['entry/data']
+        for name in sorted(key for key in group.keys() if re.fullmatch(r'data(_\d+)?', key)):
+            try:
+                dataset = group[name]
+            except KeyError:  # broken external link
+                continue
+            if isinstance(dataset, h5py.Dataset) and (dataset.ndim == 3):
+                datasets.append(dataset)
+    if not datasets:
+        try:
+            entry = f[f.attrs['default']]
+            nxdata = entry[entry.attrs['default']]
+            dataset = nxdata[nxdata.attrs['signal']]
+            if isinstance(dataset, h5py.Dataset) and (dataset.ndim == 3):
+                datasets.append(dataset)
+        except (KeyError, TypeError):
+            pass
+    if not datasets:
+        found = []
+        f.visititems(lambda name, item: found.append(item) if (isinstance(item, h5py.Dataset) and item.ndim == 3)
+                     else None)
+        datasets = found[:1]
+    return datasets
+
+
+def _locateFrame(datasets, frame):
+    ''' Returns the dataset holding the frame (of all the frames of the datasets)
+    and the frame index in this dataset.
+    '''
+    for dataset in datasets:
+        if frame < dataset.shape[0]:
+            return dataset, frame
+        frame -= dataset.shape[0]
+    raise IndexError('frame is out of range')
+
+
+def _readFrames(dataset, frames, executor=None):
+    ''' Function reading the frames (increasing indices) of a 3D dataset. The
+    chunks covering frames[0]..frames[-1] are read at once; when the dataset
+    is compressed only with deflate and shuffle, the chunks are read with
+    h5py direct chunk reads and decoded here (by the executor threads, if
+    given), otherwise through the HDF5 filter pipeline.
+    '''
+    start, stop = frames[0], frames[-1] + 1
+    data = _readDirectChunks(dataset, start, stop, executor)
+    if data is None:
+        _loadFilterPlugins()
+        data = dataset[start:stop]
+    return data[frames - start]
+
+
+def _loadFilterPlugins():
+    ''' Registers the HDF5 compression filters of hdf5plugin (bitshuffle, LZ4,
+    ...) used by detector files, if the package is installed.
+    '''
+    try:
+        import hdf5plugin  # noqa: F401
+    except ImportError:
+        pass
+
+
+def _readDirectChunks(dataset, start, stop, executor=None):
+    ''' Reads dataset[start:stop] chunk by chunk with read_direct_chunk. Returns
+    None if the dataset is not chunked, uses other filters than deflate and
+    shuffle, or has unwritten chunks.
+    '''
+    chunks = dataset.chunks
+    if chunks is None:
+        return None
+    plist = dataset.id.get_create_plist()
+    filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+    if not set(filters) <= {h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE}:
+        return None
+
+    shape = dataset.shape
+    first = start // chunks[0] * chunks[0]
+    offsets = [(i, j, k) for i in range(first, stop, chunks[0])
+               for j in range(0, shape[1], chunks[1]) for k in range(0, shape[2], chunks[2])]
+    try:
+        raw = [dataset.id.read_direct_chunk(offset) for offset in offsets]
+    except (KeyError, ValueError, OSError):
+        return None
+
+    def decode(chunk):
+        return _decodeChunk(chunk, filters, chunks, dataset.dtype)
+
+    data = np.empty((min(offsets[-1][0] + chunks[0], shape[0]) - first,) + shape[1:], dtype=dataset.dtype)
+    for (i, j, k), chunk in zip(offsets, executor.map(decode, raw) if executor else map(decode, raw)):
+        block = data[i - first:i - first + chunks[0], j:j + chunks[1], k:k + chunks[2]]
+        block[...] = chunk[:block.shape[0], :block.shape[1], :block.shape[2]]
+    return data[start - first:stop - first]
+
+
+def _decodeChunk(chunk, filters, chunkShape, dtype):
+    ''' Decodes a chunk read with read_direct_chunk by undoing the deflate and
+    shuffle filters in the reverse order (skipping the filters marked in the
+    filter mask).
+    '''
+    filterMask, data = chunk
+    for i in reversed(range(len(filters))):
+        if filterMask & (1 << i):
+            continue
+        if filters[i] == h5py.h5z.FILTER_DEFLATE:
+            data = zlib.decompress(data)
+        elif filters[i] == h5py.h5z.FILTER_SHUFFLE:
+            data = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T.tobytes()
+    return np.frombuffer(data, dtype=dtype).reshape(chunkShape)
+
+
+def _getBlockFrames(dataset, blockBytes):
+    ''' Number of frames of the dataset read at once: the whole chunks (along the
+    frames) which fit into blockBytes (at least one chunk).
+    '''
+    frameBytes = np.prod(dataset.shape[1:]) * dataset.dtype.itemsize
+    chunkFrames = dataset.chunks[0] if dataset.chunks else 1
+    return chunkFrames * max(1, int(blockBytes // (frameBytes * chunkFrames)))
+
+
+def _iterBlocks(blocks, readBlock, prefetch=None):
+    ''' Generator reading the (non-empty) blocks of images with readBlock(block)
+    and yielding the images one by one, as readImages. If prefetch is given,
+    the next block is read by a thread while the current one is used.
+
+    Yields:
+        image - image data
+        readTime - time spent on reading the block (or, with prefetch,
+        waiting for it), counted at its first image, in s
+    '''
+    if not blocks:
+        return
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        future = executor.submit(readBlock, blocks[0]) if executor else None
+        for k, block in enumerate(blocks):
+            startReadTime = time.perf_counter()
+            if executor:
+                data = future.result()
+                if k + 1 < len(blocks):
+                    future = executor.submit(readBlock, blocks[k + 1])
+            else:
+                data = readBlock(block)
+            readTime = time.perf_counter() - startReadTime
+            for j, image in enumerate(data):
+                yield image, readTime if j == 0 else 0.0
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# EDF data types (as in fabio.edfimage)
+_edf_dtypes = {'SignedByte': np.int8, 'Signed8': np.int8, 'UnsignedByte': np.uint8, 'Unsigned8': np.uint8,
+               'SignedShort': np.int16, 'Signed16': np.int16, 'UnsignedShort': np.uint16, 'Unsigned16': np.uint16,
+               'UnsignedShortInteger': np.uint16, 'SignedInteger': np.int32, 'Signed32': np.int32,
+               'UnsignedInteger': np.uint32, 'Unsigned32': np.uint32, 'SignedLong': np.int32,
+               'UnsignedLong': np.uint32, 'Signed64': np.int64, 'Unsigned64': np.uint64,
+               'FloatValue': np.float32, 'FLOATVALUE': np.float32, 'FLOAT': np.float32, 'Float': np.float32,
+               'FloatIEEE32': np.float32, 'Float32': np.float32, 'Double': np.float64, 'DoubleValue': np.float64,
+               'FloatIEEE64': np.float64, 'DoubleIEEE64': np.float64}
+
+
+def _mapEdfImage(impath, maxHeaderSize=2 ** 18):
+    ''' Function mapping the pixel block of an uncompressed single-frame EDF file
+    into memory. Only the header is read; the pixels are returned as a zero-copy
+    numpy view of the file (copy-on-write, so the array can be modified without
+    touching the file), which is paged in when the integrator uses it.
+    Returns None if the file is not an uncompressed single-frame EDF file in the
+    native byte order, so that the caller can fall back to fabio.
+    '''
+    with open(impath, 'rb') as f:
+        header = f.read(4096)
+        end = header.find(b'}\n')
+        while (end < 0) and (len(header) < maxHeaderSize):
+            block = f.read(4096)
+            if not block:
+                break
+            header += block
+            end = header.find(b'}\n')
+    if (not header.startswith(b'{')) or (end < 0):
+        return None
+
+    keys = {}
+    for item in header[1:end].split(b';'):
+        key, sep, value = item.partition(b'=')
+        if sep:
+            keys[key.strip().decode('latin-1').upper()] = value.strip().decode('latin-1')
+    byteOrder = {'little': 'LowByteFirst', 'big': 'HighByteFirst'}[sys.byteorder]
+    if ((keys.get('COMPRESSION', 'NONE').upper()[:2] != 'NO') or ('EDF_BINARYFILENAME' in keys)
+            or (keys.get('DATATYPE') not in _edf_dtypes) or (keys.get('BYTEORDER') != byteOrder)):
+        return None
+    dtype = np.dtype(_edf_dtypes[keys['DATATYPE']])
+    offset = end + 2
+    try:
+        shape = (int(keys['DIM_2']), int(keys['DIM_1']))
+        nbytes = shape[0] * shape[1] * dtype.itemsize
+        if ((int(keys.get('DIM_3', 1)) != 1) or (int(keys.get('SIZE', nbytes)) != nbytes)
+                or (os.path.getsize(impath) != offset + nbytes)):
+            return None  # multi-frame file or inconsistent header
+    except (KeyError, ValueError):
+        return None
+    return np.memmap(impath, dtype=dtype, mode='c', offset=offset, shape=shape).view(np.ndarray)
@@ -47,7 +47,7 @@ class SmallMoleculeProject:
         '''
         print(type(input_data))
         if type(input_data) == str:
-            self.data = scatdata.ScatData(input_data, smallLoad=True)
+            self.data = scatdata.ScatData(input_data, smallLoad=True, lazy=True)
         elif type(input_data) == scatdata.ScatData:
 
             print('Inputting ScatData data')
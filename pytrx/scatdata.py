@@ -13,34 +13,44 @@ understand input/output.
 """
 from pathlib import Path
 import ntpath
+import os
+import hashlib
 import time
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from math import pi
 
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
-from scipy.ndimage import median_filter
-import scipy.signal as signal
 from scipy import sparse
-from covar import cov_shrink_ss
 
-import h5py
-
-import pyFAI
-import fabio
-import scipy.io
-
-from pytrx.utils import DataContainer, _get_id09_columns_old, _get_id09_columns, time_str2num, time_num2str, \
-    invert_banded
-
-from matplotlib.lines import Line2D
-
-custom_lines = [Line2D([0], [0], color='k', lw=1),
-                Line2D([0], [0], color='b', lw=1),
-                Line2D([0], [0], color='r', lw=1)]
+from pytrx.utils import DataContainer, _get_id09_columns_old, _get_id09_columns, time_num2str, \
+    invert_banded, bin_operator, time_str2num_array, time_num2str_array, timestamp_str2num_array, lazy_import, \
+    lazy_njit
+from pytrx import caches
+from pytrx.caches import LogCache, CurveCache, IntegrationCheckpoint
+from pytrx.imageio import ImageArchive, readImages, _readImageData, _listFiles, _getFrameDatasets, \
+    frame_file_extensions
+
+# heavy dependencies are imported on first use (see utils.lazy_import and utils.benchmarkImportTime)
+plt = lazy_import('matplotlib.pyplot')
+signal = lazy_import('scipy.signal')
+scipy_io = lazy_import('scipy.io')
+h5py = lazy_import('h5py')
+pyFAI = lazy_import('pyFAI')
+fabio = lazy_import('fabio')
+covar = lazy_import('covar')
 
 ignore_these_fields = ['covii', 'imageAv', 'logData']
+lazy_fields = ['s', 's_raw', 'ds', 'imageAv']  # read only when sliced if loaded with lazy=True
+
+# axes of the saved fields, used for loading subsets of the data (see ScatData.initializeFromH5)
+subset_axes = {'q': ('q',), 'tth': ('q',), 't': ('t',), 't_str': ('t',),
+               's_raw': ('q', 'image'), 's': ('q', 'image'), 'ds': ('q', 'image'), 's2': ('q', 'image'),
+               's_av': ('q', 't'), 's_err': ('q', 't'), 'ds_av': ('q', 't'), 's2_av': ('q', 't'),
+               's2_err': ('q', 't'), 'covqq': ('q', 'q'), 'covtt': ('t', 't'), 'covii': ('image', 'image'),
+               'normInt': ('image',), 'chisq': (None, 'image'), 'isOutlier': ('image',), 'delay': ('image',),
+               'delay_str': ('image',), 'timeStamp': ('image',), 'timeStamp_str': ('image',),
+               'scanStamp': ('image',)}
 
 
 class ScatData:
@@ -97,7 +107,7 @@ class ScatData:
     '''
 
     def __init__(self, inputFile, logFileStyle='biocars', ignoreFirst=False, nFirstFiles=None, dataInDir=None,
-                 smallLoad=False):
+                 smallLoad=False, lazy=False, delays=None, scans=None, qRange=None, logCache=False):
         '''
         To read the file:
 
@@ -114,6 +124,16 @@ class ScatData:
         ignoreFirst - if True, the log reader will remove first image from
         each run frim the data analysis.
         nFiles - number of images you want to integrate in each run. (mostly for tests)
+        logCache - if True, the parsed log data are kept in a binary file next to
+        each log file or in ~/.pytrx/logs (see LogCache) and re-used as long as
+        the log file is not changed (default False)
+
+        To load the data saved with the save method, provide the .h5 file as
+        inputFile:
+        smallLoad - if True, covii, imageAv and logData are not loaded
+        lazy - if True, the curves (total.s, diff.s, etc) and imageAv stay in the
+        file and are read only when sliced (see LazyArray)
+        delays, scans, qRange - load only a part of the data (see initializeFromH5)
 
         The initialization adds a logData attribute (self.logData), which
         is a pandas table containing all the log information.
@@ -129,14 +149,14 @@ class ScatData:
             extension = Path(inputFile[0]).suffix
         #
         if extension == '.log':
-            self.initializeLogFile(inputFile, logFileStyle, ignoreFirst, nFirstFiles, dataInDir)
+            self.initializeLogFile(inputFile, logFileStyle, ignoreFirst, nFirstFiles, dataInDir, logCache)
         elif extension == '.h5':
-            self.initializeFromH5(inputFile, smallLoad)
+            self.initializeFromH5(inputFile, smallLoad, lazy, delays, scans, qRange)
 
         if inputFile is None:
             self.initializeEmpty()
 
-    def initializeLogFile(self, logFile, logFileStyle, ignoreFirst, nFirstFiles, dataInDir):
+    def initializeLogFile(self, logFile, logFileStyle, ignoreFirst, nFirstFiles, dataInDir, logCache=False):
         if dataInDir is None:
             if type(logFile) is str:
                 dataInDir = str(Path(logFile).parent.absolute()) + '\\'
@@ -147,6 +167,7 @@ class ScatData:
         self.logFileStyle = logFileStyle
         self.ignoreFirst = ignoreFirst
         self.nFirstFiles = nFirstFiles
+        self.logCache = logCache
 
         self._assertCorrectInput()
         self._getLogData()
@@ -165,29 +186,15 @@ class ScatData:
         logDataAsList = []
         for i, item in enumerate(self.logFile):
             print('reading', item)
-            if self.logFileStyle == 'biocars':
-                logDataAsList.append(pd.read_csv(item, sep='\t', header=18))
-                logDataAsList[i].rename(columns={'#date time': 'timeStamp_str', 'delay': 'delay_str'}, inplace=True)
-                logDataAsList[i]['delay'] = logDataAsList[i]['delay_str'].apply(lambda x: time_str2num(x))
-
-            elif self.logFileStyle == 'id09_old':
-                logDataAsList.append(pd.read_csv(item, skiprows=1, skipfooter=1, sep='\t',
-                                                 engine='python', names=_get_id09_columns_old(),
-                                                 skipinitialspace=True))
-
-                logDataAsList[i]['timeStamp_str'] = logDataAsList[i]['date'] + ' ' + logDataAsList[i]['time']
-                logDataAsList[i]['delay_str'] = logDataAsList[i]['delay'].apply(lambda x: time_num2str(x))
-
-            elif self.logFileStyle == 'id09':
-                logDataAsList.append(pd.read_csv(item, skiprows=1, skipfooter=1, sep='\t',
-                                                 engine='python', names=_get_id09_columns(),
-                                                 skipinitialspace=True))
-
-                logDataAsList[i]['timeStamp_str'] = logDataAsList[i]['date'] + ' ' + logDataAsList[i]['time']
-                logDataAsList[i]['delay_str'] = logDataAsList[i]['delay'].apply(lambda x: time_num2str(x))
-
-            logDataAsList[i]['timeStamp'] = logDataAsList[i]['timeStamp_str'].apply(
-                lambda x: datetime.strptime(x, '%d-%b-%y %H:%M:%S').timestamp())
+            cache = LogCache(item, self.logFileStyle) if self.logCache else None
+            logData = cache.load() if cache else None
+            if logData is None:
+                logData = self._readLogFile(item)
+                if cache:
+                    cache.save(logData)
+            else:
+                print('(parsed log data loaded from', cache.path, ')')
+            logDataAsList.append(logData)
 
             if self.ignoreFirst:
                 logDataAsList[i] = logDataAsList[i][1:]
@@ -202,8 +209,40 @@ class ScatData:
                 logDataAsList[i]['dataInDir'] = self.dataInDir[i]
 
         self.logData = pd.concat(logDataAsList, ignore_index=True)
+        if 'frame' in self.logData:  # logs without multi-frame files have no frame column
+            self.logData['frame'] = self.logData['frame'].fillna(-1).astype(int)
         print('*** Done ***\n')
 
+    def _readLogFile(self, logFile):
+        '''
+        Parse one log file into a pandas dataframe with the time delays and
+        time stamps in numerical and string formats
+        '''
+        if self.logFileStyle == 'biocars':
+            logData = pd.read_csv(logFile, sep='\t', header=18)
+            logData.rename(columns={'#date time': 'timeStamp_str', 'delay': 'delay_str'}, inplace=True)
+            logData['delay'] = time_str2num_array(logData['delay_str'])
+
+        elif self.logFileStyle == 'id09_old':
+            logData = pd.read_csv(logFile, skiprows=1, skipfooter=1, sep='\t',
+                                  engine='python', names=_get_id09_columns_old(),
+                                  skipinitialspace=True)
+
+            logData['timeStamp_str'] = logData['date'] + ' ' + logData['time']
+            logData['delay_str'] = time_num2str_array(logData['delay'])
+
+        elif self.logFileStyle == 'id09':
+            logData = pd.read_csv(logFile, skiprows=1, skipfooter=1, sep='\t',
+                                  engine='python', names=_get_id09_columns(),
+                                  skipinitialspace=True)
+
+            logData['timeStamp_str'] = logData['date'] + ' ' + logData['time']
+            logData['delay_str'] = time_num2str_array(logData['delay'])
+
+        logData['timeStamp'] = timestamp_str2num_array(logData['timeStamp_str'])
+        self._mapFrames(logData)
+        return logData
+
     def _assertCorrectInput(self):
         '''
         This method asserts the right input according to the logic described
@@ -239,20 +278,89 @@ class ScatData:
 
     def _identifyExistingFiles(self):
         '''
-        goes through the files listed in log files and checks if they exist
+        goes through the files listed in log files and checks if they exist;
+        every directory is listed only once (see _listFiles). The names are
+        compared as the file system does (os.path.normcase), and the files which
+        are not found in the listing (e.g. on a case-insensitive file system) are
+        checked one by one
+        '''
+        if self.logFileStyle == 'id09_old':
+            self.logData['file'] = self.logData['file'].str.replace('ccdraw', 'edf', regex=False)
+        elif self.logFileStyle == 'id09':
+            self.logData['file'] = self.logData['file'] + '.edf'
+
+        filePaths = (self.logData['dataInDir'] + self.logData['file']).to_numpy()
+        dirs, names = np.array([os.path.split(filePath) for filePath in filePaths], dtype=object).reshape(-1, 2).T
+        exists = np.zeros(filePaths.size, dtype=bool)
+        for directory in pd.unique(dirs):
+            inDirectory = dirs == directory
+            listed = {os.path.normcase(name) for name in _listFiles(directory)}
+            exists[inDirectory] = [os.path.normcase(name) in listed for name in names[inDirectory]]
+        exists[~exists] = [os.path.isfile(filePath) for filePath in filePaths[~exists]]
+
+        for filePath in filePaths[~exists]:
+            print(filePath, 'does not exist and will be excluded from analysis')
+        self.logData = self.logData[exists]
+        self._checkFrames()
+
+    def _mapFrames(self, logData):
+        '''
+        maps the rows of one parsed log file (before ignoreFirst and nFirstFiles
+        are applied) referring to multi-frame HDF5/NeXus files (extensions in
+        frame_file_extensions) to (file, frame index): the frame can be given
+        in the log as <file>::<frame>, otherwise the rows referring to the same
+        file get its frames in the order of the rows. The frame indices are kept
+        in the 'frame' column (-1 for single-image files), which is added only
+        if there are such files.
         '''
-        idxToDel = []
-        for i, row in self.logData.iterrows():
-            if self.logFileStyle == 'id09_old':
-                self.logData.loc[i, 'file'] = self.logData.loc[i, 'file'].replace('ccdraw', 'edf')
-            elif self.logFileStyle == 'id09':
-                self.logData.loc[i, 'file'] += '.edf'
-
-            filePath = self.logData.loc[i, 'dataInDir'] + self.logData.loc[i, 'file']
-            if not Path(filePath).is_file():
-                idxToDel.append(i)
-                print(filePath, 'does not exist and will be excluded from analysis')
-        self.logData = self.logData.drop(idxToDel)
+        files = logData['file'].astype(str)
+        parts = files.str.rpartition('::')
+        hasFrame = (parts[1] == '::').to_numpy()
+        names = np.where(hasFrame, parts[0], files)
+        isMultiFrame = hasFrame | pd.Series(names).str.lower().str.endswith(frame_file_extensions).to_numpy()
+        if not np.any(isMultiFrame):
+            return
+
+        frames = np.full(names.size, -1)
+        frames[hasFrame] = parts[2][hasFrame].astype(int)
+        implicit = isMultiFrame & ~hasFrame
+        names = pd.Series(names)
+        frames[implicit] = names[implicit].groupby(names[implicit]).cumcount().to_numpy()
+        logData['file'] = names.to_numpy()
+        logData['frame'] = frames
+
+    def _checkFrames(self):
+        '''
+        excludes the rows referring to frames which are not in the multi-frame
+        files (see _mapFrames); every file is opened once
+        '''
+        if 'frame' not in self.logData:
+            return
+        filePaths = (self.logData['dataInDir'] + self.logData['file']).to_numpy()
+        frames = self.logData['frame'].to_numpy()
+        exists = np.ones(frames.size, dtype=bool)
+        for filePath in pd.unique(filePaths[frames >= 0]):
+            inFile = filePaths == filePath
+            try:
+                with h5py.File(filePath, 'r') as f:
+                    nFrames = sum(dataset.shape[0] for dataset in _getFrameDatasets(f))
+            except OSError:
+                nFrames = 0
+            exists[inFile] = frames[inFile] < nFrames
+        for filePath, frame in zip(filePaths[~exists], frames[~exists]):
+            print(filePath, 'frame', frame, 'does not exist and will be excluded from analysis')
+        self.logData = self.logData[exists]
+
+    def _getImageNames(self):
+        '''
+        file names of the images of the log data, with the frames of multi-frame
+        files given as <file>::<frame> (see _mapFrames)
+        '''
+        names = self.logData['file'].astype(str)
+        if 'frame' in self.logData:
+            isFrame = self.logData['frame'] >= 0
+            names = names.where(~isFrame, names + '::' + self.logData['frame'].astype(str))
+        return names.to_numpy()
 
     def logSummary(self):
         '''
@@ -283,6 +391,18 @@ class ScatData:
 
         print('*** End of summary ***\n')
 
+    def _selectFiles(self, start, stop):
+        ''' Method for restricting the data to the images start:stop of the log
+        data (see distributed.DistributedReduction).
+        '''
+        self.logData = self.logData.iloc[start:stop]
+        self.nFiles = len(self.logData.index)
+        self.nDelays = self.logData['delay_str'].nunique()
+        self.t = self.logData['delay'].unique()
+        self.t_str = self.logData['delay_str'].unique()
+        self.t_str = self.t_str[np.argsort(self.t)]
+        self.t = np.sort(self.t)
+
     # 1. Integration of images
 
     def integrate(self, energy=12, distance=365, pixelSize=80e-6,
@@ -290,7 +410,11 @@ class ScatData:
                   qNormRange=[1.9, 2.1], maskPath=None,
                   correctPhosphor=False, muphos=228, lphos=75e-4,
                   correctSample=False, musample=0.49, lsample=300e-6,
-                  plotting=True, nFiles=None):
+                  plotting=True, nFiles=None, workers=None,
+                  prefetch=None, readerThreads=2, memoryMap=True, archivePath=None,
+                  useOperator=False, operatorDir=None, batchSize=None,
+                  useCache=False, cacheDir=None, cacheByContent=False,
+                  checkpointPath=None, checkpointEvery=1000, resume=False):
         ''' This method integrates images given the geometry parameters.
 
             You will need:
@@ -315,6 +439,58 @@ class ScatData:
             plotting - whether you want to plot the output results (boolean)
             nMax - number of Images you want to integrate. All imges will be
             integrates if nMax is None.
+            workers - number of processes used for integration. If None (default),
+            the images are integrated one by one in the current process. Otherwise
+            the file list is split into contiguous chunks which are integrated by
+            a pool of worker processes, each holding its own integrator. On
+            Windows the call must be protected by if __name__ == '__main__'.
+            prefetch - number of decoded images kept in the prefetch queue. If
+            given, the images are read by readerThreads threads while the current
+            image is being integrated, and the printed readout time becomes the
+            time spent waiting for the queue (read stall). None disables it.
+            readerThreads - number of threads reading the images when prefetch
+            is used (default 2).
+            memoryMap - if True (default), uncompressed single-frame EDF images are
+            memory-mapped and handed to the integrator without being copied (see
+            imageio._mapEdfImage); other images are read with fabio. The readout time
+            then includes only the header parsing and mapping, while the pixels
+            are paged in during the integration.
+            archivePath - path to the image archive made with archiveImages. If
+            given, the images are read from the archive (in blocks of
+            consecutive frames) instead of the image files.
+            Frames of multi-frame HDF5/NeXus files (see _mapFrames) are read in
+            chunk-aligned blocks (see imageio.FrameFiles); use them with useOperator and
+            batchSize, so that each block is integrated at once.
+            useOperator - if True, the images are integrated as a sparse
+            matrix-vector product with the pixel-to-q operator built by
+            AIGeometry.getOperator. The operator includes the mask, solid angle,
+            polarization and absorption corrections and is stored on disk, so
+            repeated reductions with the same geometry and mask skip the setup.
+            operatorDir - directory for the stored operators (default is
+            ~/.pytrx/operators).
+            batchSize - number of images K stacked and integrated in one pass over
+            the operator (requires useOperator, see AIGeometry.integrateStack).
+            The stack takes K * number of pixels * 4 (or 8) bytes; the best K
+            depends on the cache size, so choose it with
+            benchmarks/bench_stack_integration.py.
+            useCache - if True, the integrated curves are stored in an on-disk cache
+            (see CurveCache) and only the images which are not found in the cache
+            are integrated. The cache is specific to the geometry, mask and
+            corrections; the images are identified by path, size and modification
+            time.
+            cacheDir - directory of the cache (default is ~/.pytrx/curves).
+            cacheByContent - identify the images by the hash of their content
+            instead of path, size and modification time (requires reading the
+            files).
+            checkpointPath - path to an HDF5 side file where the state of the
+            integration (curves, partial sum of the images, indices of the
+            processed images) is saved every checkpointEvery images (see
+            IntegrationCheckpoint). The files are removed when the integration
+            is finished.
+            checkpointEvery - number of images between checkpoints (default 1000)
+            resume - if True and the checkpoint file exists, the integration
+            continues from the last checkpoint. The log data, geometry and mask
+            must be the same as in the interrupted run.
 
             Method updates the following fields:
             self.q - transferred momentum in A^{-1}
@@ -331,6 +507,17 @@ class ScatData:
                        all the curves are NOT outliers.
 
         '''
+        # settings needed to integrate the scans added later with appendScan
+        self.integrationSettings = dict(energy=energy, distance=distance, pixelSize=pixelSize,
+                                        centerX=centerX, centerY=centerY, qRange=qRange, nqpt=nqpt,
+                                        qNormRange=qNormRange, maskPath=maskPath,
+                                        correctPhosphor=correctPhosphor, muphos=muphos, lphos=lphos,
+                                        correctSample=correctSample, musample=musample, lsample=lsample,
+                                        workers=workers, prefetch=prefetch, readerThreads=readerThreads,
+                                        memoryMap=memoryMap, archivePath=archivePath,
+                                        useOperator=useOperator, operatorDir=operatorDir, batchSize=batchSize,
+                                        useCache=useCache, cacheDir=cacheDir, cacheByContent=cacheByContent)
+
         # Get all the ingredients for integration:
         if not hasattr(self, 'aiGeometry'):
             self._getaiGeometry(energy, distance, pixelSize, centerX, centerY,
@@ -342,6 +529,33 @@ class ScatData:
         else:
             maskImage = None
 
+        impaths = self.logData['dataInDir'].to_numpy() + self._getImageNames()
+        if nFiles:
+            impaths = impaths[:nFiles]
+
+        archive = None
+        if archivePath:
+            assert Path(archivePath).is_file(), archivePath + ' file (image archive) not found'
+            archive = ImageArchive(archivePath)
+            archive.setImages(impaths, self.logData['Scan'].values, self._getImageNames())
+
+        if batchSize:
+            assert useOperator, 'batch integration requires useOperator=True'
+
+        if useOperator:
+            if maskImage is not None:
+                shape = maskImage.shape
+            elif archive is not None:
+                shape = archive.getShape()
+            else:
+                shape = _readImageData(impaths[0], memoryMap).shape
+            self.aiGeometry.getOperator(shape, nqpt, qRange, maskImage, operatorDir)
+            tth = 2 * np.arcsin(self.aiGeometry.wavelength * 1e10 * self.aiGeometry.operatorQ / (4 * pi))
+            self.aiGeometry.scaleOperator(self._getCorrections(tth, correctPhosphor, muphos, lphos,
+                                                               correctSample, musample, lsample))
+        else:
+            self.aiGeometry.operator = None
+
         self.total = IntensityContainer()
         self.total.s = np.zeros([nqpt, self.nFiles])
         self.total.s_raw = np.zeros([nqpt, self.nFiles])
@@ -354,64 +568,222 @@ class ScatData:
         self.total.isOutlier = np.zeros(self.nFiles, dtype=bool)
 
         print('*** Integration ***')
-        for i, row in self.logData.iterrows():
-            impath = row['dataInDir'] + row['file']
-            startReadTime = time.perf_counter()
-            image = fabio.open(impath).data
-            readTime = time.perf_counter() - startReadTime
-
-            startIntTime = time.perf_counter()
-            q, self.total.s_raw[:, i] = self.aiGeometry.ai.integrate1d(
-                image,
-                nqpt,
-                radial_range=qRange,
-                correctSolidAngle=True,
-                polarization_factor=1,
-                mask=maskImage,
-                unit="q_A^-1")
-
-            if i == 0:
-                self.imageAv = image
+        todo = np.arange(impaths.size)  # indices of the images to integrate
+        isCached = np.zeros(impaths.size, dtype=bool)
+        self.imageAv = None
+        nImageAv = 0  # number of images summed in self.imageAv
+        q = None
+        settingsHash = self.aiGeometry.getHash(
+            nqpt, qRange, maskImage,
+            extra=(useOperator, correctPhosphor, muphos, lphos, correctSample, musample, lsample,
+                   self.aiGeometry.operator.dtype.str if useOperator else None))
+
+        cache = None
+        if useCache:
+            cache = CurveCache(cacheDir, settingsHash)
+            imageKeys = cache.getImageKeys(impaths, cacheByContent)
+        checkpoint = None
+        if checkpointPath:
+            checkpoint = IntegrationCheckpoint(checkpointPath, impaths, settingsHash, checkpointEvery)
+
+        if resume and (checkpoint is not None) and Path(checkpointPath).is_file():
+            isDone, self.imageAv, nImageAv, q = checkpoint.load(self.total.s_raw[:, :impaths.size])
+            todo = np.where(~isDone)[0]
+            print('Resuming from', checkpointPath, ':', np.sum(isDone), 'of', impaths.size, 'images are done')
+        elif cache is not None:
+            isCached, q = cache.load(imageKeys, self.total.s_raw[:, :impaths.size])
+            todo = np.where(~isCached)[0]
+            print('Found', np.sum(isCached), 'of', impaths.size, 'curves in', cache.path)
+            if np.any(isCached):
+                self.imageAv = cache.loadImageSum(imageKeys[isCached])
+                if self.imageAv is None:
+                    print('Sum of the cached images is not in the cache; imageAv is obtained from the',
+                          todo.size, 'integrated images')
+                else:
+                    nImageAv = np.sum(isCached)
+            if checkpoint is not None:
+                checkpoint.start(np.where(isCached)[0], nImageAv)
+        elif checkpoint is not None:
+            checkpoint.start(np.array([], dtype=int), 0)
+
+        if todo.size > 0:
+            if workers:
+                q = self._integrateParallel(impaths, todo, workers, nqpt, qRange, maskImage,
+                                            prefetch, readerThreads, batchSize, checkpoint, memoryMap, archive)
             else:
-                self.imageAv += image
+                q = self._integrateSerial(impaths, todo, nqpt, qRange, maskImage,
+                                          prefetch, readerThreads, batchSize, checkpoint, memoryMap, archive)
+            nImageAv += todo.size
+        if archive is not None:
+            archive.close()
 
-            intTime = time.perf_counter() - startIntTime
-            print(i + 1, '|',
-                  row['file'], ':',
-                  'readout: %.0f' % (readTime * 1e3),
-                  'ms | integration: %.0f' % (intTime * 1e3),
-                  'ms | total: %.0f' % ((intTime + readTime) * 1e3), 'ms')
+        if cache is not None:
+            cache.save(imageKeys[~isCached], self.total.s_raw[:, :impaths.size][:, ~isCached], q)
+            if nImageAv == impaths.size:
+                cache.saveImageSum(imageKeys, self.imageAv)
 
-            if nFiles:
-                if (i + 1) >= nFiles:
-                    break
+        if checkpoint is not None:
+            checkpoint.remove()
 
         print('*** Integration done ***\n')
         self.q = q
         self.tth = 2 * np.arcsin(self.aiGeometry.wavelength * 1e10 * self.q / (4 * pi)) / pi * 180
 
-        Corrections = np.ones(q.shape)
-        if correctPhosphor:
-            Tphos = self._getPhosphorAbsorptionCorrection(muphos, lphos, self.tth / 180 * pi)
-            Corrections *= Tphos
-        if correctSample:
-            Tsample = self._getSampleAbsorptionCorrection(musample, lsample, self.tth / 180 * pi)
-            Corrections *= Tsample
-        #        print(Corrections)
-        #        self.total.s = self.total.s*Corrections[:, np.newaxis]
-        self.total.s_raw *= Corrections[:, np.newaxis]
+        if not useOperator:  # otherwise the corrections are already included in the operator
+            Corrections = self._getCorrections(self.tth / 180 * pi, correctPhosphor, muphos, lphos,
+                                               correctSample, musample, lsample)
+            #        self.total.s = self.total.s*Corrections[:, np.newaxis]
+            self.total.s_raw *= Corrections[:, np.newaxis]
 
         self.total.normInt, self.total.s = normalizeQ(q, self.total.s_raw, qNormRange)
-        self.imageAv = self.imageAv / (i + 1)
-        self.imageAv[maskImage == 1] = 0
+        if self.imageAv is not None:
+            self.imageAv = self.imageAv / nImageAv
+            self.imageAv[maskImage == 1] = 0
 
         weights = 1 / self.total.normInt
         weights /= np.median(weights)
-        self.total.covii = np.diag(weights)
+        self.total.covii = sparse.diags(weights, format='csr')  # diagonal, so O(nFiles) in memory
 
         if plotting:
             self.plotIntegrationResult()
 
+    def _integrateSerial(self, impaths, todo, nqpt, qRange, maskImage, prefetch=None, readerThreads=2,
+                         batchSize=None, checkpoint=None, memoryMap=True, archive=None):
+        '''Method for integrating the images impaths[todo] one by one (or stack by
+        stack) in the current process. The curves are written into the
+        corresponding columns of self.total.s_raw and the images are added to
+        self.imageAv (not yet divided by the number of images). The progress is
+        reported to the checkpoint (if given) once the curves are written.
+        Returns q.
+        '''
+        files = self._getImageNames()
+        readTimeTotal, intTimeTotal = 0, 0
+        stack = None
+        for j, (image, readTime) in enumerate(readImages(impaths[todo], prefetch, readerThreads, memoryMap,
+                                                                      archive)):
+            i = todo[j]
+            startIntTime = time.perf_counter()
+            if batchSize:
+                if stack is None:
+                    stack = self.aiGeometry.getStack(image, batchSize)
+                stack[j % batchSize] = image.ravel()
+                if (j % batchSize == batchSize - 1) or (j == todo.size - 1):
+                    k = j % batchSize + 1
+                    q, self.total.s_raw[:, todo[j - k + 1:j + 1]] = self.aiGeometry.integrateStack(stack[:k])
+                    written = todo[j - k + 1:j + 1]
+                else:
+                    written = None
+            else:
+                q, self.total.s_raw[:, i] = self.aiGeometry.integrate1d(image, nqpt, qRange, maskImage)
+                written = [i]
+
+            if self.imageAv is None:
+                self.imageAv = np.array(image)  # the image may be a view of the file
+            else:
+                self.imageAv += image
+
+            if (checkpoint is not None) and (written is not None):
+                checkpoint.add(written, self.total.s_raw, self.imageAv, q)
+
+            intTime = time.perf_counter() - startIntTime
+            readTimeTotal += readTime
+            intTimeTotal += intTime
+            print(i + 1, '|',
+                  files[i], ':',
+                  ('read stall: %.0f' if prefetch else 'readout: %.0f') % (readTime * 1e3),
+                  'ms | integration: %.0f' % (intTime * 1e3),
+                  'ms | total: %.0f' % ((intTime + readTime) * 1e3), 'ms')
+
+        print(('Read stall' if prefetch else 'Readout') + ': %.1f s |' % readTimeTotal,
+              'integration: %.1f s' % intTimeTotal)
+        return q
+
+    def _integrateParallel(self, impaths, todo, workers, nqpt, qRange, maskImage, prefetch=None, readerThreads=2,
+                           batchSize=None, checkpoint=None, memoryMap=True, archive=None):
+        '''Method for integrating the images impaths[todo] using a pool of worker
+        processes. The list is split into contiguous chunks. Each worker builds its
+        own integrator from self.aiGeometry and returns the curves for the chunk
+        together with the partial sum of the chunk images. The curves are written
+        directly into self.total.s_raw and the partial sums are reduced in the
+        chunk order and added to self.imageAv (not yet divided by the number of
+        images).
+        Returns q.
+        '''
+        nChunks = min(todo.size, workers * 4)  # several chunks per worker to balance the load
+        chunks = np.array_split(todo, nChunks)
+
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_initIntegrationWorker,
+                                 initargs=(self.aiGeometry, maskImage)) as executor:
+            futures = [executor.submit(_integrateChunk, impaths[idx], nqpt, qRange, prefetch, readerThreads,
+                                       batchSize, memoryMap, archive)
+                       for idx in chunks]
+            for k, (idx, future) in enumerate(zip(chunks, futures)):
+                q, self.total.s_raw[:, idx], imageSum, chunkTime, readTime = future.result()
+                if self.imageAv is None:
+                    self.imageAv = imageSum
+                else:
+                    self.imageAv += imageSum
+                if checkpoint is not None:
+                    checkpoint.add(idx, self.total.s_raw, self.imageAv, q)
+                print('chunk', k + 1, '/', nChunks, '|',
+                      'images %d-%d' % (idx[0] + 1, idx[-1] + 1), ':',
+                      'total: %.0f' % (chunkTime * 1e3),
+                      ('ms | read stall: %.0f' if prefetch else 'ms | readout: %.0f') % (readTime * 1e3),
+                      'ms | per image: %.0f' % (chunkTime / idx.size * 1e3), 'ms')
+        return q
+
+    def archiveImages(self, archivePath, compression='gzip', chunkFrames=1, prefetch=None, readerThreads=2):
+        ''' Method for packing the images of the data set into a single HDF5 file
+        (see ImageArchive), from which they can be integrated with
+        integrate(archivePath=...). The frames are stored in the order of
+        self.logData, and the archive keeps the scan and file name of each frame
+        and the log data. This is meant to be done once per run: repeated
+        reductions (new mask, geometry, etc) then read one large file instead
+        of many small ones.
+
+        You need:
+        archivePath - path to the .h5 file
+        compression - HDF5 compression filter ('gzip' or 'lzf', with byte
+        shuffling); if None, the images are stored uncompressed
+        chunkFrames - number of frames per chunk (1 keeps the access to single
+        frames cheap; larger chunks compress slightly better)
+        prefetch, readerThreads - reading of the image files (see integrate)
+        '''
+        assert isinstance(archivePath, str), 'provide the archive path as a string'
+        names = self._getImageNames()
+        impaths = self.logData['dataInDir'].to_numpy() + names
+        nFrames = impaths.size
+
+        print('*** Archiving', nFrames, 'images to', archivePath, '***')
+        startTime = time.perf_counter()
+        readTimeTotal, writeTimeTotal = 0, 0
+        with h5py.File(archivePath, 'w') as f:
+            f.create_dataset('scan', data=self.logData['Scan'].values.astype(str).astype(object),
+                             dtype=h5py.string_dtype())
+            f.create_dataset('file', data=names.astype(object), dtype=h5py.string_dtype())
+            images = None
+            for i, (image, readTime) in enumerate(readImages(impaths, prefetch, readerThreads)):
+                startWriteTime = time.perf_counter()
+                if images is None:
+                    images = f.create_dataset('images', shape=(nFrames,) + image.shape, dtype=image.dtype,
+                                              chunks=(min(chunkFrames, nFrames),) + image.shape,
+                                              compression=compression, shuffle=compression is not None)
+                images[i] = image
+                writeTime = time.perf_counter() - startWriteTime
+                readTimeTotal += readTime
+                writeTimeTotal += writeTime
+                print(i + 1, '|',
+                      names[i], ':',
+                      ('read stall: %.0f' if prefetch else 'readout: %.0f') % (readTime * 1e3),
+                      'ms | writing: %.0f' % (writeTime * 1e3), 'ms')
+        self.logData.to_hdf(archivePath, key='logData', mode='r+')  # pandas can write only after h5py closes
+
+        print(('Read stall' if prefetch else 'Readout') + ': %.1f s |' % readTimeTotal,
+              'writing: %.1f s |' % writeTimeTotal,
+              'archive size: %.1f MB' % (os.path.getsize(archivePath) / 2 ** 20))
+        print('*** Archiving done in %.1f s ***\n' % (time.perf_counter() - startTime))
+
     def _getaiGeometry(self, energy, distance, pixelSize, centerX, centerY, qRange, nqpt, qNormRange):
         '''Method for storing the geometry parameters in self.aiGeometry from
         the input to self.integrate() method.
@@ -425,34 +797,31 @@ class ScatData:
             time delays in numerical and string formats. This is done for
             the readability of the code in the main function.
         '''
-        timeStamp_str = self.logData['date time'].tolist()
-        timeStamp = []
-        for t in timeStamp_str:
-            timeStamp.append(datetime.strptime(t, '%d-%b-%y %H:%M:%S').timestamp())
-        timeStamp = np.array(timeStamp)
-        timeStamp_str = np.array(timeStamp_str)
+        timeStamp_str = np.array(self.logData['date time'].tolist())
+        timeStamp = timestamp_str2num_array(timeStamp_str)
         return timeStamp, timeStamp_str
 
     def plotIntegrationResult(self):
-        # get min and max of scale for average image
-        vmin, vmax = np.percentile(self.imageAv[self.imageAv != 0], (1, 99))
-
         plt.figure(figsize=(12, 5))
         plt.clf()
 
-        plt.subplot(131)
-        x, y = self.imageAv.shape
-        extent = [-self.aiGeometry.centerX,
-                  -self.aiGeometry.centerX + x,
-                  -self.aiGeometry.centerY + y,
-                  -self.aiGeometry.centerY]
-        plt.imshow(self.imageAv, vmin=vmin, vmax=vmax, extent=extent, cmap='Greys')
-        plt.vlines(0, extent[2], extent[3], colors='r')
-        plt.hlines(0, extent[0], extent[1], colors='r')
-        plt.xlim(extent[:2])
-        plt.ylim(extent[2:])
-        plt.colorbar()
-        plt.title('Average image')
+        if self.imageAv is not None:  # can be missing if the curves were taken from the cache
+            # get min and max of scale for average image
+            vmin, vmax = np.percentile(self.imageAv[self.imageAv != 0], (1, 99))
+
+            plt.subplot(131)
+            x, y = self.imageAv.shape
+            extent = [-self.aiGeometry.centerX,
+                      -self.aiGeometry.centerX + x,
+                      -self.aiGeometry.centerY + y,
+                      -self.aiGeometry.centerY]
+            plt.imshow(self.imageAv, vmin=vmin, vmax=vmax, extent=extent, cmap='Greys')
+            plt.vlines(0, extent[2], extent[3], colors='r')
+            plt.hlines(0, extent[0], extent[1], colors='r')
+            plt.xlim(extent[:2])
+            plt.ylim(extent[2:])
+            plt.colorbar()
+            plt.title('Average image')
 
         plt.subplot(132)
         plt.plot(self.q, self.total.s_raw)
@@ -468,6 +837,14 @@ class ScatData:
 
         plt.tight_layout()
 
+    def _getCorrections(self, tth, correctPhosphor, muphos, lphos, correctSample, musample, lsample):
+        Corrections = np.ones(tth.shape)
+        if correctPhosphor:
+            Corrections *= self._getPhosphorAbsorptionCorrection(muphos, lphos, tth)
+        if correctSample:
+            Corrections *= self._getSampleAbsorptionCorrection(musample, lsample, tth)
+        return Corrections
+
     def _getPhosphorAbsorptionCorrection(self, mu, l, tth):
         cv = np.cos(tth)  # cos value
         cph = mu * l  # coef phosphor
@@ -484,8 +861,8 @@ class ScatData:
     # 2. Total curve averaging
 
     def getTotalAverages(self, fraction=0.9, chisqThresh=5, q_break=None,
-                         dezinger=True, dezingerThresh=5, covShrinkage=0,
-                         plotting=True, chisqHistMax=10, y_offset=None):
+                         dezinger=True, dezingerThresh=5, covShrinkage=0, shrinkageSubsample=None,
+                         plotting=True, chisqHistMax=10, y_offset=None, workers=None):
         ''' Method calculates the total averages and gets rid of nasty outliers.
         It uses a chisq-based method for detecting outliers (see getAverage aux
         method).
@@ -509,19 +886,27 @@ class ScatData:
         useCovShrinkage - use regularized method for covariance estimation
         covShrinkage - amount of shrinkage; if None, will be determined
         automatically (slow)
+        shrinkageSubsample - number of randomly chosen curves used for the automatic
+        determination of covShrinkage; if None (default), all curves are used
+        (see covar.cov_shrink_ss and benchmarks/bench_cov_shrinkage.py)
 
         plotting - True if you want to see the results of the outlier rejection
         chisqHistMax - maximum value of chisq you want to plot histograms
         y_offset - amount of offset you want in the plot to show different time
         delays
+        workers - number of threads used for the outlier identification, which is
+        done for the delays concurrently. If None (default), the delays are
+        processed one by one.
         '''
         print('*** Averaging the total curves ***')
+        self.total.statistics = AverageStatistics()
         self.total.s_av, self.total.s_err, self.total.isOutlier, self.total.covtt, self.total.covqq, self.total.chisq = \
             getAverage(self.q, self.total.s, self.total.covii, self.total.isOutlier,
                        self.total.delay_str, self.t_str, None,
                        fraction, chisqThresh, q_break,
                        dezinger=dezinger, dezingerThresh=dezingerThresh, covShrinkage=covShrinkage,
-                       plotting=plotting, chisqHistMax=chisqHistMax, y_offset=y_offset)
+                       shrinkageSubsample=shrinkageSubsample, plotting=plotting, chisqHistMax=chisqHistMax, y_offset=y_offset, workers=workers,
+                       statistics=self.total.statistics)
         print('*** Done ***\n')
 
     # 3. Difference calculation
@@ -548,6 +933,8 @@ class ScatData:
 
         NB: the difference calculation ignores curves marked True in
         self.total.isOutlier
+        NB: every toff_str image of a scan can be a reference, including the
+        first image of the data (which was skipped in earlier versions)
 
         The method updates/adds following fields:
         self.diff.s - difference curves
@@ -575,59 +962,12 @@ class ScatData:
 
         assert toff_str in self.total.delay_str, 'toff_str is not found among recorded time delays'
         self.diff.toff_str = toff_str
+        self.diff.subtractFlag = subtractFlag
 
-        Adiff = sparse.eye(self.nFiles).tolil()
-
-        for i in range(self.nFiles):
-
-            idx_next = self._findOffIdx(i, 'Next')
-            idx_prev = self._findOffIdx(i, 'Prev')
-
-            if subtractFlag == 'Next':
-                if idx_next:
-                    Adiff[i, idx_next] = -1
-
-            elif subtractFlag == 'Previous':
-                if idx_prev:
-                    Adiff[i, idx_prev] = -1
-
-            elif subtractFlag == 'Closest':
-                if self.total.delay_str[i] == self.diff.toff_str:  # this is to avoid getting the same differences
-                    if idx_next:
-                        Adiff[i, idx_next] = -1
-                else:
-                    if (idx_next) and (idx_prev):
-                        timeToNext = np.abs(self.total.timeStamp[i] - self.total.timeStamp[idx_next])
-                        timeToPrev = np.abs(self.total.timeStamp[i] - self.total.timeStamp[idx_prev])
-                        if timeToNext <= timeToPrev:
-                            Adiff[i, idx_next] = -1
-                        else:
-                            Adiff[i, idx_prev] = -1
-                    elif (idx_next) and (not idx_prev):
-                        Adiff[i, idx_next] = -1
-                    elif (not idx_next) and (idx_prev):
-                        Adiff[i, idx_prev] = -1
-
-            elif subtractFlag == 'MovingAverage':
-                if (idx_next) and (idx_prev):
-                    timeToNext = np.abs(self.total.timeStamp[i] -
-                                        self.total.timeStamp[idx_next])
-                    timeToPrev = np.abs(self.total.timeStamp[i] -
-                                        self.total.timeStamp[idx_prev])
-                    timeDiff = np.abs(self.total.timeStamp[idx_next] -
-                                      self.total.timeStamp[idx_prev])
-                    Adiff[i, idx_next] = -timeToPrev / timeDiff
-                    Adiff[i, idx_prev] = -timeToNext / timeDiff
-
-                elif (idx_next) and (not idx_prev):
-                    Adiff[i, idx_next] = -1
-
-                elif (not idx_next) and (idx_prev):
-                    Adiff[i, idx_prev] = -1
-
+        Adiff = self._getAdiff(subtractFlag)
         self.diff.s = (Adiff @ self.total.s.T).T
         self.diff.ds = np.copy(self.diff.s)
-        self.diff.covii = Adiff @ self.total.covii @ Adiff.T
+        self.diff.covii = (Adiff @ sparse.csr_matrix(self.total.covii) @ Adiff.T).tocsr()  # banded
         self.Adiff = Adiff
         self.diff.isOutlier = np.ravel((np.sum(Adiff,
                                                axis=1) > 1e-6))  # argument of np.ravel is of matrix type which has ravel method working differently from np.ravel; we need np.ravel!
@@ -636,49 +976,200 @@ class ScatData:
             last_off = np.where((self.diff.delay_str == self.diff.toff_str) & ~self.diff.isOutlier)[0][-1]
             self.diff.isOutlier[last_off] = True
             a = self.diff.covii[last_off, last_off]
-            self.diff.covii[last_off, :] = 0
-            self.diff.covii[:, last_off] = 0
-            self.diff.covii[last_off, last_off] = a
+            keep = np.ones(self.nFiles)
+            keep[last_off] = 0
+            self.diff.covii = sparse.diags(keep) @ self.diff.covii @ sparse.diags(keep)  # zero row and column
+            self.diff.covii = (self.diff.covii + sparse.csr_matrix(([a], ([last_off], [last_off])),
+                                                                   shape=self.diff.covii.shape)).tocsr()
 
         print('*** Done ***\n')
 
-    def _findOffIdx(self, idx, direction):
-        idx_start = idx
-        while True:
-            if direction == 'Next':
-                idx += 1
-            elif direction == 'Prev':
-                idx -= 1
-            else:
-                raise ValueError('direction must be "Next" or "Prev"')
-            if (idx < 0) or idx > (self.nFiles - 1):
-                return None
-            if ((self.total.delay_str[idx] == self.diff.toff_str) and  # find next/prev reference
-                    (self.total.scanStamp[idx] == self.total.scanStamp[idx_start])):  # and # should be in the same scan
-                #                (not self.total.isOutlier[idx])): # should not be an outlier
-                return idx
+    def _getAdiff(self, subtractFlag):
+        '''Method for building the (sparse) difference operator Adiff such that
+        self.diff.s = (Adiff @ self.total.s.T).T according to subtractFlag (see
+        getDifferences). Rows of the images without a reference are left as in
+        the identity matrix.
+        '''
+        idx_prev, idx_next = self._getReferenceIdx()
+        hasPrev, hasNext = idx_prev >= 0, idx_next >= 0
+        isOff = self.total.delay_str == self.diff.toff_str
+        timeStamp = self.total.timeStamp
+        timeToNext = np.abs(timeStamp - timeStamp[idx_next])
+        timeToPrev = np.abs(timeStamp - timeStamp[idx_prev])
+
+        if subtractFlag == 'Next':
+            useNext, usePrev = hasNext, np.zeros(self.nFiles, dtype=bool)
+        elif subtractFlag == 'Previous':
+            useNext, usePrev = np.zeros(self.nFiles, dtype=bool), hasPrev
+        elif subtractFlag == 'Closest':
+            # the reference images use the next one to avoid getting the same differences
+            useNext = hasNext & (isOff | ~hasPrev | (timeToNext <= timeToPrev))
+            usePrev = hasPrev & ~isOff & ~useNext
+        elif subtractFlag == 'MovingAverage':
+            useNext, usePrev = hasNext, hasPrev
+        else:
+            raise ValueError('subtractFlag must be "MovingAverage", "Closest", "Previous" or "Next"')
+
+        weightNext = -np.ones(self.nFiles)
+        weightPrev = -np.ones(self.nFiles)
+        both = useNext & usePrev  # only for MovingAverage
+        timeDiff = np.abs(timeStamp[idx_next[both]] - timeStamp[idx_prev[both]])
+        weightNext[both] = -timeToPrev[both] / timeDiff
+        weightPrev[both] = -timeToNext[both] / timeDiff
+
+        idx = np.arange(self.nFiles)
+        rows = np.hstack((idx, idx[useNext], idx[usePrev]))
+        cols = np.hstack((idx, idx_next[useNext], idx_prev[usePrev]))
+        data = np.hstack((np.ones(self.nFiles), weightNext[useNext], weightPrev[usePrev]))
+        return sparse.csr_matrix((data, (rows, cols)), shape=(self.nFiles, self.nFiles))
+
+    def _getReferenceIdx(self):
+        '''Method for finding the previous and the next reference (toff_str) image
+        within the same scan for every image. Returns two arrays of indices,
+        -1 means that there is no such image.
+        '''
+        idx_prev = np.full(self.nFiles, -1)
+        idx_next = np.full(self.nFiles, -1)
+        isOff = self.total.delay_str == self.diff.toff_str
+        for scan in np.unique(self.total.scanStamp):
+            idx = np.where(self.total.scanStamp == scan)[0]
+            idx_off = idx[isOff[idx]]
+            if idx_off.size == 0:
+                continue
+            k = np.searchsorted(idx_off, idx, side='left') - 1  # last reference before the image
+            idx_prev[idx[k >= 0]] = idx_off[k[k >= 0]]
+            k = np.searchsorted(idx_off, idx, side='right')  # first reference after the image
+            idx_next[idx[k < idx_off.size]] = idx_off[k[k < idx_off.size]]
+        return idx_prev, idx_next
 
     # 4. Difference averaging
 
     def getDiffAverages(self, fraction=0.9, chisqThresh=1.5, q_break=None,
-                        dezinger=True, dezingerThresh=5, covShrinkage=None,
-                        plotting=True, chisqHistMax=10, y_offset=None):
+                        dezinger=True, dezingerThresh=5, covShrinkage=None, shrinkageSubsample=None,
+                        plotting=True, chisqHistMax=10, y_offset=None, workers=None):
         ''' Method to get average differences. It works in the same way as
         getTotalAverages, so refer to the information on input/output in the
         getTotalAverages docstring.
         '''
         print('*** Averaging the difference curves ***')
-
+        self.diff.statistics = AverageStatistics()
         (self.diff.s_av, self.diff.s_err, self.diff.isOutlier,
          self.diff.covtt, self.diff.covqq, self.diff.chisq) = \
             getAverage(self.q, self.diff.s, self.diff.covii,
                        self.diff.isOutlier, self.diff.delay_str, self.t_str, self.diff.toff_str,
                        fraction, chisqThresh, q_break,
                        dezinger=dezinger, dezingerThresh=dezingerThresh, covShrinkage=covShrinkage,
-                       plotting=plotting, chisqHistMax=chisqHistMax, y_offset=y_offset)
+                       shrinkageSubsample=shrinkageSubsample, plotting=plotting, chisqHistMax=chisqHistMax, y_offset=y_offset, workers=workers,
+                       statistics=self.diff.statistics)
+        self.diff.ds_av = np.copy(self.diff.s_av)
+        print('*** Done ***\n')
+
+    # 4a. Adding scans
+
+    def appendScan(self, logFile, dataInDir=None, plotting=False):
+        ''' Method for adding a new scan (log file) to the data which was already
+        processed with integrate, getTotalAverages, getDifferences and
+        getDiffAverages. The new images are integrated and subtracted with the
+        same settings, and the averages are updated from the sufficient
+        statistics stored by getTotalAverages/getDiffAverages (see
+        AverageStatistics), so the time needed does not depend on the number of
+        curves already in the data.
+
+        The new curves are compared with the per-delay references (trimmed
+        averages and deviations) obtained at the last full averaging, and the
+        outlier flags of the old curves are kept. To reconsider all the
+        outliers, call getTotalAverages/getDifferences/getDiffAverages again.
+        If covShrinkage was determined automatically, the value found at the
+        last full averaging is used.
+
+        You need:
+        logFile - name of the log file of the new scan (string)
+        dataInDir - directory with the images of the new scan (string)
+        plotting - whether you want to plot the integration result of the scan
+
+        NB: the new scan should not contain delays absent from self.t_str. The
+        last reference curve of the scan is treated as in getDifferences (with
+        'MovingAverage' it is marked as an outlier).
+        '''
+        assert hasattr(self, 'integrationSettings'), 'integrate the data first'
+        assert (getattr(self.total, 'statistics', None) is not None and
+                getattr(self.diff, 'statistics', None) is not None), \
+            'run getTotalAverages, getDifferences and getDiffAverages first'
+
+        print('*** Adding scan', logFile, '***')
+        new = ScatData(logFile, logFileStyle=self.logFileStyle, ignoreFirst=self.ignoreFirst,
+                       nFirstFiles=self.nFirstFiles, dataInDir=dataInDir)
+        assert np.all(np.isin(new.t_str, self.t_str)), \
+            'the new scan has time delays which are not in the data, use the full reduction'
+        new.aiGeometry = self.aiGeometry
+        # the images of the new scan are read from the files, not from the image archive
+        settings = dict(self.integrationSettings, qNormRange=self.aiGeometry.qNormRange, archivePath=None)
+        new.integrate(plotting=plotting, **settings)
+        new.getDifferences(self.diff.toff_str, self.diff.subtractFlag)
+
+        nOld = self.nFiles
+        weightScaleOld = np.median(1 / self.total.normInt)  # covii = diag(1/normInt) / weightScale
+        weightScaleNew = np.median(1 / new.total.normInt)
+        self._appendData(new)
+        weightScale = np.median(1 / self.total.normInt)
+        self.total.covii = sparse.diags(1 / self.total.normInt / weightScale, format='csr')
+        self.diff.covii = sparse.block_diag((self.diff.covii * (weightScaleOld / weightScale),
+                                             new.diff.covii * (weightScaleNew / weightScale)), format='csr')
+
+        for container, name in ((self.total, 'total'), (self.diff, 'difference')):
+            print('*** Updating the', name, 'averages ***')
+            statistics = container.statistics
+            statistics.rescale(weightScale / weightScaleOld)
+            settings = statistics.settings
+            idx = np.arange(nOld, self.nFiles)
+            delay_str = container.delay_str[idx]
+            x = container.s[:, idx].copy()
+            isOutlier, chisq, _ = identifyOutliers_all(
+                self.q, x, delay_str, self.t_str, container.isOutlier[idx], settings['fraction'],
+                settings['chisqThresh'], settings['q_break'], settings['dezinger'], settings['dezingerThresh'],
+                references=statistics.references)
+            container.isOutlier[idx] = isOutlier
+            container.chisq = np.hstack((container.chisq, chisq))
+            covii = container.covii[nOld:, nOld:]
+            statistics.add(x, covii, getDelayIdx(delay_str, self.t_str),
+                           ~isOutlier & (delay_str != settings['toff_str']))
+            container.s_av, container.s_err, container.covtt, container.covqq = statistics.getAverage()
         self.diff.ds_av = np.copy(self.diff.s_av)
         print('*** Done ***\n')
 
+    def _appendData(self, new):
+        '''Method for concatenating the log data, integrated curves and differences
+        of the ScatData object new (one scan, see appendScan, or a part of the
+        merged data, see mergeScatData) to the data.
+        '''
+        nOld = self.nFiles
+        self.logFile = list(np.atleast_1d(self.logFile)) + list(np.atleast_1d(new.logFile))
+        self.dataInDir = list(np.atleast_1d(self.dataInDir)) + list(np.atleast_1d(new.dataInDir))
+        if (getattr(self, 'logData', None) is not None) and (getattr(new, 'logData', None) is not None):
+            self.logData = pd.concat((self.logData, new.logData), ignore_index=True)
+        else:
+            self.logData = None
+        self.nFiles = nOld + new.nFiles
+        if (self.imageAv is not None) and (new.imageAv is not None) and (self.imageAv.shape == new.imageAv.shape):
+            self.imageAv = (np.asarray(self.imageAv) * nOld + np.asarray(new.imageAv) * new.nFiles) / self.nFiles
+        else:
+            self.imageAv = None
+
+        for key in ('s_raw', 's'):
+            self.total.__setattr__(key, np.hstack((self.total.__getattribute__(key),
+                                                   new.total.__getattribute__(key))))
+        for key in ('normInt', 'delay', 'delay_str', 'timeStamp', 'timeStamp_str', 'scanStamp', 'isOutlier'):
+            self.total.__setattr__(key, np.hstack((self.total.__getattribute__(key),
+                                                   new.total.__getattribute__(key))))
+        if new.diff.s is None:
+            return
+        self.diff.s = np.hstack((self.diff.s, new.diff.s))
+        self.diff.ds = np.copy(self.diff.s)
+        for key in ('delay', 'delay_str', 'timeStamp', 'timeStamp_str', 'scanStamp', 'isOutlier'):
+            self.diff.__setattr__(key, np.hstack((self.diff.__getattribute__(key),
+                                                  new.diff.__getattribute__(key))))
+        self.Adiff = sparse.block_diag((self.Adiff, new.Adiff), format='csr')
+
     def plotDiffAverages(self, fig=None, y_offset=None, x_txt=None, y_txt=None, qpower=0):
         if fig is None:
             plt.figure()
@@ -688,7 +1179,17 @@ class ScatData:
 
     # 5. Saving
 
-    def save(self, savePath=None):
+    def save(self, savePath=None, compression='gzip'):
+        ''' Method for saving the data to an HDF5 file. Large arrays are stored in
+        chunks (curves in q x image tiles, covariances and images in tiles) and
+        compressed, so that parts of them can be read without reading the whole
+        array (see _save_dataset).
+
+        You need:
+        savePath - path to the .h5 file
+        compression - HDF5 compression filter ('gzip' or 'lzf'); if None, the
+        arrays are stored contiguous and uncompressed
+        '''
 
         assert isinstance(savePath, str), \
             'provide data output directory as a string'
@@ -696,15 +1197,24 @@ class ScatData:
         print('*** Saving ***')
         f = h5py.File(savePath, 'w')
 
-        self._save_group(savePath, f, self.__dict__)
-        self._save_group(savePath, f, self.aiGeometry.__dict__, indent='\t', group='aiGeometry')
-        self._save_group(savePath, f, self.total.__dict__, indent='\t', group='total')
-        self._save_group(savePath, f, self.diff.__dict__, indent='\t', group='diff')
+        self._save_group(savePath, f, self.__dict__, compression=compression)
+        self._save_group(savePath, f, self.aiGeometry.__dict__, indent='\t', group='aiGeometry',
+                         compression=compression)
+        self._save_group(savePath, f, self.total.__dict__, indent='\t', group='total', compression=compression)
+        self._save_group(savePath, f, self.diff.__dict__, indent='\t', group='diff', compression=compression)
 
         f.close()
+
+        if getattr(self, 'logData', None) is not None:  # pandas can write only after h5py closes the file
+            print(' logData', '\t', end=' ')
+            try:
+                self.logData.to_hdf(savePath, key='logData', mode='r+')
+                print('success')
+            except Exception as e:  # e.g. PyTables is not installed
+                print('failed (%s)' % e)
         print('*** Saving finished ***')
 
-    def _save_group(self, savepath, f, dict, indent='', group=None):
+    def _save_group(self, savepath, f, dict, indent='', group=None, compression='gzip'):
         if group:
             print('Saving the following group:', group)
             fpath = group + '/'
@@ -716,33 +1226,56 @@ class ScatData:
             if (dict[key] is None
                     or (type(dict[key]) == IntensityContainer)
                     or (type(dict[key]) == AIGeometry)
+                    or (type(dict[key]) == AverageStatistics)
+                    or (type(dict[key]) == h5py.File)
+                    or (type(dict[key]) == pd.core.frame.DataFrame)
+                    or (key == 'integrationSettings')
                     or (key == 'ai')
+                    or (key == 'operator')
+                    or (key == 'operatorQ')
                     or (key == 'Adiff')):
                 continue
 
             print(indent, key, '\t', end=' ')
 
-            if type(dict[key]) == pd.core.frame.DataFrame:
-                try:
-                    dict[key].to_hdf(savepath, key='logData', mode='r+')
+            try:
+                if sparse.issparse(dict[key]):  # stored as a group with the CSR arrays
+                    _save_sparse(f, fpath + key, dict[key])
                     print('success')
-                except:
-                    'failed'
-            else:
-                try:
-                    if ((type(dict[key]) == list)
-                            or ((type(dict[key]) == np.ndarray) and (
-                                    (type(dict[key][0]) == str) or (type(dict[key][0]) == np.str_)))):
-                        data = '|'.join(dict[key])
-                    else:
-                        data = dict[key]
-                    f.create_dataset(fpath + key, data=data)
+                    continue
+                if ((type(dict[key]) == list)
+                        or ((type(dict[key]) == np.ndarray) and (
+                                (type(dict[key][0]) == str) or (type(dict[key][0]) == np.str_)))):
+                    data = '|'.join(dict[key])
+                else:
+                    data = dict[key]
+                _save_dataset(f, fpath + key, data, compression=compression)
 
-                    print('success')
-                except:
-                    print('failed')
+                print('success')
+            except:
+                print('failed')
+
+    def initializeFromH5(self, loadPath, smallLoad, lazy=False, delays=None, scans=None, qRange=None):
+        ''' Method for loading the data saved with the save method.
 
-    def initializeFromH5(self, loadPath, smallLoad):
+        You need:
+        loadPath - path to the .h5 file
+        smallLoad - if True, covii, imageAv and logData are not loaded
+        lazy - if True, the curves and imageAv are read only when sliced (see
+        LazyArray)
+
+        To load only a part of the data:
+        delays - list of delays (strings from t_str) to load
+        scans - list of scans (log file names without extension, as in
+        total.scanStamp) to load
+        qRange - [qmin, qmax] of the q region to load
+        Only the corresponding hyperslabs of the curves, averages and
+        covariances are read from the file. The per-image arrays, covii and
+        logData are reduced to the images of the selected delays and scans, and
+        t, t_str, covtt, etc to the selected delays. Note that the averages
+        (s_av, covqq, etc) are those calculated from the full data; imageAv is
+        loaded as is.
+        '''
 
         assert isinstance(loadPath, str), \
             'Provide data output directory as a string'
@@ -750,7 +1283,11 @@ class ScatData:
             'The file has not been found'
 
         print('*** Loading ***')
-        f = h5py.File(loadPath, 'r')
+        f = h5py.File(loadPath, 'r', rdcc_nbytes=2 ** 26)
+
+        selection = None
+        if (delays is not None) or (scans is not None) or (qRange is not None):
+            selection = self._getH5Selection(f, delays, scans, qRange)
 
         for key in f.keys():
 
@@ -758,13 +1295,11 @@ class ScatData:
                 print(f'{key} skipped to conserve memory')
                 continue
 
-            # print(type(f[key].value))  #################################
-
             if type(f[key]) == h5py.Dataset:
-                if type(f[key].value) == str:
-                    data_to_load = np.array(f[key].value.split('|'))
+                if (selection is not None) and (key in subset_axes):
+                    data_to_load = _load_subset(f[key], subset_axes[key], selection)
                 else:
-                    data_to_load = f[key].value
+                    data_to_load = _load_dataset(f[key], lazy and (key in lazy_fields))
                 self.__setattr__(key, data_to_load)
                 print(key, 'success')
 
@@ -781,25 +1316,77 @@ class ScatData:
                         print('\t', f'{subkey} skipped to conserve memory')
                         continue
 
-                    # print(type(f[key][subkey]))  #################################
-                    if type(f[key][subkey].value) == str:
-                        data_to_load = np.array(f[key][subkey].value.split('|'))
+                    if type(f[key][subkey]) == h5py.Group:  # sparse matrix (see _save_sparse)
+                        data_to_load = _load_sparse(f[key][subkey])
+                        if (selection is not None) and (subkey in subset_axes):
+                            data_to_load = _load_subset(data_to_load, subset_axes[subkey], selection)
+                    elif (selection is not None) and (subkey in subset_axes):
+                        data_to_load = _load_subset(f[key][subkey], subset_axes[subkey], selection)
                     else:
-                        data_to_load = f[key][subkey].value
+                        data_to_load = _load_dataset(f[key][subkey], lazy and (subkey in lazy_fields))
                     self.__getattribute__(key).__setattr__(subkey, data_to_load)
                     print('\t', subkey, 'success')
 
             elif (key == 'logData'):
-                self.logData = pd.read_hdf(loadPath, key=key)
+                try:
+                    self.logData = pd.read_hdf(loadPath, key=key)
+                except ImportError as e:  # PyTables is not installed
+                    print(key, 'failed (%s)' % e)
+                    continue
+                if selection is not None:
+                    self.logData = self.logData.iloc[selection['image']]
                 print(key, 'success')
 
-        f.close()
+        if selection is not None:
+            self.nFiles = selection['nFiles']
+            self.nDelays = selection['nDelays']
+
+        if lazy:
+            self._h5File = f  # the lazy arrays read from the file, so it is kept open
+        else:
+            f.close()
 
         if hasattr(self, 'aiGeometry'):
             self.aiGeometry.getai()
 
         print('*** Loading finished ***')
 
+    def _getH5Selection(self, f, delays, scans, qRange):
+        ''' Finds the indices of q points, delays and images to load from the
+        file f for initializeFromH5. Contiguous indices are converted to slices,
+        so that they are read as hyperslabs.
+        '''
+        q = f['q'][()]
+        t_str = _load_dataset(f['t_str'])
+        delay_str = _load_dataset(f['total/delay_str'])
+
+        if qRange is None:
+            qSel = np.ones(q.size, dtype=bool)
+        else:
+            qSel = (q >= qRange[0]) & (q <= qRange[1])
+            assert np.any(qSel), 'no q points in the qRange'
+
+        if delays is None:
+            tSel = np.ones(t_str.size, dtype=bool)
+        else:
+            delays = np.atleast_1d(delays)
+            assert np.all(np.isin(delays, t_str)), 'some of the delays are not in t_str'
+            tSel = np.isin(t_str, delays)
+
+        imageSel = np.isin(delay_str, t_str[tSel])
+        if scans is not None:
+            scans = np.atleast_1d(scans)
+            scanStamp = _load_dataset(f['total/scanStamp'])
+            assert np.all(np.isin(scans, scanStamp)), 'some of the scans are not in the data'
+            imageSel &= np.isin(scanStamp, scans)
+        if not np.any(imageSel):
+            raise ValueError('no images with the delays %s in the scans %s' %
+                             ('all' if delays is None else list(delays), 'all' if scans is None else list(scans)))
+
+        print('Loading', np.sum(qSel), 'q points,', np.sum(tSel), 'delays and', np.sum(imageSel), 'images')
+        return {'q': _indexToSlice(np.where(qSel)[0]), 't': _indexToSlice(np.where(tSel)[0]),
+                'image': _indexToSlice(np.where(imageSel)[0]), 'nFiles': np.sum(imageSel), 'nDelays': np.sum(tSel)}
+
     def initializeEmpty(self):
         self.q = None
         self.tth = None
@@ -830,6 +1417,8 @@ class AIGeometry:
         self.qRange = np.array(qRange)
         self.nqpt = nqpt
         self.qNormRange = np.array(qNormRange)
+        self.operator = None
+        self.operatorQ = None
         # self.ai = self.getai()
 
     def getai(self):
@@ -842,6 +1431,118 @@ class AIGeometry:
             rot1=0, rot2=0, rot3=0,
             wavelength=self.wavelength)
 
+    def getOperator(self, shape, nqpt, qRange, maskImage=None, operatorDir=None, dtype=np.float64):
+        ''' Method for getting the sparse operator (CSR matrix of nqpt x number of
+        pixels) that maps a flattened image onto the integrated curve:
+            s_raw = self.operator @ image.ravel()
+        The operator reproduces pyFAI integrate1d (bbox splitting) with the mask,
+        solid angle and polarization corrections folded in. It is stored in
+        operatorDir under the hash of the geometry and the mask, and is loaded
+        from there if it was built before. dtype is the type of the operator
+        elements; np.float32 halves the memory traffic of the integration at the
+        cost of the precision (~1e-7 relative).
+
+        Updates self.operator and self.operatorQ (q values of the bins).
+        '''
+        if operatorDir is None:
+            operatorDir = caches.default_cache_dir / 'operators'
+        operatorHash = self.getHash(nqpt, qRange, maskImage, extra=(tuple(shape), np.dtype(dtype).str))
+        operatorPath = Path(operatorDir) / ('operator_' + operatorHash + '.npz')
+
+        if operatorPath.is_file():
+            print('Loading integration operator from', operatorPath)
+            with np.load(operatorPath) as f:
+                self.operator = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=f['shape'])
+                self.operatorQ = f['q']
+            return
+
+        print('Building integration operator ... ', end='')
+        startTime = time.perf_counter()
+        if not hasattr(self, 'ai'):
+            self.getai()
+        unit = pyFAI.units.to_unit('q_A^-1')
+        engine = self.ai.setup_sparse_integrator(shape, nqpt, mask=maskImage, pos0_range=qRange, unit=unit,
+                                                 split='bbox', algo='CSR', scale=True)
+        data, indices, indptr = engine.lut
+        operator = sparse.csr_matrix((data, indices, indptr), shape=(nqpt, np.prod(shape)))
+        norm = operator @ (self.ai.solidAngleArray(shape) * self.ai.polarization(shape, factor=1)).ravel()
+        normInv = np.zeros(nqpt)
+        normInv[norm > 0] = 1 / norm[norm > 0]  # empty bins are set to zero as in pyFAI
+        self.operator = (sparse.diags(normInv) @ operator).tocsr().astype(dtype)
+        self.operatorQ = np.asarray(engine.bin_centers) * unit.scale
+        print('done ( %3.f' % ((time.perf_counter() - startTime) * 1000), 'ms )')
+
+        operatorPath.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(operatorPath, data=self.operator.data, indices=self.operator.indices, indptr=self.operator.indptr,
+                 shape=self.operator.shape, q=self.operatorQ)
+
+    def getHash(self, nqpt, qRange, maskImage=None, extra=()):
+        ''' Method for getting a hash of the geometry, integration range, mask and
+        any extra parameters, used as a key for the data stored on disk.
+        '''
+        key = repr((self.wavelength, self.distance, self.pixelSize, self.centerX, self.centerY,
+                    [float(i) for i in qRange], int(nqpt), tuple(extra), pyFAI.version))
+        h = hashlib.sha1(key.encode())
+        if maskImage is not None:
+            h.update(np.ascontiguousarray(maskImage != 0).tobytes())
+        return h.hexdigest()
+
+    def scaleOperator(self, factors):
+        ''' Method for folding per-q factors (e.g. absorption corrections) into
+        the operator.
+        '''
+        self.operator = (sparse.diags(factors.astype(self.operator.dtype)) @ self.operator).tocsr()
+        self.operator.sort_indices()  # the pixels are summed in the same order as in integrateStack
+
+    def integrate1d(self, image, nqpt, qRange, maskImage=None):
+        ''' Method for integrating a single image. Uses the sparse operator if it
+        is available (see getOperator) and pyFAI otherwise.
+        Returns q and the integrated curve.
+        '''
+        if getattr(self, 'operator', None) is not None:
+            return self.operatorQ, self.operator @ image.ravel()
+        return self.ai.integrate1d(image,
+                                   nqpt,
+                                   radial_range=qRange,
+                                   correctSolidAngle=True,
+                                   polarization_factor=1,
+                                   mask=maskImage,
+                                   unit="q_A^-1")
+
+    def getStack(self, image, batchSize):
+        ''' Method for allocating a stack for batchSize images like the given one.
+        The images are put in the stack as rows (stack[k] = image.ravel()), which
+        is the only copy of the image made for the integration. The stack has the
+        dtype of the product with the operator.
+        '''
+        return np.empty((batchSize, image.size), dtype=np.result_type(self.operator.dtype, image.dtype))
+
+    def integrateStack(self, stack):
+        ''' Method for integrating a stack of K flattened images (K x pixels, see
+        getStack) in one pass over the operator: the operator is traversed pixel
+        by pixel (as its transpose, kept with the operator) and every element is
+        applied to the images (see _integrateStack), so the stack is used as it
+        is. Without numba, the stack is integrated as a sparse matrix product
+        with scipy.
+        Returns q and the curves (nqpt x K).
+        '''
+        if getattr(self, '_operatorT', (None,))[0] is not self.operator:
+            self._operatorT = (self.operator, self.operator.T.tocsr())
+        operatorT = self._operatorT[1]
+        s = np.zeros((self.operator.shape[0], stack.shape[0]), dtype=stack.dtype)
+        try:
+            _integrateStack(operatorT.indptr, operatorT.indices, operatorT.data, stack, s)
+        except ImportError:  # numba is not installed
+            s = self.operator @ stack.T
+        return self.operatorQ, s
+
+    def __getstate__(self):
+        # the integrator is not sent to worker processes; they call getai() themselves
+        state = self.__dict__.copy()
+        state.pop('ai', None)
+        state.pop('_operatorT', None)
+        return state
+
 
 class IntensityContainer:
     def __init__(self, s_raw=None, s=None, s_av=None, s_err=None,
@@ -884,6 +1585,168 @@ class IntensityContainer:
         if self.covqq is not None: self.covqq *= scale ** 2
 
 
+class LazyArray(np.lib.mixins.NDArrayOperatorsMixin):
+    ''' Array stored in an HDF5 file (see ScatData.initializeFromH5 with
+    lazy=True). The data is read from the file only when the array is sliced
+    (x[:, 10:20], x[q_idx, :], etc) or converted with np.asarray. Multiplication
+    by a number (x *= scale) is applied on reading, the file is not modified.
+    Arithmetic and numpy functions (x + y, x * 2, np.sqrt(x), ...) read the whole
+    array and return numpy arrays.
+    '''
+
+    def __init__(self, dataset, scale=1):
+        self.dataset = dataset
+        self.scale = scale
+        self.shape = dataset.shape
+        self.ndim = dataset.ndim
+        self.size = dataset.size
+        self.dtype = dataset.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        try:
+            data = self.dataset[idx]
+        except (TypeError, ValueError, IndexError):
+            data = self._readFancy(idx)
+        return data * self.scale if self.scale != 1 else data
+
+    def _readFancy(self, idx):
+        # h5py allows only one increasing index array per selection; for the other
+        # cases the bounding hyperslab is read and indexed in memory
+        if not isinstance(idx, tuple):
+            idx = (idx,)
+        slab, local = [], []
+        for i in idx:
+            if isinstance(i, (slice, int, np.integer)):
+                slab.append(i)
+                if isinstance(i, slice):
+                    local.append(slice(None))
+            else:
+                i = np.asarray(i)
+                if i.dtype == bool:
+                    i = np.nonzero(i)[0]
+                lo, hi = (i.min(), i.max() + 1) if i.size > 0 else (0, 0)
+                slab.append(slice(lo, hi))
+                local.append(i - lo)
+        return self.dataset[tuple(slab)][tuple(local)]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        return data if dtype is None else data.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if any(isinstance(x, LazyArray) for x in kwargs.get('out', ())):
+            return NotImplemented
+        inputs = tuple(np.asarray(x) if isinstance(x, LazyArray) else x for x in inputs)
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def __imul__(self, factor):
+        self.scale = self.scale * factor
+        return self
+
+    @property
+    def T(self):
+        return np.asarray(self).T
+
+    def copy(self):
+        return np.asarray(self)
+
+    def load(self):
+        ''' Reads the whole array from the file.
+        '''
+        return np.asarray(self)
+
+
+class AverageStatistics:
+    ''' Per-delay sufficient statistics of the weighted averages calculated by
+    getAverage. They allow to add new curves to the averages (see
+    ScatData.appendScan) in time proportional to the number of new curves.
+
+    With the weights w = 1 / diag(covii), for every delay k:
+        W[k] - sum of w over the curves of the delay
+        A[:, k] - sum of w * x over the curves of the delay
+        C[k, l] - sum of w_i * covii_ij * w_j over the curves i of delay k and j
+        of delay l (gives covtt)
+    and over the curves used for covqq (not outliers, not toff_str):
+        n[k] - number of curves
+        b[k] - sum of w
+        a[:, k] - sum of w * (x - shift[:, k])
+    and, summed over all these curves (only the sum enters covqq),
+        M - sum of w * (x - shift[:, k]) (x - shift[:, k])^T
+    The shift is the average at the time of the full averaging; it keeps the
+    sums of squares numerically stable.
+
+    The settings of the averaging and the per-delay references used for the
+    outlier identification are also stored.
+    '''
+
+    def __init__(self):
+        self.settings = None
+        self.references = None
+
+    def start(self, t_str, shift):
+        self.t_str = t_str
+        nqpt, nt = shift.shape
+        self.shift = shift.copy()
+        self.W = np.zeros(nt)
+        self.A = np.zeros((nqpt, nt))
+        self.C = np.zeros((nt, nt))
+        self.n = np.zeros(nt, dtype=int)
+        self.b = np.zeros(nt)
+        self.a = np.zeros((nqpt, nt))
+        self.M = np.zeros((nqpt, nqpt))
+
+    def add(self, x, covii, delayIdx, isUsed):
+        ''' Adds the curves x (axis=0 in q space) with the covariance covii, delay
+        indices delayIdx (see getDelayIdx) and flags isUsed marking the curves
+        used for covqq.
+        '''
+        w = 1 / covii.diagonal()
+        isDelay = delayIdx >= 0
+        G = sparse.csr_matrix((w[isDelay], (delayIdx[isDelay], np.where(isDelay)[0])),
+                              shape=(self.W.size, delayIdx.size))  # weighted grouping
+        self.W += np.bincount(delayIdx[isDelay], w[isDelay], minlength=self.W.size)
+        self.A += np.asarray(G @ x.T).T
+        C = G @ covii @ G.T
+        self.C += C.toarray() if sparse.issparse(C) else np.asarray(C)
+
+        isUsed = isUsed & isDelay
+        for k in np.unique(delayIdx[isUsed]):
+            sel = isUsed & (delayIdx == k)
+            sqrt_w = np.sqrt(w[sel])
+            y = (x[:, sel] - self.shift[:, k, None]) * sqrt_w
+            self.M += y @ y.T
+            self.a[:, k] += y @ sqrt_w
+            self.b[k] += np.sum(w[sel])
+            self.n[k] += np.sum(sel)
+
+    def rescale(self, factor):
+        ''' Accounts for all the weights being multiplied by factor (covii divided
+        by factor).
+        '''
+        for key in ('W', 'A', 'C', 'b', 'a', 'M'):
+            self.__setattr__(key, self.__getattribute__(key) * factor)
+
+    def getAverage(self):
+        ''' Returns x_av, x_err, covtt and covqq in the same way as getAverage.
+        '''
+        WInv = np.zeros(self.W.size)
+        isValid = self.W > 1e-15 * self.W.max()  # the default rcond of np.linalg.pinv
+        WInv[isValid] = 1 / self.W[isValid]
+        x_av = self.A * WInv
+        covtt = self.C * WInv[:, None] * WInv[None, :]
+
+        d = x_av - self.shift
+        dxdxt = (self.M - (d @ self.a.T) - (self.a @ d.T) + (d * self.b) @ d.T)
+        dxdxt_diag = np.diag(np.diag(dxdxt))
+        covShrinkage = self.settings['covShrinkage']
+        covqq = (dxdxt * (1 - covShrinkage) + dxdxt_diag * covShrinkage) / (np.sum(self.n) - self.t_str.size)
+        x_err = np.sqrt(np.diag(covqq)[:, None] * np.diag(covtt)[None, :])
+        return x_av, x_err, covtt, covqq
+
+
 # %% Auxillary functions
 # This functions are put outside of the class as they can be used in broader
 # contexts and such implementation simplifies access to them.
@@ -915,6 +1778,179 @@ def medianDezinger1d(x_orig, fraction=0.9, kernel_size=5, thresh=5):
     return x
 
 
+# state of a worker process used for parallel integration (see ScatData.integrate)
+_workerState = {}
+
+
+def _initIntegrationWorker(aiGeometry, maskImage):
+    ''' Initializer of the integration worker processes: builds the integrator
+    once per process.
+    '''
+    aiGeometry.getai()
+    _workerState['aiGeometry'] = aiGeometry
+    _workerState['maskImage'] = maskImage
+
+
+def _integrateChunk(impaths, nqpt, qRange, prefetch=None, readerThreads=2, batchSize=None, memoryMap=True,
+                    archive=None):
+    ''' Function integrating a chunk of images in a worker process.
+
+    Output:
+        q - transferred momentum
+        s_raw - integrated curves (nqpt x number of images)
+        imageSum - sum of the images in the chunk
+        chunkTime - time spent on the chunk (in s)
+        readTimeTotal - time spent on reading (or waiting for) the images (in s)
+    '''
+    startTime = time.perf_counter()
+    aiGeometry = _workerState['aiGeometry']
+    s_raw = np.zeros([nqpt, len(impaths)])
+    readTimeTotal = 0
+    stack = None
+    for j, (image, readTime) in enumerate(readImages(impaths, prefetch, readerThreads, memoryMap, archive)):
+        readTimeTotal += readTime
+        if batchSize:
+            if stack is None:
+                stack = aiGeometry.getStack(image, batchSize)
+            stack[j % batchSize] = image.ravel()
+            if (j % batchSize == batchSize - 1) or (j == len(impaths) - 1):
+                k = j % batchSize + 1
+                q, s_raw[:, j - k + 1:j + 1] = aiGeometry.integrateStack(stack[:k])
+        else:
+            q, s_raw[:, j] = aiGeometry.integrate1d(image, nqpt, qRange, _workerState['maskImage'])
+        if j == 0:
+            imageSum = np.array(image)  # the image may be a view of the file
+        else:
+            imageSum += image
+    return q, s_raw, imageSum, time.perf_counter() - startTime, readTimeTotal
+
+
+@lazy_njit(cache=True)
+def _integrateStack(indptr, indices, data, stack, s):
+    ''' Adds the product of the operator with the stack of K images (K x pixels)
+    to s (nqpt x K). The operator is given as the CSR arrays of its transpose
+    (pixels x nqpt). The images are taken in groups of 8, whose values of a
+    pixel are kept in registers while the operator elements of the pixel are
+    applied; the remaining images are integrated one by one. Every curve is
+    summed in the order of the pixels, as in the product with the operator.
+    '''
+    K, nPixels = stack.shape
+    nGrouped = K - K % 8
+    for k in range(0, nGrouped, 8):
+        for j in range(nPixels):
+            x0, x1, x2, x3 = stack[k, j], stack[k + 1, j], stack[k + 2, j], stack[k + 3, j]
+            x4, x5, x6, x7 = stack[k + 4, j], stack[k + 5, j], stack[k + 6, j], stack[k + 7, j]
+            for n in range(indptr[j], indptr[j + 1]):
+                i = indices[n]
+                a = data[n]
+                s[i, k] += a * x0
+                s[i, k + 1] += a * x1
+                s[i, k + 2] += a * x2
+                s[i, k + 3] += a * x3
+                s[i, k + 4] += a * x4
+                s[i, k + 5] += a * x5
+                s[i, k + 6] += a * x6
+                s[i, k + 7] += a * x7
+    for k in range(nGrouped, K):
+        for j in range(nPixels):
+            x = stack[k, j]
+            for n in range(indptr[j], indptr[j + 1]):
+                s[indices[n], k] += data[n] * x
+
+
+def _save_dataset(f, path, data, compression='gzip', chunkSize=128):
+    ''' Stores data in the HDF5 file f. Numerical arrays with more than
+    chunkSize**2 elements are stored chunked and compressed: 2d arrays (curves
+    q x image, covariances, images) in tiles of chunkSize x chunkSize and 1d
+    arrays in chunks of chunkSize**2 elements. Other data (strings, scalars,
+    small arrays) is stored as is.
+    '''
+    if ((compression is None) or (not isinstance(data, (np.ndarray, LazyArray)))
+            or (data.dtype.kind not in 'biuf') or (data.size <= chunkSize ** 2)):
+        return f.create_dataset(path, data=data)
+    data = np.asarray(data)
+    if data.ndim == 1:
+        chunks = (min(data.size, chunkSize ** 2),)
+    elif data.ndim == 2:
+        chunks = tuple(min(n, chunkSize) for n in data.shape)
+    else:
+        chunks = True
+    return f.create_dataset(path, data=data, chunks=chunks, compression=compression, shuffle=True)
+
+
+def _load_dataset(dataset, lazy=False):
+    ''' Reads a dataset stored by _save_dataset. The strings which were joined
+    with '|' on saving are split into arrays of strings. If lazy is True, the
+    numerical arrays are returned as LazyArray.
+    '''
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        return np.array(dataset.asstr()[()].split('|'))
+    if lazy and (dataset.ndim > 0):
+        return LazyArray(dataset)
+    return dataset[()]
+
+
+def _load_subset(data, axes, selection):
+    ''' Reads a part of the dataset (or takes a part of the array or sparse
+    matrix) data. The axes are the names of the data axes (see subset_axes) and
+    selection is a dictionary with the slices or increasing integer indices for
+    the 'q', 't' and 'image' axes (see ScatData._getH5Selection). For HDF5
+    datasets, the slices and one of the index arrays are applied on reading, so
+    that only the needed hyperslab is read; the rest is applied in memory. Dense
+    index arrays (covering more than 10% of their span) are read as the bounding
+    slab, which is much faster than the h5py point selection.
+    '''
+    index = [selection[axis] if axis in selection else slice(None) for axis in axes]
+    if isinstance(data, h5py.Dataset):
+        if h5py.check_string_dtype(data.dtype) is not None:  # strings joined with '|'
+            data = _load_dataset(data)
+        else:
+            onRead = [slice(None)] * len(index)
+            isFancyRead = False
+            for axis, idx in enumerate(index):
+                if isinstance(idx, slice):
+                    onRead[axis], index[axis] = idx, slice(None)
+                elif (idx.size > 0) and (idx.size > 0.1 * (idx[-1] - idx[0] + 1)):
+                    onRead[axis], index[axis] = slice(idx[0], idx[-1] + 1), idx - idx[0]
+                elif not isFancyRead:
+                    onRead[axis], index[axis] = idx, slice(None)
+                    isFancyRead = True
+            data = data[tuple(onRead)]
+    if sparse.issparse(data):
+        data = sparse.csr_matrix(data)
+    for axis, idx in enumerate(index):
+        if not (isinstance(idx, slice) and (idx == slice(None))):
+            data = data[(slice(None),) * axis + (idx,)]
+    return data
+
+
+def _indexToSlice(idx):
+    ''' Converts increasing indices to a slice if they are contiguous.
+    '''
+    if (idx.size > 0) and (idx[-1] - idx[0] + 1 == idx.size):
+        return slice(idx[0], idx[-1] + 1)
+    return idx
+
+
+def _save_sparse(f, path, matrix):
+    ''' Stores a sparse matrix in the HDF5 file f as a group with the CSR arrays.
+    '''
+    matrix = sparse.csr_matrix(matrix)
+    group = f.create_group(path)
+    group.attrs['format'] = 'csr'
+    group.create_dataset('data', data=matrix.data)
+    group.create_dataset('indices', data=matrix.indices)
+    group.create_dataset('indptr', data=matrix.indptr)
+    group.create_dataset('shape', data=matrix.shape)
+
+
+def _load_sparse(group):
+    ''' Reads a sparse matrix stored by _save_sparse.
+    '''
+    return sparse.csr_matrix((group['data'][()], group['indices'][()], group['indptr'][()]),
+                             shape=tuple(group['shape'][()]))
+
+
 def normalizeQ(q, s_raw, qNormRange):
     qNormRangeSel = (q >= qNormRange[0]) & (q <= qNormRange[1])
     normInt = np.trapz(s_raw[qNormRangeSel, :], q[qNormRangeSel], axis=0)
@@ -925,59 +1961,69 @@ def getAverage(q, x_orig, covii, isOutlier, delay_str, t_str, toff_str,
                fraction, chisqThresh,
                q_break=None,
                dezinger=True, dezingerThresh=5,
-               covShrinkage=0,
-               plotting=False, chisqHistMax=10, y_offset=None):
+               covShrinkage=0, shrinkageSubsample=None,
+               plotting=False, chisqHistMax=10, y_offset=None, workers=None, statistics=None):
     ''' Function for calculating averages and standard errors of data sets.
     For details see ScatData.getTotalAverages method docstring.
+
+    If statistics (an AverageStatistics object) is given, it is filled with the
+    per-delay sufficient statistics of the averages, so that new curves can be
+    added later without recomputing everything (see ScatData.appendScan).
     '''
 
     x = x_orig.copy()
 
-    if sparse.issparse(covii): covii = covii.toarray()
     if covii is None:
-        covii = np.eye(delay_str.size)
+        covii = sparse.identity(delay_str.size, format='csr')
 
-    chisqThresh = np.array(chisqThresh)
-    if chisqThresh.size > 1:
-        q_break = np.array(q_break)
-        assert q_break.size == (chisqThresh.size - 1)
-        q_break = np.hstack((q.min() - 1e-6, q_break, q.max() + 1e-6))
-    else:
-        chisqThresh = chisqThresh[None]
-        q_break = np.array([q.min() - 1e-6, q.max() + 1e-6])
+    chisqThresh, q_break = getChisqThresholds(q, chisqThresh, q_break)
 
-    isOutlier, chisq = identifyOutliers_all(q, x, delay_str, t_str, isOutlier, fraction, chisqThresh, q_break,
-                                            dezinger, dezingerThresh)
+    isOutlier, chisq, references = identifyOutliers_all(q, x, delay_str, t_str, isOutlier, fraction, chisqThresh,
+                                                        q_break, dezinger, dezingerThresh, workers)
 
     print('Averaging ... ', end='')
     averageStartTime = time.perf_counter()
 
-    # For propoper average estimation we will need Amean operator
-    # Amean is defined such that x_mean @ Amean = X
-    Amean = np.zeros((t_str.size, delay_str.size))
-    for i, delay_point in enumerate(t_str):
-        delay_selection = (delay_str == delay_point)
-        Amean[i, delay_selection] = 1
-
-    # an inversion of the covii matrix is expensive, so for computing of the
-    # weighed average we approximate it with the inverse of the diagonal:
-    covii_diag_inv = np.diag(1 / np.diag(covii))
-
-    H = np.linalg.pinv(Amean @ covii_diag_inv @ Amean.T) @ Amean @ covii_diag_inv
-    x_av = (H @ x.T).T
+    # The weighted average is x_av = X @ H.T with
+    # H = pinv(Amean @ W @ Amean.T) @ Amean @ W, where Amean[k, i] = 1 if curve i
+    # belongs to delay k (so that x_av @ Amean gives the fitted curves) and W is
+    # the inverse of the diagonal of covii (the inversion of the full covii is
+    # expensive). As W is diagonal, Amean @ W @ Amean.T is diagonal as well and
+    # H reduces to per-delay normalized weights, applied as a sparse matrix.
+    delayIdx = getDelayIdx(delay_str, t_str)  # -1 for curves with delays not in t_str
+    isUsed = delayIdx >= 0
+    covii_diag_inv = 1 / covii.diagonal()
+    weightSum = np.bincount(delayIdx[isUsed], covii_diag_inv[isUsed], minlength=t_str.size)
+    weightSumInv = np.zeros(t_str.size)
+    isValid = weightSum > 1e-15 * weightSum.max()  # the default rcond of np.linalg.pinv
+    weightSumInv[isValid] = 1 / weightSum[isValid]
+    H = sparse.csr_matrix((covii_diag_inv[isUsed] * weightSumInv[delayIdx[isUsed]],
+                           (delayIdx[isUsed], np.where(isUsed)[0])),
+                          shape=(t_str.size, delay_str.size))
+    x_av = np.asarray(H @ x.T).T
     print('done ( %3.f' % ((time.perf_counter() - averageStartTime) * 1000), 'ms )')
 
     print('Uncertainty propagation  ... ', end='')
     covtt = H @ covii @ H.T
+    covtt = covtt.toarray() if sparse.issparse(covtt) else np.asarray(covtt)
     covarStartTime = time.perf_counter()
 
-    dx = (x - x_av @ Amean) @ np.sqrt(covii_diag_inv)
+    x_fit = np.hstack((x_av, np.zeros((x.shape[0], 1))))[:, delayIdx]  # index -1 picks the zero column
+    dx = (x - x_fit) * np.sqrt(covii_diag_inv)
     dx = dx[:, ~isOutlier & (delay_str != toff_str)]
 
     if covShrinkage is None:
-        _, covShrinkage = cov_shrink_ss(dx.T.copy(order='C'))
-
-    dxdxt = dx @ dx.T
+        _, covShrinkage = covar.cov_shrink_ss(dx.T.copy(order='C'), subsample=shrinkageSubsample)
+
+    if statistics is not None:
+        statistics.settings = dict(fraction=fraction, chisqThresh=chisqThresh, q_break=q_break, dezinger=dezinger,
+                                   dezingerThresh=dezingerThresh, covShrinkage=covShrinkage, toff_str=toff_str)
+        statistics.references = references
+        statistics.start(t_str, x_av)
+        statistics.add(x, covii, delayIdx, ~isOutlier & (delay_str != toff_str))
+        dxdxt = statistics.M  # dx @ dx.T accumulated delay by delay
+    else:
+        dxdxt = dx @ dx.T
     dxdxt_diag = np.diag(np.diag(dxdxt))
 
     covqq = (dxdxt * (1 - covShrinkage) + dxdxt_diag * covShrinkage) / (dx.shape[1] - t_str.size)
@@ -994,33 +2040,97 @@ def getAverage(q, x_orig, covii, isOutlier, delay_str, t_str, toff_str,
     return x_av, x_err, isOutlier, covtt, covqq, chisq
 
 
-def identifyOutliers_all(q, x, delay_str, t_str, isOutlier, fraction, chisqThresh, q_break, dezinger, dezingerThresh):
+def getChisqThresholds(q, chisqThresh, q_break=None):
+    ''' Function for converting chisqThresh and q_break (see
+    ScatData.getTotalAverages) to the arrays of thresholds and of the q region
+    edges used by identifyOutliers_one.
+    '''
+    chisqThresh = np.array(chisqThresh)
+    if chisqThresh.size > 1:
+        q_break = np.array(q_break)
+        assert q_break.size == (chisqThresh.size - 1)
+        q_break = np.hstack((q.min() - 1e-6, q_break, q.max() + 1e-6))
+    else:
+        chisqThresh = chisqThresh[None]
+        q_break = np.array([q.min() - 1e-6, q.max() + 1e-6])
+    return chisqThresh, q_break
+
+
+def getDelayIdx(delay_str, t_str):
+    ''' Function for getting the index of the delay in t_str for every curve.
+    Returns -1 for the curves with delays which are not in t_str.
+    '''
+    delay_str, t_str = np.asarray(delay_str), np.asarray(t_str)
+    sorter = np.argsort(t_str)
+    idx = np.searchsorted(t_str, delay_str, sorter=sorter).clip(max=t_str.size - 1)
+    delayIdx = sorter[idx]
+    delayIdx[t_str[delayIdx] != delay_str] = -1
+    return delayIdx
+
+
+def identifyOutliers_all(q, x, delay_str, t_str, isOutlier, fraction, chisqThresh, q_break, dezinger, dezingerThresh,
+                         workers=None, references=None):
+    ''' Function for identification of outliers (and dezingering of x) for all the
+    delays in t_str, see identifyOutliers_one.
+
+    references - list (ordered as t_str) of the per-delay references (trimmed
+    average, trimmed std and median) to compare the curves with. If None, they
+    are obtained from the curves themselves.
+
+    Returns isOutlier, chisq and the list of the references used.
+    '''
     print('Identifying outliers ... ')
     outlierStartTime = time.perf_counter()
 
     chisq = np.zeros((chisqThresh.size, delay_str.size)) + 10
+    if references is None:
+        references = [None] * t_str.size
+
+    # the delays are independent (disjoint columns of x), so they can be processed concurrently
+    selections = [(delay_str == delay_point) & ~isOutlier for delay_point in t_str]
+    args = (fraction, chisqThresh, q_break, dezinger, dezingerThresh)
+    if workers:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_identifyOutliers_delay, q, x[:, delay_selection], *args, reference)
+                       for delay_selection, reference in zip(selections, references)]
+            results = [future.result() for future in futures]
+    else:
+        results = (_identifyOutliers_delay(q, x[:, delay_selection], *args, reference)
+                   for delay_selection, reference in zip(selections, references))
 
-    for i, delay_point in enumerate(t_str):
-        delay_selection = (delay_str == delay_point) & ~isOutlier
-        x_loc = x[:, delay_selection]
-
-        isOutlier_loc, chisq_loc, isHotPixel_loc = identifyOutliers_one(
-            q, x_loc, fraction, chisqThresh, q_break, dezingerThresh=dezingerThresh)
+    references = []
+    for delay_point, delay_selection, (x_loc, isOutlier_loc, chisq_loc, reference) in zip(t_str, selections,
+                                                                                         results):
         print(f'Acceptance for {delay_point}: {np.sum(~isOutlier_loc)}/{np.sum((delay_str == delay_point))}')
         isOutlier[delay_selection] = isOutlier_loc
         chisq[:, delay_selection] = chisq_loc
-
         if dezinger:
-            x_loc_med = np.tile(np.median(x_loc, axis=1)[:, None], x_loc.shape[1])
-            x_loc[isHotPixel_loc] = x_loc_med[isHotPixel_loc]
             x[:, delay_selection] = x_loc
+        references.append(reference)
 
     print('... done ( %3.f' % ((time.perf_counter() - outlierStartTime) * 1000), 'ms )')
-    return isOutlier, chisq
+    return isOutlier, chisq, references
+
+
+def _identifyOutliers_delay(q, x_loc, fraction, chisqThresh, q_break, dezinger, dezingerThresh, reference=None):
+    ''' Outlier identification (and dezingering) of the curves x_loc of one delay
+    (see identifyOutliers_all). x_loc is modified in place.
+    '''
+    if reference is None:
+        if x_loc.shape[1] == 0:
+            return x_loc, np.zeros(0, dtype=bool), np.zeros((chisqThresh.size, 0)), None
+        ySel_av, ySel_std = getOutlierReference(x_loc, fraction)
+        reference = (ySel_av, ySel_std, np.median(x_loc, axis=1) if dezinger else None)
+    isOutlier_loc, chisq_loc, isHotPixel_loc = identifyOutliers_one(
+        q, x_loc, fraction, chisqThresh, q_break, dezingerThresh=dezingerThresh, reference=reference[:2])
+    if dezinger:
+        iq, ic = np.nonzero(isHotPixel_loc)
+        x_loc[iq, ic] = reference[2][iq]
+    return x_loc, isOutlier_loc, chisq_loc, reference
 
 
 def identifyOutliers_one(q_orig, y_orig, fraction, chisqThresh,
-                         q_break, dezingerThresh=5):
+                         q_break, dezingerThresh=5, reference=None):
     ''' Function for identification of outliers in a given data set.
 
     The function calculates the average and the standard deviation using fraction
@@ -1050,14 +2160,17 @@ def identifyOutliers_one(q_orig, y_orig, fraction, chisqThresh,
             will be evaluated.
         chisqThresh_lowq, chisqThresh_highq - chisq threshold values for low and
             high q parts of the data.
+        reference - (average, deviation) to use instead of the ones calculated
+            from y_orig (see getOutlierReference).
     '''
-    q = q_orig.copy()
-    y = y_orig.copy()
+    q = q_orig  # neither q nor y are modified
+    y = y_orig
     chisq = np.zeros((chisqThresh.size, y.shape[1]))
 
-    ySel = getMedianSelection(y, fraction)
-    ySel_av = np.mean(ySel, axis=1)
-    ySel_std = np.std(ySel, axis=1)
+    if reference is None:
+        ySel_av, ySel_std = getOutlierReference(y, fraction)
+    else:
+        ySel_av, ySel_std = reference
     nnzStd = ySel_std != 0
     errsq = ((y[nnzStd, :] - ySel_av[nnzStd, np.newaxis]) /
              ySel_std[nnzStd, np.newaxis]) ** 2
@@ -1073,18 +2186,29 @@ def identifyOutliers_one(q_orig, y_orig, fraction, chisqThresh,
     return isOutlier, chisq, isHotPixel
 
 
+def getOutlierReference(y, fraction):
+    ''' Function for getting the trial average and standard deviation of the
+    curves y (axis=0 in q space) from the fraction of the data between the
+    symmetric percentiles (see getMedianSelection).
+    '''
+    ySel = getMedianSelection(y, fraction)
+    return np.mean(ySel, axis=1), np.std(ySel, axis=1)
+
+
 def getMedianSelection(z_orig, frac):
     ''' Function to get selection of data from symmetric percentiles determined
     by fraction. For example if fraction is 0.9, then the output data is the
     selection between 0.05 and 0.95 percentiles.
     '''
-    z = z_orig.copy()
-    z = np.sort(z, axis=1)
-    ncols = z.shape[1]
-    low = np.int(np.round((1 - frac) / 2 * ncols))
-    high = np.int(np.round((1 + frac) / 2 * ncols))
-    z = z[:, low:high]
-    return z
+    ncols = z_orig.shape[1]
+    low = int(np.round((1 - frac) / 2 * ncols))
+    high = int(np.round((1 + frac) / 2 * ncols))
+    if high <= low:
+        return z_orig[:, low:high]
+    # the selection is not ordered: only the values at positions low and high-1 are
+    # put in place, which is enough for the statistics computed from it
+    z = np.partition(z_orig, (low, high - 1), axis=1)
+    return z[:, low:high]
 
 
 def plotOutliers(q, x, delay_str, t_str, isOutlier, chisq,
@@ -1117,6 +2241,9 @@ def plotOutliers(q, x, delay_str, t_str, isOutlier, chisq,
                  backgroundcolor='w', zorder=3)
 
     plt.hlines(-np.arange(chisqThresh.size) * y_offset, q.min(), q.max())
+    custom_lines = [plt.Line2D([0], [0], color='k', lw=1),
+                    plt.Line2D([0], [0], color='b', lw=1),
+                    plt.Line2D([0], [0], color='r', lw=1)]
     plt.legend(custom_lines, ['Data', 'Outliers', 'Mean'])
     plt.xlim(q.min(), q.max())
     plt.xlabel('q, A$^{-1}$')
@@ -1178,9 +2305,134 @@ def rescaleQ(q_old, wavelength, dist_old, dist_new):
     return 4 * pi / wavelength * np.sin(tth_new / 2)
 
 
+def mergeScatData(inputs, q=None, toff_str=None, subtractFlag=None, totalAverages=None, diffAverages=None):
+    ''' Function for merging data sets which were reduced and saved separately
+    (e.g. the same sample measured at several beamtimes) without reading the
+    images. The total curves of the inputs are concatenated (rebinned to a
+    common q grid with utils.bin_operator if the q grids differ), the
+    differences are calculated for each input separately as in
+    ScatData.getDifferences, and the merged data is averaged with
+    getTotalAverages and getDiffAverages.
+
+    You need:
+        inputs - list of .h5 files saved with ScatData.save and/or ScatData objects
+        q - q grid of the merged data. If None, the q grid of the inputs is used
+        or, if the grids differ, the coarsest of them within the q range covered
+        by all the inputs
+        toff_str, subtractFlag - see ScatData.getDifferences; if None, the values
+        used for the inputs are taken (they must be the same for all the inputs).
+        If the inputs have no differences and toff_str is None, only the total
+        curves are merged
+        totalAverages, diffAverages - dictionaries with the keyword arguments of
+        getTotalAverages and getDiffAverages (fraction, chisqThresh, etc); by
+        default, the defaults of the methods are used (without plotting)
+
+    Output:
+        ScatData object with the merged data
+
+    NB: the outliers are identified anew. The t_str of the merged data is the
+    union of the t_str of the inputs. The aiGeometry of the first input is kept.
+    '''
+    datasets = [ScatData(item) if isinstance(item, str) else item for item in inputs]
+
+    if q is None:
+        q = _getCommonQ([data.q for data in datasets])
+    delays = {}
+    for data in datasets:
+        delays.update(zip(np.atleast_1d(data.t_str), np.atleast_1d(data.t)))
+    t_str = np.array(list(delays.keys()))
+    t = np.array(list(delays.values()))
+    t_str, t = t_str[np.argsort(t)], np.sort(t)
+
+    if toff_str is None:
+        toff_str = _getCommonSetting(datasets, 'toff_str')
+    if (toff_str is not None) and (subtractFlag is None):
+        subtractFlag = _getCommonSetting(datasets, 'subtractFlag')
+        if subtractFlag is None:
+            subtractFlag = 'MovingAverage'
+
+    print('*** Merging', len(datasets), 'data sets ***')
+    parts = []
+    for data in datasets:
+        part = ScatData(None)
+        part.q, part.t, part.t_str, part.nDelays = q, t, t_str, t_str.size
+        part.nFiles = np.atleast_1d(data.total.delay_str).size
+        part.logFile, part.dataInDir, part.logFileStyle = data.logFile, data.dataInDir, data.logFileStyle
+        part.logData = getattr(data, 'logData', None)
+        part.imageAv = data.imageAv
+
+        Abin = None
+        if (data.q.size != q.size) or not np.allclose(data.q, q):
+            print('Rebinning', data.q.size, 'q points to', q.size)
+            Abin = bin_operator(q, data.q)
+        for key in ('s_raw', 's'):
+            value = np.asarray(data.total.__getattribute__(key))
+            part.total.__setattr__(key, value if Abin is None else Abin @ value)
+        for key in ('normInt', 'delay', 'delay_str', 'timeStamp', 'timeStamp_str', 'scanStamp'):
+            part.total.__setattr__(key, np.atleast_1d(data.total.__getattribute__(key)))
+        part.total.isOutlier = np.zeros(part.nFiles, dtype=bool)
+        part.total.covii = sparse.diags(1 / part.total.normInt / np.median(1 / part.total.normInt), format='csr')
+
+        if toff_str is not None:
+            part.getDifferences(toff_str, subtractFlag)
+        parts.append(part)
+
+    # covii = diag(1/normInt) / median(1/normInt), see ScatData.integrate
+    weightScales = [np.median(1 / part.total.normInt) for part in parts]
+    diffCovii = [part.diff.covii for part in parts]
+    merged = parts[0]
+    for part in parts[1:]:
+        merged._appendData(part)
+    merged.aiGeometry = datasets[0].aiGeometry
+    merged.ignoreFirst = getattr(datasets[0], 'ignoreFirst', None)
+    merged.nFirstFiles = getattr(datasets[0], 'nFirstFiles', None)
+    if getattr(datasets[0], 'tth', None) is not None:
+        merged.tth = np.interp(q, datasets[0].q, datasets[0].tth)
+
+    weightScale = np.median(1 / merged.total.normInt)
+    merged.total.covii = sparse.diags(1 / merged.total.normInt / weightScale, format='csr')
+    if toff_str is not None:
+        merged.diff.covii = sparse.block_diag([covii * (partScale / weightScale)
+                                               for covii, partScale in zip(diffCovii, weightScales)], format='csr')
+    print('*** Done ***\n')
+
+    merged.getTotalAverages(**{'plotting': False, **(totalAverages or {})})
+    if toff_str is not None:
+        merged.getDiffAverages(**{'plotting': False, **(diffAverages or {})})
+    return merged
+
+
+def _getCommonQ(qs):
+    ''' Returns the q grid for merging the data with the q grids qs (see
+    mergeScatData).
+    '''
+    if all((q.size == qs[0].size) and np.allclose(q, qs[0]) for q in qs):
+        return qs[0]
+    qmin = max(q.min() for q in qs)
+    qmax = min(q.max() for q in qs)
+    assert qmin < qmax, 'the q ranges of the data sets do not overlap'
+    candidates = [q[(q >= qmin) & (q <= qmax)] for q in qs]
+    return min(candidates, key=lambda q: q.size)
+
+
+def _getCommonSetting(datasets, key):
+    ''' Returns the setting key (toff_str or subtractFlag) of the differences of
+    the data sets (see mergeScatData), None if the differences were not
+    calculated.
+    '''
+    values = set()
+    for data in datasets:
+        value = getattr(data.diff, key, None)
+        if value is None:
+            return None
+        values.add(str(np.atleast_1d(value)[0]))  # strings are loaded from .h5 files as arrays
+    assert len(values) == 1, f'the data sets have different {key} ({values}), provide it explicitly'
+    return values.pop()
+
+
 def distribute_Mat2ScatData(matfile, t_factor=1e-12, t_offset=0):
     data = ScatData(None)
-    matdata = scipy.io.loadmat(matfile)
+    matdata = scipy_io.loadmat(matfile)
     data.q = matdata['data']['q'][0][0].squeeze()
     data.t = matdata['data']['t'][0][0].squeeze()*t_factor - t_offset
     data.t_str = np.array([time_num2str(i) for i in data.t])
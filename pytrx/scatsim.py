@@ -10,15 +10,16 @@ from itertools import islice
 import numpy as np
 import pandas as pd
 import copy
-import matplotlib.pyplot as plt
-from pytrx.utils import z_str2num, z_num2str
-import pkg_resources
+from pytrx.utils import z_str2num, z_num2str, lazy_import, lazy_njit
 
 from pytrx import hydro
 from pytrx.transformation import Transformation
 # from pytrx import transformation
-from numba import njit, prange
-from mpl_toolkits.mplot3d import Axes3D
+
+# heavy dependencies are imported on first use (see utils.lazy_import)
+plt = lazy_import('matplotlib.pyplot')
+pkg_resources = lazy_import('pkg_resources')
+numba = lazy_import('numba')
 
 
 class Molecule:
@@ -283,6 +284,7 @@ class ParameterConverter:
 
         if plotting:
             grid_out_pred = grid_in @ self.R
+            from mpl_toolkits.mplot3d import Axes3D  # registers the 3d projection
             fig = plt.figure()
             plt.clf()
             ax = fig.gca(projection='3d')
@@ -564,7 +566,7 @@ def Debye(q, mol, f=None, atomOnly=False, debug=False):
 
     return Scoh
 
-@njit
+@lazy_njit
 def Scoh_calc(FF, q, r, natoms):
     Scoh = np.zeros(q.shape)
     for idx1 in range(natoms):
@@ -575,11 +577,11 @@ def Scoh_calc(FF, q, r, natoms):
         Scoh += FF[idx1] ** 2
     return Scoh
 
-@njit(parallel=True)
+@lazy_njit(parallel=True)
 def Scoh_calc2(FF, q, r, natoms):
     # Scoh = np.zeros(q.shape)
     Scoh2 = np.zeros((natoms, len(q)))
-    for idx1 in prange(natoms):
+    for idx1 in numba.prange(natoms):
         Scoh2[idx1] += FF[idx1] ** 2
         for idx2 in range(idx1 + 1, natoms):
             r12 = r[idx1, idx2]
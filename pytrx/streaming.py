@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+"""
+streaming - live reduction of a running scan (ScatDataStream) with streaming
+outlier rejection (OutlierSketch).
+"""
+from pathlib import Path
+import ntpath
+import os
+import time
+from datetime import datetime
+from collections import deque
+from math import pi
+
+import numpy as np
+import pandas as pd
+
+from pytrx.utils import _get_id09_columns_old, _get_id09_columns, time_str2num, time_num2str, lazy_import
+from pytrx.scatdata import ScatData, normalizeQ, getChisqThresholds, identifyOutliers_one, getOutlierReference
+from pytrx.imageio import _readImageData
+
+fabio = lazy_import('fabio')
+asyncio = lazy_import('asyncio')
+
+
+class ScatDataStream:
+    ''' This is a class for a live reduction of the data while the scan is still
+        running.
+
+        The log file(s) are tailed and every new line is integrated as soon as
+        the corresponding image is written to dataInDir. The per-delay averages
+        of the total and difference curves are updated with running sums, so
+        the time needed to take a new image into account does not depend on
+        the number of images already in the run.
+
+        The workflow:
+
+        0. Declare the stream object (ex: S) with the log file(s), the
+        integration and the difference parameters:
+        S = ScatDataStream(logFile, dataInDir, energy=12, distance=365, ...)
+
+        1. Run it:
+        asyncio.run(S.run(idleTimeout=600)) - in a script, or
+        task = asyncio.ensure_future(S.run()) - in jupyter (the event loop is
+        already running); stop it with S.stop().
+
+        2. The current results are in S.data (a ScatData object):
+        S.data.q, S.data.t_str, S.data.total.s_av, S.data.diff.s_av, so they
+        can be plotted with S.data.plotDiffAverages() at any time. A function
+        given as onUpdate is called with S after each processed image.
+
+        3. With rejectOutliers=True every new total and difference curve is
+        checked on arrival against a running robust estimate of its delay (see
+        OutlierSketch) and the outliers are left out of the averages. When the
+        scan is finished, S.reconcile() repeats the identification with the
+        offline (batch) method on all the curves, updates the averages and
+        returns the comparison of the online and batch outlier flags.
+
+        NB: the live averages are weighted averages (the weights are the same
+        as in getTotalAverages/getDiffAverages) of the dezingering-free curves,
+        so they are meant for monitoring the experiment. The final reduction
+        should be done with ScatData once the scan is finished.
+    '''
+
+    def __init__(self, logFile, dataInDir=None, logFileStyle='biocars', toff_str='-5us',
+                 subtractFlag='MovingAverage',
+                 energy=12, distance=365, pixelSize=80e-6,
+                 centerX=1900, centerY=1900, qRange=[0.0, 4.0], nqpt=400,
+                 qNormRange=[1.9, 2.1], maskPath=None,
+                 correctPhosphor=False, muphos=228, lphos=75e-4,
+                 correctSample=False, musample=0.49, lsample=300e-6,
+                 useOperator=False, operatorDir=None,
+                 pollInterval=0.5, missingTimeout=60, onUpdate=None,
+                 rejectOutliers=False, fraction=0.9, chisqThresh=5, chisqThreshDiff=1.5, q_break=None,
+                 nWarmup=20, nSketchBins=256):
+        '''
+        You will need:
+        logFile - name of the log file(s) being written. Should be a string or
+        a list of strings. The log files do not need to exist yet.
+        dataInDir - directory (or list of directories) where the images are
+        written (see ScatData.__init__).
+        logFileStyle - 'biocars', 'id09_old' or 'id09' (see ScatData.__init__).
+        toff_str - time delay used as a reference for the differences.
+        subtractFlag - the way the differences are calculated, see
+        ScatData.getDifferences. With 'MovingAverage', 'Closest' and 'Next' an
+        image is subtracted once the next reference image arrives.
+        energy ... lsample - integration parameters, see ScatData.integrate.
+        useOperator, operatorDir - integrate with the sparse pixel-to-q operator
+        (see ScatData.integrate), which is much faster for a stream of images.
+        pollInterval - time between the checks of the log files and of the data
+        directories (in s). An image is integrated once its size did not change
+        between two checks.
+        missingTimeout - time (in s) after which an image listed in the log file
+        which did not appear in dataInDir is excluded from the analysis.
+        onUpdate - function called as onUpdate(self) after each processed image.
+        rejectOutliers - identify the outliers on arrival and leave them out of
+        the averages. The curves are then kept in memory for reconcile().
+        fraction, q_break - see ScatData.getTotalAverages.
+        chisqThresh, chisqThreshDiff - chisq thresholds for the total and the
+        difference curves (see getTotalAverages and getDiffAverages).
+        nWarmup, nSketchBins - number of curves of a delay for which the exact
+        reference is used and the number of histogram bins per q point used
+        after that (see OutlierSketch).
+        '''
+        if dataInDir is None:
+            if type(logFile) is str:
+                dataInDir = str(Path(logFile).parent.absolute()) + '\\'
+            else:
+                dataInDir = [(str(Path(i).parent.absolute()) + '\\') for i in logFile]
+        if isinstance(logFile, str):
+            logFile, dataInDir = [logFile], [dataInDir]
+        assert isinstance(logFile, list), 'Provide a string or a list of strings as log file(s)'
+        assert isinstance(dataInDir, list) and len(dataInDir) == len(logFile), \
+            'If you provide a list of log files, dataInDir should be a list of the same size'
+        assert logFileStyle in ('biocars', 'id09_old', 'id09'), \
+            'logFileStyle can be either "biocars" or "id09"'
+        assert subtractFlag in ('MovingAverage', 'Closest', 'Previous', 'Next'), \
+            'subtractFlag can be "MovingAverage", "Closest", "Previous" or "Next"'
+
+        self.tails = [_LogTail(item, dataInDir[i], logFileStyle) for i, item in enumerate(logFile)]
+        self.toff_str = toff_str
+        self.subtractFlag = subtractFlag
+        self.qRange = qRange
+        self.nqpt = nqpt
+        self.useOperator = useOperator
+        self.operatorDir = operatorDir
+        self.pollInterval = pollInterval
+        self.missingTimeout = missingTimeout
+        self.onUpdate = onUpdate
+
+        if maskPath:
+            assert isinstance(maskPath, str), 'maskPath should be string'
+            assert Path(maskPath).is_file(), maskPath + ' file (mask) not found'
+            self.maskImage = fabio.open(maskPath).data
+        else:
+            self.maskImage = None
+        self._correctionArgs = (correctPhosphor, muphos, lphos, correctSample, musample, lsample)
+        self._corrections = None
+
+        self.data = ScatData(None)
+        self.data.logFile = logFile
+        self.data.dataInDir = dataInDir
+        self.data.logFileStyle = logFileStyle
+        self.data.nFiles = 0
+        self.data.diff.toff_str = toff_str
+        self.data._getaiGeometry(energy, distance, pixelSize, centerX, centerY, qRange, nqpt, qNormRange)
+
+        self.rejectOutliers = rejectOutliers
+        self.fraction = fraction
+        self.chisqThresh = {'total': chisqThresh, 'diff': chisqThreshDiff}
+        self.q_break = q_break
+        self.nWarmup = nWarmup
+        self.nSketchBins = nSketchBins
+
+        # for the total and difference curves: delay_str -> [sum of weight * curve, sum of weights, number of curves]
+        self._sums = {'total': {}, 'diff': {}}
+        self._sketches = {'total': {}, 'diff': {}}  # delay_str -> OutlierSketch
+        self._curves = {'total': [], 'diff': []}  # (delay_str, curve, weight, isOutlier) if rejectOutliers
+        self._isRunning = False
+
+    async def run(self, idleTimeout=None):
+        ''' Coroutine processing the images until stop() is called or, if
+        idleTimeout is given, until no new image arrived for idleTimeout
+        seconds. The images are read and integrated in a worker thread, so the
+        event loop stays responsive. An image which cannot be read is excluded
+        from the analysis. When the coroutine ends, the images still
+        waiting for the next reference are subtracted using the previous one
+        (see finish).
+        Returns self.data.
+        '''
+        loop = asyncio.get_running_loop()
+        self._isRunning = True
+        lastImageTime = time.monotonic()
+        print('*** Streaming ***')
+        while self._isRunning:
+            for tail in self.tails:
+                tail.readNewRows()
+                for row in tail.popReadyRows(self.missingTimeout):
+                    impath = row['dataInDir'] + row['file']
+                    startReadTime = time.perf_counter()
+                    try:
+                        image = await loop.run_in_executor(None, _readImageData, impath)
+                    except Exception as e:
+                        print(impath, 'could not be read (%s) and will be excluded from analysis' % e)
+                        continue
+                    startIntTime = time.perf_counter()
+                    q, s_raw = await loop.run_in_executor(None, self._integrateImage, image)
+                    readTime = startIntTime - startReadTime
+                    intTime = time.perf_counter() - startIntTime
+                    startUpdateTime = time.perf_counter()
+                    self._addCurve(tail, row, q, s_raw)
+                    updateTime = time.perf_counter() - startUpdateTime
+                    lastImageTime = time.monotonic()
+                    print(self.data.nFiles, '|',
+                          row['file'], ':',
+                          'readout: %.0f' % (readTime * 1e3),
+                          'ms | integration: %.0f' % (intTime * 1e3),
+                          'ms | update: %.1f' % (updateTime * 1e3), 'ms')
+                    if self.onUpdate is not None:
+                        self.onUpdate(self)
+            if (idleTimeout is not None) and (time.monotonic() - lastImageTime > idleTimeout):
+                break
+            await asyncio.sleep(self.pollInterval)
+        self.finish()
+        print('*** Streaming done ***\n')
+        return self.data
+
+    def stop(self):
+        ''' Stops run() after the current poll. '''
+        self._isRunning = False
+
+    def finish(self):
+        ''' Subtracts the images waiting for the next reference image using the
+        previous reference only (end of the scan) and updates self.data.
+        '''
+        for tail in self.tails:
+            for entry in tail.waiting:
+                self._addDifference(entry, entry['prev'], None)
+            tail.waiting = []
+        self._updateAverages()
+
+    def _integrateImage(self, image):
+        aiGeometry = self.data.aiGeometry
+        if self.useOperator and aiGeometry.operator is None:
+            aiGeometry.getOperator(image.shape, self.nqpt, self.qRange, self.maskImage, self.operatorDir)
+            tth = 2 * np.arcsin(aiGeometry.wavelength * 1e10 * aiGeometry.operatorQ / (4 * pi))
+            aiGeometry.scaleOperator(self.data._getCorrections(tth, *self._correctionArgs))
+        return aiGeometry.integrate1d(image, self.nqpt, self.qRange, self.maskImage)
+
+    def _addCurve(self, tail, row, q, s_raw):
+        '''Adds the integrated curve to the running sums of its delay and passes
+        it on to the difference calculation.
+        '''
+        if self.data.q is None:
+            self.data.q = q
+            self.data.tth = 2 * np.arcsin(self.data.aiGeometry.wavelength * 1e10 * q / (4 * pi)) / pi * 180
+            if self.useOperator:  # the corrections are already included in the operator
+                self._corrections = np.ones(q.shape)
+            else:
+                self._corrections = self.data._getCorrections(self.data.tth / 180 * pi, *self._correctionArgs)
+        s_raw = s_raw * self._corrections
+        normInt, s = normalizeQ(self.data.q, s_raw[:, np.newaxis], self.data.aiGeometry.qNormRange)
+        normInt, s = normInt[0], s[:, 0]
+
+        self._addToAverage('total', row['delay_str'], s, normInt)  # the weights are normInt (see ScatData.integrate)
+        self.data.nFiles += 1
+
+        entry = {'delay_str': row['delay_str'], 's': s, 'normInt': normInt,
+                 'timeStamp': row['timeStamp'], 'prev': tail.lastOff}
+        if row['delay_str'] == self.toff_str:
+            for waiting in tail.waiting:
+                self._addDifference(waiting, waiting['prev'], entry)
+            tail.waiting = []
+            tail.lastOff = entry
+        if self.subtractFlag == 'Previous':
+            self._addDifference(entry, entry['prev'], None)
+        else:
+            tail.waiting.append(entry)
+        self._updateAverages()
+
+    def _addDifference(self, entry, prev, next):
+        '''Subtracts the reference curve(s) prev/next from the curve of the entry
+        following the subtractFlag rules of ScatData.getDifferences and adds the
+        difference to the running sums of its delay. The weight of the
+        difference is the inverse of its variance, i.e. of the corresponding
+        diagonal element of Adiff @ covii @ Adiff.T.
+        '''
+        if self.subtractFlag == 'Previous':
+            next = None
+        elif self.subtractFlag == 'Next':
+            prev = None
+        elif self.subtractFlag == 'Closest':
+            if entry['delay_str'] == self.toff_str:  # this is to avoid getting the same differences
+                prev = None
+            elif (prev is not None) and (next is not None):
+                if abs(entry['timeStamp'] - next['timeStamp']) <= abs(entry['timeStamp'] - prev['timeStamp']):
+                    prev = None
+                else:
+                    next = None
+
+        if (prev is not None) and (next is not None):
+            timeToNext = abs(entry['timeStamp'] - next['timeStamp'])
+            timeToPrev = abs(entry['timeStamp'] - prev['timeStamp'])
+            timeDiff = abs(next['timeStamp'] - prev['timeStamp'])
+            references = [(next, timeToPrev / timeDiff), (prev, timeToNext / timeDiff)]
+        elif next is not None:
+            references = [(next, 1)]
+        elif prev is not None:
+            references = [(prev, 1)]
+        else:
+            return  # no reference in this scan
+
+        ds = entry['s'].copy()
+        variance = 1 / entry['normInt']
+        for reference, weight in references:
+            ds -= weight * reference['s']
+            variance += weight ** 2 / reference['normInt']
+
+        self._addToAverage('diff', entry['delay_str'], ds, 1 / variance)
+
+    def _addToAverage(self, kind, delay_str, x, weight):
+        '''Adds the curve x with the weight to the running sums of its delay for
+        the total (kind='total') or difference (kind='diff') curves, unless it
+        is identified as an outlier.
+        '''
+        sums = self._sums[kind].setdefault(delay_str, [np.zeros(x.size), 0.0, 0])
+        isOutlier = False
+        if self.rejectOutliers:
+            if delay_str not in self._sketches[kind]:
+                self._sketches[kind][delay_str] = OutlierSketch(self.data.q, self.fraction, self.chisqThresh[kind],
+                                                                self.q_break, self.nWarmup, self.nSketchBins)
+            isOutlier, _ = self._sketches[kind][delay_str].add(x)
+            self._curves[kind].append((delay_str, x, weight, isOutlier))
+        if not isOutlier:
+            sums[0] += weight * x
+            sums[1] += weight
+            sums[2] += 1
+
+    def reconcile(self):
+        ''' Final batch pass over the curves received so far (requires
+        rejectOutliers=True): the outliers are identified with the offline
+        method (identifyOutliers_one with all the curves of each delay) and the
+        averages are recomputed without them. The online and batch flags are
+        stored in self.data.total/diff.isOutlierOnline and isOutlier (in the
+        order of arrival, with the delays in delay_str).
+
+        Returns a pandas table with the number of curves, online and batch
+        outliers, and curves flagged differently for every delay.
+        '''
+        assert self.rejectOutliers, 'reconcile requires rejectOutliers=True'
+        print('*** Reconciling the outliers ***')
+        summary = []
+        for kind, container in (('total', self.data.total), ('diff', self.data.diff)):
+            if not self._curves[kind]:
+                continue
+            delay_str = np.array([curve[0] for curve in self._curves[kind]])
+            x = np.array([curve[1] for curve in self._curves[kind]]).T
+            weight = np.array([curve[2] for curve in self._curves[kind]])
+            isOutlierOnline = np.array([curve[3] for curve in self._curves[kind]])
+            isOutlier = np.zeros(delay_str.size, dtype=bool)
+            chisqThresh, q_break = getChisqThresholds(self.data.q, self.chisqThresh[kind], self.q_break)
+            for delay_point in self._sums[kind]:
+                sel = delay_str == delay_point
+                isOutlier[sel], _, _ = identifyOutliers_one(self.data.q, x[:, sel], self.fraction, chisqThresh,
+                                                            q_break)
+                used = sel & ~isOutlier
+                self._sums[kind][delay_point] = [x[:, used] @ weight[used], np.sum(weight[used]), np.sum(used)]
+                summary.append({'curves': kind, 'delay': delay_point, 'n': np.sum(sel),
+                                'online': np.sum(isOutlierOnline[sel]), 'batch': np.sum(isOutlier[sel]),
+                                'different': np.sum(isOutlierOnline[sel] != isOutlier[sel])})
+            self._curves[kind] = [(d, c, w, o) for d, c, w, o in zip(delay_str, x.T, weight, isOutlier)]
+            container.delay_str = delay_str
+            container.isOutlier = isOutlier
+            container.isOutlierOnline = isOutlierOnline
+        self._updateAverages()
+        summary = pd.DataFrame(summary)
+        print(summary.to_string(index=False))
+        print('*** Done ***\n')
+        return summary
+
+    def _updateAverages(self):
+        '''Updates self.data from the running sums. The cost depends only on the
+        number of delays and q points.
+        '''
+        t_str = np.array(list(self._sums['total'].keys()))
+        t = np.array([time_str2num(i) for i in t_str])
+        order = np.argsort(t)
+        self.data.t, self.data.t_str = t[order], t_str[order]
+        self.data.nDelays = t_str.size
+
+        for kind, container in (('total', self.data.total), ('diff', self.data.diff)):
+            s_av = np.full((self.data.q.size, self.data.t_str.size), np.nan)  # nan if there are no curves (yet)
+            nCurves = np.zeros(self.data.t_str.size, dtype=int)
+            for i, delay_str in enumerate(self.data.t_str):
+                sums = self._sums[kind].get(delay_str)
+                if (sums is not None) and (sums[2] > 0):
+                    s_av[:, i] = sums[0] / sums[1]
+                    nCurves[i] = sums[2]
+            container.s_av = s_av
+            container.nCurves = nCurves
+        self.data.diff.ds_av = self.data.diff.s_av
+
+
+class OutlierSketch:
+    ''' Streaming version of the outlier identification of identifyOutliers_one
+    for the curves of one delay. It keeps a fixed-size sketch of the
+    distribution of the curves in every q bin, from which the trimmed average
+    and standard deviation (see getOutlierReference) are estimated, so every
+    new curve is judged on arrival with work independent of the number of
+    curves already seen.
+
+    The first nWarmup curves are kept as they are and the reference is
+    calculated from them exactly. Then, for every q bin, a histogram with nBins
+    bins spanning +/- width trimmed standard deviations around the trimmed
+    average of the warm-up curves (plus two bins for the values outside) is
+    filled instead, and the trimmed statistics are taken from the histogram
+    (the values in a bin are assumed to be uniformly distributed).
+    '''
+
+    def __init__(self, q, fraction=0.9, chisqThresh=5, q_break=None, nWarmup=20, nBins=256, width=10):
+        self.q = q
+        self.fraction = fraction
+        self.chisqThresh, self.q_break = getChisqThresholds(q, chisqThresh, q_break)
+        self.nWarmup = nWarmup
+        self.nBins = nBins
+        self.width = width
+        self.n = 0
+        self.buffer = []  # warm-up curves
+        self.counts = None
+        self.yMin = np.full(q.size, np.inf)
+        self.yMax = np.full(q.size, -np.inf)
+
+    def add(self, y):
+        ''' Adds the curve y to the sketch and identifies whether it is an outlier
+        with respect to the curves seen so far (including y).
+        Returns isOutlier and chisq (see identifyOutliers_one).
+        '''
+        self.n += 1
+        self.yMin, self.yMax = np.minimum(self.yMin, y), np.maximum(self.yMax, y)
+        if self.counts is None:
+            self.buffer.append(y)
+            if self.n == self.nWarmup:
+                self._startHistogram()
+        else:
+            self._addToHistogram(y)
+
+        if self.n < 3:  # there is no meaningful spread yet
+            return False, np.zeros(self.chisqThresh.size)
+        isOutlier, chisq, _ = identifyOutliers_one(self.q, y[:, None], self.fraction, self.chisqThresh,
+                                                   self.q_break, reference=self.getReference())
+        return isOutlier[0], chisq[:, 0]
+
+    def getReference(self):
+        ''' Returns the estimates of the trimmed average and standard deviation.
+        '''
+        if self.counts is None:
+            return getOutlierReference(np.array(self.buffer).T, self.fraction)
+        low = int(np.round((1 - self.fraction) / 2 * self.n))
+        high = int(np.round((1 + self.fraction) / 2 * self.n))
+        cumCounts = np.cumsum(self.counts, axis=1)
+        # number of the values with ranks between low and high in every bin:
+        c = np.clip(np.minimum(cumCounts, high) - np.maximum(cumCounts - self.counts, low), 0, None)
+        nSel = max(high - low, 1)
+        y_av = np.sum(c * self.centers, axis=1) / nSel
+        y_var = (np.sum(c * (self.centers - y_av[:, None]) ** 2, axis=1) +
+                 np.sum(c[:, 1:-1], axis=1) * self.binWidth ** 2 / 12) / nSel
+        y_std = np.sqrt(y_var)
+        y_std[self.yMin == self.yMax] = 0  # constant (e.g. masked) q bins are excluded as in identifyOutliers_one
+        return y_av, y_std
+
+    def _startHistogram(self):
+        y_av, y_std = getOutlierReference(np.array(self.buffer).T, self.fraction)
+        y_std = np.where(y_std > 0, y_std, np.maximum(np.abs(y_av), 1) * 1e-6)
+        self.binWidth = 2 * self.width * y_std / self.nBins
+        self.lowEdge = y_av - self.width * y_std
+        # the values below/above the histogram range are put to its edges
+        self.centers = self.lowEdge[:, None] + self.binWidth[:, None] * np.hstack(
+            (0, np.arange(self.nBins) + 0.5, self.nBins))
+        self.counts = np.zeros((self.q.size, self.nBins + 2))
+        for y in self.buffer:
+            self._addToHistogram(y)
+        self.buffer = []
+
+    def _addToHistogram(self, y):
+        idx = np.floor((y - self.lowEdge) / self.binWidth).clip(-1, self.nBins) + 1
+        self.counts[np.arange(self.q.size), idx.astype(int)] += 1
+
+
+class _LogTail:
+    ''' Helper class for ScatDataStream: reads the new lines of a log file that
+    is being written and keeps the list of images waiting to be integrated.
+    '''
+
+    def __init__(self, logFile, dataInDir, logFileStyle):
+        self.logFile = logFile
+        self.dataInDir = dataInDir
+        self.logFileStyle = logFileStyle
+        self.scan = ntpath.splitext(ntpath.basename(logFile))[0]
+        if logFileStyle == 'id09_old':
+            self.columns = _get_id09_columns_old()
+        elif logFileStyle == 'id09':
+            self.columns = _get_id09_columns()
+        else:
+            self.columns = None  # read from the header line
+        self.position = 0
+        self.nLines = 0
+        self.buffer = ''
+        self.pending = deque()  # rows read from the log whose images are not integrated yet
+        self.waiting = []  # curves waiting for the next reference curve
+        self.lastOff = None
+
+    def readNewRows(self):
+        ''' Reads the lines appended to the log file since the previous call. An
+        incomplete last line is kept until the rest of it is written.
+        '''
+        if not Path(self.logFile).is_file():
+            return
+        with open(self.logFile, 'r') as f:
+            f.seek(self.position)
+            text = self.buffer + f.read()
+            self.position = f.tell()
+        lines = text.split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.nLines += 1
+            row = self._parseLine(line.rstrip('\r'))
+            if row is not None:
+                self.pending.append(row)
+
+    def _parseLine(self, line):
+        '''Parses a log line in the same way as ScatData._getLogData. Returns a
+        dict or None for the header, footer and incomplete lines.
+        '''
+        if self.logFileStyle == 'biocars':
+            if line.startswith('#date time'):
+                self.columns = line.split('\t')
+                return None
+            if (self.columns is None) or line.startswith('#'):
+                return None
+            values = line.split('\t')
+            if len(values) != len(self.columns):
+                return None
+            values = dict(zip(self.columns, values))
+            timeStamp_str = values['#date time']
+            delay_str = values['delay']
+            delay = time_str2num(delay_str)
+            file = values['file']
+        else:
+            if self.nLines == 1:  # skiprows=1
+                return None
+            values = [i.strip() for i in line.split('\t')]
+            if len(values) != len(self.columns):  # footer
+                return None
+            values = dict(zip(self.columns, values))
+            timeStamp_str = values['date'] + ' ' + values['time']
+            try:
+                delay = float(values['delay'])
+            except ValueError:
+                return None
+            delay_str = time_num2str(delay)
+            if self.logFileStyle == 'id09_old':
+                file = values['file'].replace('ccdraw', 'edf')
+            else:
+                file = values['file'] + '.edf'
+        try:
+            timeStamp = datetime.strptime(timeStamp_str, '%d-%b-%y %H:%M:%S').timestamp()
+        except ValueError:
+            return None
+        return {'file': file, 'dataInDir': self.dataInDir, 'delay': delay, 'delay_str': delay_str,
+                'timeStamp': timeStamp, 'timeStamp_str': timeStamp_str, 'Scan': self.scan,
+                'size': None, 'firstSeen': time.monotonic()}
+
+    def popReadyRows(self, missingTimeout=60):
+        ''' Returns the pending rows (in the log order) whose images are completely
+        written, i.e. whose size did not change since the previous call. An
+        image which did not appear within missingTimeout seconds is excluded.
+        '''
+        ready = []
+        while self.pending:
+            row = self.pending[0]
+            try:
+                size = os.stat(row['dataInDir'] + row['file']).st_size
+            except FileNotFoundError:
+                if time.monotonic() - row['firstSeen'] > missingTimeout:
+                    print(row['dataInDir'] + row['file'], 'does not exist and will be excluded from analysis')
+                    self.pending.popleft()
+                    continue
+                break
+            if (size == 0) or (size != row['size']):
+                row['size'] = size
+                break
+            ready.append(self.pending.popleft())
+        return ready
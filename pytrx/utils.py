@@ -5,12 +5,123 @@ Created on Wed Mar 25 21:10:16 2020
 @author: dleshchev
 """
 
+import os
+import sys
+import functools
+import importlib
 import numpy as np
-import matplotlib.pyplot as plt
+from datetime import datetime, timedelta
 from scipy.linalg import solveh_banded
 # from pytrx.transformation import *
 
 
+class LazyModule:
+    ''' Placeholder for a module which is imported on the first access to one of
+    its attributes (see lazy_import).
+    '''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        if attr in ('_name', '_module'):  # not set yet (e.g. during unpickling)
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self._name
+
+
+def lazy_import(name):
+    ''' Module-level replacement of "import name" for heavy dependencies: the module
+    is imported when its attribute is accessed for the first time. If the module
+    is already imported, it is returned as is.
+        Input: module name, e.g. 'matplotlib.pyplot'
+        Output: module or LazyModule
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+# heavy dependencies are imported on first use
+pd = lazy_import('pandas')
+plt = lazy_import('matplotlib.pyplot')
+
+
+def lazy_njit(*args, **options):
+    ''' Replacement of numba.njit which imports numba and compiles the function on
+    its first call. Can be used as @lazy_njit or @lazy_njit(parallel=True). The
+    lazily imported modules used by the function (e.g. numba for numba.prange)
+    are imported before the compilation, as numba needs the modules themselves.
+    '''
+    def decorator(func):
+        compiled = []
+
+        @functools.wraps(func)
+        def wrapper(*fargs):
+            if not compiled:
+                import numba
+                for name in func.__code__.co_names:
+                    if isinstance(func.__globals__.get(name), LazyModule):
+                        func.__globals__[name] = func.__globals__[name]._load()
+                compiled.append(numba.njit(**options)(func))
+            return compiled[0](*fargs)
+        return wrapper
+
+    if args and callable(args[0]):
+        return decorator(args[0])
+    return decorator
+
+
+# modules which are not supposed to be imported together with pytrx.scatdata and pytrx.scatsim
+heavy_modules = ['pyFAI', 'fabio', 'matplotlib', 'h5py', 'numba', 'scipy.io', 'scipy.signal', 'covar',
+                 'mpl_toolkits', 'asyncio', 'pkg_resources']
+
+
+def benchmarkImportTime(modules=('pytrx.scatdata', 'pytrx.scatsim'), heavyModules=None, nRepeats=3,
+                        maxTime=None):
+    ''' Measures the import time of pytrx modules in fresh python processes and
+    checks that the heavy dependencies are not imported with them (they are
+    loaded on first use via lazy_import).
+
+    You need:
+    modules - pytrx modules to import
+    heavyModules - modules which should not be imported (default is heavy_modules)
+    nRepeats - number of measurements per module (the best is reported)
+    maxTime - if provided, the largest allowed import time in s
+
+    Output:
+    dictionary with the import times in s
+    '''
+    import subprocess
+    if heavyModules is None:
+        heavyModules = heavy_modules
+    script = ('import sys, time; t = time.perf_counter(); import %s; t = time.perf_counter() - t; '
+              'print(t); print(" ".join(m for m in %r if m in sys.modules))')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))  # same module search path
+    importTimes = {}
+    for module in modules:
+        times = []
+        for i in range(nRepeats):
+            out = subprocess.run([sys.executable, '-c', script % (module, list(heavyModules))],
+                                 capture_output=True, text=True, check=True, env=env).stdout.splitlines()
+            times.append(float(out[0]))
+            imported = out[1].split() if len(out) > 1 else []
+            assert not imported, '%s imports %s at import time' % (module, ', '.join(imported))
+        importTimes[module] = min(times)
+        print('%s: %0.3f s' % (module, importTimes[module]))
+        if maxTime is not None:
+            assert importTimes[module] < maxTime, \
+                '%s imports in %0.3f s (more than %0.3f s)' % (module, importTimes[module], maxTime)
+    return importTimes
+
 
 class DataContainer:
     # dummy class to store the data
@@ -94,6 +205,98 @@ def time_num2str(t):
     return t_str
 
 
+def _apply_to_unique(func, x):
+    ''' Applies func to every element of x, calling it once per unique value
+    (missing values included), and returns a numpy array.
+    '''
+    codes, uniques = pd.factorize(np.asarray(x, dtype=object).ravel())
+    values = [func(u) for u in uniques.tolist()] + [func(np.nan)]  # code -1 (missing) takes the last one
+    return np.array(values)[codes].reshape(np.shape(x))
+
+
+def time_str2num_array(t_str):
+    ''' Vectorized time_str2num for arrays of time delay strings, e.g. the delay
+    column of a log file. Every unique string is converted once.
+        Input: array (or list, pandas Series) of time delay strings
+        Output: array of times in s
+    '''
+    return _apply_to_unique(time_str2num, t_str).astype(float)
+
+
+def time_num2str_array(t):
+    ''' Vectorized time_num2str for arrays of time delays. Every unique delay is
+    converted once.
+        Input: array (or list, pandas Series) of time delays in s
+        Output: array of time strings
+    '''
+    return _apply_to_unique(time_num2str, t).astype(str)
+
+
+def timestamp_str2num_array(timeStamp_str, fmt='%d-%b-%y %H:%M:%S'):
+    ''' Vectorized conversion of time stamp strings to epoch time, the same as
+    datetime.strptime(x, fmt).timestamp() (local time) for every element. The
+    time stamps of the default format written by the log files are parsed with
+    numpy arithmetic on the characters (see _parse_timestamps_fixed), other
+    formats with pandas; the local time offset is obtained once per unique
+    minute.
+        Input: array (or list, pandas Series) of time stamp strings
+        Output: array of epoch times in s
+    '''
+    naive = None  # seconds since epoch, taking the time stamps as UTC
+    if fmt == '%d-%b-%y %H:%M:%S':
+        naive = _parse_timestamps_fixed(timeStamp_str)
+    if naive is None:
+        dt = pd.Series(pd.to_datetime(pd.Series(np.asarray(timeStamp_str, dtype=object)), format=fmt))
+        naive = ((dt - pd.Timestamp(1970, 1, 1)) / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+
+    minutes, inverse = np.unique(np.floor(naive / 60) * 60, return_inverse=True)
+    offsets = np.array([(datetime(1970, 1, 1) + timedelta(seconds=minute)).timestamp() - minute
+                        for minute in minutes.tolist()])
+    return naive + offsets[inverse]
+
+
+_month_codes = np.array([(ord(m[0]) << 16) | (ord(m[1]) << 8) | ord(m[2])  # 3 letters as integers
+                         for m in ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                                   'jul', 'aug', 'sep', 'oct', 'nov', 'dec']], dtype=np.uint32)
+
+
+def _parse_timestamps_fixed(timeStamp_str):
+    ''' Parses time stamps of the form 'dd-Mon-yy HH:MM:SS' (zero-padded, English
+    month names) as numbers. Returns the seconds since epoch (taking the time
+    stamps as UTC) or None if any of the strings is not of this form.
+    '''
+    try:
+        b = np.asarray(timeStamp_str, dtype='S').ravel()
+    except (UnicodeEncodeError, ValueError, TypeError):
+        return None
+    if (b.size == 0) or (b.dtype.itemsize != 18):
+        return None
+    c = b.view(np.uint8).reshape(-1, 18)
+    if np.any(c[:, 17] == 0):  # shorter strings
+        return None
+    if not (np.all(c[:, [2, 6]] == ord('-')) and np.all(c[:, 9] == ord(' ')) and np.all(c[:, [12, 15]] == ord(':'))):
+        return None
+    d = c[:, [0, 1, 7, 8, 10, 11, 13, 14, 16, 17]].astype(np.int64) - ord('0')
+    if np.any((d < 0) | (d > 9)):
+        return None
+    day, year, hour, minute, second = (d[:, 0::2] * 10 + d[:, 1::2]).T
+    year = np.where(year < 69, 2000 + year, 1900 + year)  # as %y of strptime
+
+    # month names (case insensitive) as integers looked up among the sorted codes of the names
+    letters = (c[:, 3:6] | 0x20).astype(np.uint32)
+    codes = (letters[:, 0] << 16) | (letters[:, 1] << 8) | letters[:, 2]
+    order = np.argsort(_month_codes)
+    idx = np.minimum(np.searchsorted(_month_codes[order], codes), 11)
+    if np.any(_month_codes[order][idx] != codes) or np.any(hour > 23) or np.any(minute > 59) or np.any(second > 59):
+        return None
+    month = order[idx] + 1
+    monthStart = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    date = monthStart.astype('datetime64[D]') + (day - 1)
+    if np.any(day < 1) or np.any(date.astype('datetime64[M]') != monthStart):  # e.g. 30-Feb
+        return None
+    return (date.astype(np.int64) * 86400 + hour * 3600 + minute * 60 + second).astype(float)
+
+
 def convert_banded(x):
     n, m = x.shape
     assert n == m, 'matrix must be squared'
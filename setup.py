@@ -1,4 +1,32 @@
-from setuptools import setup, find_packages
+import sys
+from setuptools import setup, find_packages, Extension
+from setuptools.command.build_ext import build_ext
+
+try:
+    from Cython.Build import cythonize
+    # covar is imported as a top-level module (see pytrx/scatdata.py)
+    ext_modules = cythonize([Extension('covar', ['pytrx/covar.pyx'])])
+except ImportError:  # covar.pyx has to be compiled separately
+    ext_modules = []
+
+
+class BuildExt(build_ext):
+    ''' Compiles the extensions with OpenMP where the compiler supports it out of
+    the box; otherwise the prange loops of covar run serially.
+    '''
+
+    def build_extensions(self):
+        if self.compiler.compiler_type == 'msvc':
+            compileArgs, linkArgs = ['/openmp'], []
+        elif sys.platform == 'darwin':  # Apple clang comes without libomp
+            compileArgs, linkArgs = [], []
+        else:
+            compileArgs, linkArgs = ['-fopenmp'], ['-fopenmp']
+        for ext in self.extensions:
+            ext.extra_compile_args += compileArgs
+            ext.extra_link_args += linkArgs
+        super().build_extensions()
+
 
 setup(
     name='pytrx',
@@ -11,11 +39,14 @@ setup(
     description='toolbox for analysis of time-resolved x-ray experiments',
     long_description=open('README.md').read(),
     include_package_data=True,
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': BuildExt},
 	install_requires=[
         "numpy",
         "fabio",
 		"pandas",
 		"matplotlib",
 		"scipy",
+		"numba",
     ],
 )
\ No newline at end of file
@@ -0,0 +1,77 @@
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+fabio = pytest.importorskip('fabio')
+
+delays = ['-5us', '100ps', '1ns', '-5us', '10ns']
+
+
+def makeImage(rng, delay, shape=(64, 64)):
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]]
+    r = np.hypot(yy - 32.3, xx - 31.7)
+    base = 1000 * np.exp(-r / 40) * (1 + 0.01 * (delay != '-5us') * np.sin(r / 3))
+    return rng.poisson(base * (1 + 0.05 * rng.standard_normal())).astype(np.float32)
+
+
+def writeScan(directory, scan, nImages, rng, firstDelay=0, fileNames=None):
+    ''' Writes nImages EDF images and a biocars log file <scan>.log into directory.
+    Returns the path of the log file and the images.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    lines = ['# header line %d' % i for i in range(18)] + ['#date time\tdelay\tfile']
+    t0 = datetime(2020, 3, 1, 10, 0, 0)
+    images = []
+    for i in range(nImages):
+        delay = delays[(i + firstDelay) % len(delays)]
+        image = makeImage(rng, delay)
+        fileName = fileNames[i] if fileNames else 'img_%04d.edf' % i
+        fabio.edfimage.EdfImage(data=image).write(os.path.join(directory, fileName))
+        images.append(image)
+        timeStamp = (t0 + timedelta(seconds=7 * i)).strftime('%d-%b-%y %H:%M:%S')
+        lines.append('%s\t%s\t%s' % (timeStamp, delay, fileName))
+    logFile = os.path.join(directory, scan + '.log')
+    with open(logFile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return logFile, np.array(images)
+
+
+class Dataset:
+    ''' Two scans of synthetic 64x64 BioCARS images with a mask. '''
+
+    def __init__(self, root, nImages=20):
+        rng = np.random.default_rng(0)
+        self.root = str(root)
+        self.logFiles, self.dataInDirs, self.images = [], [], []
+        for scan in ['run1', 'run2']:
+            directory = os.path.join(self.root, scan) + os.sep
+            logFile, images = writeScan(directory, scan, nImages, rng)
+            self.logFiles.append(logFile)
+            self.dataInDirs.append(directory)
+            self.images.append(images)
+        mask = np.zeros((64, 64), dtype=np.int8)
+        mask[:3, :] = 1
+        self.maskPath = os.path.join(self.root, 'mask.edf')
+        fabio.edfimage.EdfImage(data=mask).write(self.maskPath)
+        self.integration = dict(energy=12, distance=10, pixelSize=80e-6, centerX=32, centerY=32,
+                                qRange=[0.1, 1.8], nqpt=50, qNormRange=[0.5, 1.5], maskPath=self.maskPath,
+                                plotting=False)
+
+    def getScatData(self, **kwargs):
+        from pytrx.scatdata import ScatData
+        return ScatData(list(self.logFiles), dataInDir=list(self.dataInDirs), **kwargs)
+
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+    return Dataset(tmp_path_factory.mktemp('data'))
+
+
+@pytest.fixture(autouse=True)
+def cacheDir(tmp_path, monkeypatch):
+    ''' Keeps the operators, curves and log caches of the tests out of ~/.pytrx. '''
+    import pytrx.caches
+    monkeypatch.setattr(pytrx.caches, 'default_cache_dir', tmp_path / 'pytrx_cache')
+    return tmp_path / 'pytrx_cache'
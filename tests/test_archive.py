@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from pytrx.imageio import ImageArchive
+
+h5py = pytest.importorskip('h5py')
+
+
+@pytest.mark.parametrize('compression, chunkFrames', [('gzip', 1), ('lzf', 4), (None, 8)])
+def test_archive_integration(dataset, tmp_path, compression, chunkFrames):
+    archivePath = str(tmp_path / 'archive.h5')
+    data = dataset.getScatData()
+    data.archiveImages(archivePath, compression=compression, chunkFrames=chunkFrames)
+
+    with h5py.File(archivePath, 'r') as f:
+        assert f['images'].shape == (40, 64, 64)
+        assert f['images'].compression == compression
+        assert f['images'].chunks[0] == chunkFrames
+        np.testing.assert_array_equal(f['images'][:20], dataset.images[0])
+        np.testing.assert_array_equal(f['images'][20:], dataset.images[1])
+        assert list(f['file'].asstr()[:3]) == ['img_0000.edf', 'img_0001.edf', 'img_0002.edf']
+
+    ref = dataset.getScatData()
+    ref.integrate(**dataset.integration)
+    data.integrate(archivePath=archivePath, **dataset.integration)
+    np.testing.assert_array_equal(data.total.s_raw, ref.total.s_raw)
+    np.testing.assert_array_equal(data.total.normInt, ref.total.normInt)
+    np.testing.assert_allclose(data.imageAv, ref.imageAv, rtol=1e-6)
+
+
+def test_archive_prefetch(dataset, tmp_path):
+    archivePath = str(tmp_path / 'archive.h5')
+    data = dataset.getScatData()
+    data.archiveImages(archivePath, chunkFrames=4, prefetch=2)
+
+    archive = ImageArchive(archivePath, blockBytes=3 * 64 * 64 * 4)
+    impaths = ['a%d' % i for i in range(40)]
+    archive.frames = dict(zip(impaths, range(40)))
+    order = impaths[5:30] + impaths[:5] + impaths[35:]
+    images = np.concatenate(dataset.images)
+    for prefetch in [None, 2]:
+        read = [image for image, _ in archive.readImages(order, prefetch=prefetch)]
+        np.testing.assert_array_equal(read, images[[int(name[1:]) for name in order]])
+    archive.close()
+
+
+def test_archive_missing_images(dataset, tmp_path):
+    archivePath = str(tmp_path / 'archive.h5')
+    data = dataset.getScatData()
+    data.logData = data.logData.iloc[:10]
+    data.archiveImages(archivePath)
+    with pytest.raises(AssertionError, match='not in the archive'):
+        dataset.getScatData().integrate(archivePath=archivePath, **dataset.integration)
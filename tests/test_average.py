@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from pytrx.scatdata import ScatData, getAverage, mergeScatData
+
+averaging = dict(chisqThresh=1e9, dezinger=False, plotting=False)  # no outliers
+
+
+def reduce(data, dataset):
+    data.integrate(**dataset.integration)
+    data.getTotalAverages(**averaging)
+    data.getDifferences()
+
+
+def test_append_scan(dataset):
+    appended = ScatData(dataset.logFiles[0], dataInDir=dataset.dataInDirs[0])
+    reduce(appended, dataset)
+    appended.getDiffAverages(covShrinkage=0.1, **averaging)
+    appended.appendScan(dataset.logFiles[1], dataInDir=dataset.dataInDirs[1])
+
+    full = dataset.getScatData()
+    reduce(full, dataset)
+    # the last reference of the first scan is excluded as at the end of a scan (see getDifferences)
+    last = np.where((full.diff.delay_str == '-5us') & (full.diff.scanStamp == 'run1'))[0][-1]
+    full.diff.isOutlier[last] = True
+    keep = np.ones(full.nFiles)
+    keep[last] = 0
+    full.diff.covii = (sparse.diags(keep) @ full.diff.covii @ sparse.diags(keep) +
+                       sparse.csr_matrix(([full.diff.covii[last, last]], ([last], [last])),
+                                         shape=full.diff.covii.shape)).tocsr()
+    full.getDiffAverages(covShrinkage=0.1, **averaging)
+
+    for kind in ['total', 'diff']:
+        a, b = getattr(appended, kind), getattr(full, kind)
+        np.testing.assert_array_equal(a.isOutlier, b.isOutlier)
+        np.testing.assert_allclose(a.s, b.s, rtol=1e-12, atol=1e-12 * np.abs(b.s).max())
+        for key in ['s_av', 's_err', 'covtt', 'covqq']:
+            x, y = getattr(a, key), getattr(b, key)
+            np.testing.assert_allclose(x, y, rtol=1e-10, atol=1e-10 * np.abs(y).max(), err_msg=kind + '.' + key)
+
+
+def test_merge(dataset, tmp_path):
+    scans = []
+    for logFile, dataInDir in zip(dataset.logFiles, dataset.dataInDirs):
+        data = ScatData(logFile, dataInDir=dataInDir)
+        reduce(data, dataset)
+        scans.append(data)
+    savePath = str(tmp_path / 'run2.h5')
+    scans[1].save(savePath)
+    merged = mergeScatData([scans[0], savePath], totalAverages=averaging,
+                           diffAverages=dict(covShrinkage=0.1, **averaging))
+
+    # the same as appending the second scan to the first one
+    appended = ScatData(dataset.logFiles[0], dataInDir=dataset.dataInDirs[0])
+    reduce(appended, dataset)
+    appended.getDiffAverages(covShrinkage=0.1, **averaging)
+    appended.appendScan(dataset.logFiles[1], dataInDir=dataset.dataInDirs[1])
+
+    assert list(merged.t_str) == list(appended.t_str)
+    np.testing.assert_array_equal(merged.total.scanStamp, appended.total.scanStamp)
+    for kind in ['total', 'diff']:
+        a, b = getattr(merged, kind), getattr(appended, kind)
+        np.testing.assert_array_equal(a.isOutlier, b.isOutlier)
+        np.testing.assert_allclose(a.covii.toarray(), b.covii.toarray(), rtol=1e-12)
+        for key in ['s', 's_av', 's_err', 'covtt', 'covqq']:
+            x, y = getattr(a, key), getattr(b, key)
+            np.testing.assert_allclose(x, y, rtol=1e-10, atol=1e-10 * np.abs(y).max(), err_msg=kind + '.' + key)
+
+
+def test_merge_rebinning(dataset):
+    coarse = ScatData(dataset.logFiles[0], dataInDir=dataset.dataInDirs[0])
+    reduce(coarse, dataset)
+    fine = ScatData(dataset.logFiles[1], dataInDir=dataset.dataInDirs[1])
+    fine.integrate(**{**dataset.integration, 'nqpt': 100, 'qRange': [0.05, 2.0]})
+    fine.getTotalAverages(**averaging)
+    fine.getDifferences()
+
+    merged = mergeScatData([coarse, fine], diffAverages=dict(covShrinkage=0.1))
+    np.testing.assert_array_equal(merged.q, coarse.q)
+    assert merged.total.s.shape == (coarse.q.size, 40)
+    np.testing.assert_array_equal(merged.total.s[:, :20], coarse.total.s)
+    assert merged.diff.s_av.shape == (coarse.q.size, merged.t_str.size)
+
+
+def averageReference(x, covii, delay_str, t_str, toff_str, covShrinkage):
+    ''' The averaging with the pseudo-inverse as it was done before the grouped sums. '''
+    Amean = (delay_str[None, :] == t_str[:, None]).astype(float)
+    covii_diag_inv = np.diag(1 / np.diag(covii))
+    H = np.linalg.pinv(Amean @ covii_diag_inv @ Amean.T) @ Amean @ covii_diag_inv
+    x_av = (H @ x.T).T
+    covtt = H @ covii @ H.T
+    dx = ((x - x_av @ Amean) @ np.sqrt(covii_diag_inv))[:, delay_str != toff_str]
+    dxdxt = dx @ dx.T
+    covqq = (dxdxt * (1 - covShrinkage) + np.diag(np.diag(dxdxt)) * covShrinkage) / (dx.shape[1] - t_str.size)
+    return x_av, covtt, covqq
+
+
+def test_average_matches_pinv():
+    rng = np.random.default_rng(0)
+    q = np.linspace(0.1, 4, 40)
+    delay_str = np.array(['-5us', '100ps', '1ns'] * 10)
+    t_str = np.array(['-5us', '100ps', '1ns', '10ns'])  # no curves of 10ns
+    x = np.exp(-q)[:, None] + 0.01 * rng.standard_normal((q.size, delay_str.size))
+    weights = rng.uniform(0.5, 2, delay_str.size)
+    covii = sparse.diags([weights, -0.3 * weights[1:], -0.3 * weights[1:]], [0, 1, -1], format='csr')
+
+    x_av, x_err, isOutlier, covtt, covqq, chisq = getAverage(
+        q, x, covii, np.zeros(delay_str.size, dtype=bool), delay_str, t_str, '-5us', 0.9, 1e9,
+        dezinger=False, covShrinkage=0.1)
+    x_avRef, covttRef, covqqRef = averageReference(x, covii.toarray(), delay_str, t_str, '-5us', 0.1)
+    assert not np.any(isOutlier)
+    np.testing.assert_allclose(x_av, x_avRef, rtol=1e-12, atol=1e-14)
+    np.testing.assert_array_equal(x_av[:, 3], 0)
+    np.testing.assert_allclose(covtt, covttRef, rtol=1e-12, atol=1e-14)
+    np.testing.assert_allclose(covqq, covqqRef, rtol=1e-10, atol=1e-16)
+
+
+@pytest.mark.parametrize('q_break', [None, 1.0])
+def test_outliers_with_workers(dataset, q_break):
+    data = dataset.getScatData()
+    data.integrate(**dataset.integration)
+    data.total.s[:, 7] *= 1 + 0.2 * np.sin(data.q * 10)  # one distorted curve
+    results = []
+    for workers in [None, 3]:
+        data.total.isOutlier = np.zeros(data.nFiles, dtype=bool)
+        data.getTotalAverages(plotting=False, q_break=q_break, workers=workers)
+        results.append({key: np.copy(getattr(data.total, key)) for key in ['s_av', 's_err', 'isOutlier', 'chisq']})
+    assert results[0]['isOutlier'][7]
+    for key in results[0]:
+        np.testing.assert_array_equal(results[1][key], results[0][key], err_msg=key)
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+import pytest
+
+import pytrx.scatdata
+
+
+class Preempted(Exception):
+    pass
+
+
+def crashAfter(monkeypatch, nImages):
+    readImages = pytrx.scatdata.readImages
+
+    def crashing(impaths, *args, **kwargs):
+        for n, image in enumerate(readImages(impaths, *args, **kwargs)):
+            if n == nImages:
+                raise Preempted
+            yield image
+    monkeypatch.setattr(pytrx.scatdata, 'readImages', crashing)
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_resume(dataset, tmp_path, monkeypatch, workers):
+    reference = dataset.getScatData()
+    reference.integrate(**dataset.integration)
+
+    checkpointPath = str(tmp_path / 'checkpoint.h5')
+    data = dataset.getScatData()
+    crashAfter(monkeypatch, 25)
+    with pytest.raises(Preempted):
+        data.integrate(checkpointPath=checkpointPath, checkpointEvery=10, **dataset.integration)
+    assert os.path.isfile(checkpointPath)
+    monkeypatch.undo()
+
+    done = []
+    integrateSerial = pytrx.scatdata.ScatData._integrateSerial
+
+    def _integrateSerial(self, impaths, todo, *args, **kwargs):
+        done.append(todo.size)
+        return integrateSerial(self, impaths, todo, *args, **kwargs)
+    monkeypatch.setattr(pytrx.scatdata.ScatData, '_integrateSerial', _integrateSerial)
+    data = dataset.getScatData()
+    data.integrate(checkpointPath=checkpointPath, resume=True, workers=workers, **dataset.integration)
+    if workers is None:
+        assert done == [40 - 20]  # the images up to the last checkpoint are not integrated again
+    assert not os.path.isfile(checkpointPath)
+    np.testing.assert_array_equal(data.total.s_raw, reference.total.s_raw)
+    np.testing.assert_allclose(data.imageAv, reference.imageAv, rtol=1e-6)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+covar = pytest.importorskip('covar')
+
+
+def correlatedData(n, p, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((n, p))
+    x[:, 1:] += 0.5 * x[:, :-1]
+    return x
+
+
+def covShrinkSSReference(X):
+    ''' The Schafer and Strimmer estimate as computed before the BLAS rewrite:
+    the variance of r_ij is summed over the data points explicitly. '''
+    n, p = X.shape
+    X_meaned = X - X.mean(axis=0)
+    X_std = X.std(axis=0)
+    w_ij_bar = X_meaned.T @ X_meaned / n
+    r = n / (n - 1.0) * w_ij_bar / np.outer(X_std, X_std)
+    w = X_meaned[:, :, None] * X_meaned[:, None, :]
+    var_r = ((w - w_ij_bar) ** 2).sum(axis=0) * n / ((n - 1.0) ** 3 * np.outer(X_std, X_std) ** 2)
+    offDiagonal = ~np.eye(p, dtype=bool)
+    gamma = max(0, min(1, var_r[offDiagonal].sum() / (r[offDiagonal] ** 2).sum()))
+    S = n / (n - 1.0) * w_ij_bar
+    return (1 - gamma) * S + gamma * np.diag(np.diag(S)), gamma
+
+
+def covShrinkRBLWReference(S, n):
+    p = S.shape[0]
+    alpha = (n - 2) / (n * (n + 2))
+    beta = ((p + 1) * n - 2) / (n * (n + 2))
+    U = p * np.trace(S @ S) / np.trace(S) ** 2 - 1
+    rho = min(alpha + beta / U, 1)
+    return (1 - rho) * S + rho * np.trace(S) / p * np.eye(p), rho
+
+
+def test_cov_shrink_ss():
+    X = correlatedData(200, 30)
+    cov, gamma = covar.cov_shrink_ss(X)
+    covRef, gammaRef = covShrinkSSReference(X)
+    assert 0 < gamma < 1
+    assert gamma == pytest.approx(gammaRef, rel=1e-12)
+    np.testing.assert_allclose(cov, covRef, rtol=1e-12, atol=1e-15)
+
+
+def test_cov_shrink_ss_fixed_shrinkage():
+    X = correlatedData(50, 10)
+    cov, gamma = covar.cov_shrink_ss(X, shrinkage=0.3)
+    S = np.cov(X.T)
+    assert gamma == 0.3
+    np.testing.assert_allclose(cov, 0.7 * S + 0.3 * np.diag(np.diag(S)), rtol=1e-12, atol=1e-15)
+
+
+def test_cov_shrink_ss_subsample():
+    X = correlatedData(4000, 20)
+    _, gamma = covar.cov_shrink_ss(X)
+    _, gammaSub = covar.cov_shrink_ss(X, subsample=1000)
+    assert gammaSub == pytest.approx(gamma, rel=0.2)
+    assert covar.cov_shrink_ss(X, subsample=1000)[1] == gammaSub  # fixed seed
+
+
+def test_cov_shrink_rblw():
+    n = 40
+    S = np.cov(correlatedData(n, 30).T)
+    cov, rho = covar.cov_shrink_rblw(S, n)
+    covRef, rhoRef = covShrinkRBLWReference(S, n)
+    assert 0 < rho < 1
+    assert rho == pytest.approx(rhoRef, rel=1e-12)
+    np.testing.assert_allclose(cov, covRef, rtol=1e-12)
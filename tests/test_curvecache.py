@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+import pytrx.scatdata
+from conftest import makeImage, writeScan
+
+fabio = pytest.importorskip('fabio')
+
+
+@pytest.fixture
+def scan(tmp_path):
+    directory = str(tmp_path / 'run1') + os.sep
+    logFile, _ = writeScan(directory, 'run1', 12, np.random.default_rng(1))
+    return logFile, directory
+
+
+@pytest.fixture
+def integrated(monkeypatch):
+    ''' Records the indices of the images integrated by ScatData._integrateSerial. '''
+    calls = []
+    integrateSerial = pytrx.scatdata.ScatData._integrateSerial
+
+    def _integrateSerial(self, impaths, todo, *args, **kwargs):
+        calls.append(list(todo))
+        return integrateSerial(self, impaths, todo, *args, **kwargs)
+    monkeypatch.setattr(pytrx.scatdata.ScatData, '_integrateSerial', _integrateSerial)
+    return calls
+
+
+def integrate(scan, dataset, **kwargs):
+    data = pytrx.scatdata.ScatData(scan[0], dataInDir=scan[1])
+    data.integrate(**dict(dataset.integration, **kwargs))
+    return data
+
+
+def test_cache_hit(scan, dataset, tmp_path, integrated):
+    reference = integrate(scan, dataset)
+    first = integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves')
+    second = integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves')
+    assert integrated == [list(range(12)), list(range(12))]  # the last run is served from the cache
+    for data in [first, second]:
+        np.testing.assert_array_equal(data.q, reference.q)
+        np.testing.assert_array_equal(data.total.s, reference.total.s)
+        np.testing.assert_allclose(data.imageAv, reference.imageAv, rtol=1e-12)
+
+
+def test_modified_image_is_integrated_again(scan, dataset, tmp_path, integrated):
+    integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves')
+    image = makeImage(np.random.default_rng(2), '1ns') + 100
+    fabio.edfimage.EdfImage(data=image).write(scan[1] + 'img_0005.edf')
+    cached = integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves')
+    assert integrated[-1] == [5]
+    reference = integrate(scan, dataset)
+    np.testing.assert_array_equal(cached.total.s, reference.total.s)
+    # the sum of the other images was not stored for this set, so imageAv is the integrated image
+    image[:3] = 0
+    np.testing.assert_allclose(cached.imageAv, image, rtol=1e-6)
+
+
+def test_cache_by_content(scan, dataset, tmp_path, integrated):
+    integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves', cacheByContent=True)
+    os.utime(scan[1] + 'img_0003.edf', (0, 0))  # a new modification time, the same content
+    integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves', cacheByContent=True)
+    assert len(integrated) == 1
+
+
+def test_first_files_then_all(scan, dataset, tmp_path, integrated):
+    integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves', nFiles=5)
+    cached = integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves')
+    assert integrated[-1] == list(range(5, 12))
+    reference = integrate(scan, dataset)
+    np.testing.assert_array_equal(cached.total.s, reference.total.s)
+
+
+def test_cache_keeps_the_precision(scan, dataset, tmp_path, integrated):
+    kwargs = dict(useOperator=True, operatorDir=tmp_path / 'operators')
+    reference = integrate(scan, dataset, **kwargs)
+    integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves', **kwargs)
+    cached = integrate(scan, dataset, useCache=True, cacheDir=tmp_path / 'curves', **kwargs)
+    assert len(integrated) == 2
+    np.testing.assert_array_equal(cached.total.s_raw, reference.total.s_raw)
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope='module')
+def integrated(dataset):
+    data = dataset.getScatData()
+    data.integrate(useOperator=True, operatorDir=dataset.root + '/operators', **dataset.integration)
+    return data
+
+
+def test_first_image_is_a_reference(integrated):
+    ''' Image 0 of the data is a -5us image; the next images of the scan are
+    subtracted with it as the previous reference. '''
+    data = integrated
+    s = data.total.s
+    assert data.total.delay_str[0] == '-5us' and data.total.delay_str[3] == '-5us'
+    data.getDifferences(subtractFlag='Previous')
+    np.testing.assert_allclose(data.diff.s[:, 1], s[:, 1] - s[:, 0], atol=1e-12)
+    np.testing.assert_allclose(data.diff.s[:, 2], s[:, 2] - s[:, 0], atol=1e-12)
+
+    data.getDifferences(subtractFlag='MovingAverage')  # images every 7 s: weights by the time to the references
+    np.testing.assert_allclose(data.diff.s[:, 1], s[:, 1] - (2 * s[:, 0] + s[:, 3]) / 3, atol=1e-12)
+    np.testing.assert_allclose(data.diff.s[:, 2], s[:, 2] - (s[:, 0] + 2 * s[:, 3]) / 3, atol=1e-12)
+
@@ -0,0 +1,72 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from pytrx.distributed import DistributedReduction
+
+pytest.importorskip('h5py')
+
+differences = dict(toff_str='-5us', subtractFlag='MovingAverage')
+diffAverages = dict(covShrinkage=0.1)
+
+
+def prepare(dataset, jobDir, **kwargs):
+    job = DistributedReduction(jobDir, **kwargs)
+    integration = {key: value for key, value in dataset.integration.items() if key != 'plotting'}
+    job.prepare(dataset.logFiles, dataset.dataInDirs, shardSize=12, integration=integration,
+                differences=differences, diffAverages=diffAverages)
+    return job
+
+
+def test_distributed_reduction(dataset, tmp_path):
+    job = prepare(dataset, tmp_path / 'job', staleTimeout=5, heartbeatInterval=1)
+    assert len(job._readJob()['shards']) == 4  # 12 + 8 images per scan
+
+    # a shard abandoned by a dead worker is claimed again
+    lock = job._getPath(2, '.lock.1')
+    lock.write_text('deadWorker')
+    os.utime(lock, (time.time() - 100,) * 2)
+
+    assert sorted(job.runWorker('w0')) == [0, 1, 2, 3]
+    assert job.runWorker('w1') == []
+    assert not list((tmp_path / 'job').glob('*.lock.*'))
+    result = job.reduce(pollInterval=0.1, timeout=60)
+
+    full = dataset.getScatData()
+    full.integrate(**dataset.integration)
+    full.getTotalAverages(plotting=False)
+    full.getDifferences(**differences)
+    full.getDiffAverages(plotting=False, **diffAverages)
+
+    assert list(result.t_str) == list(full.t_str)
+    assert len(result.logData) == full.nFiles
+    np.testing.assert_allclose(result.imageAv, full.imageAv, rtol=1e-6)
+    for kind in ['total', 'diff']:
+        a, b = getattr(result, kind), getattr(full, kind)
+        np.testing.assert_array_equal(a.isOutlier, b.isOutlier)
+        for key in ['s', 's_av', 's_err', 'covtt', 'covqq']:
+            x, y = np.asarray(getattr(a, key)), getattr(b, key)
+            np.testing.assert_allclose(x, y, rtol=1e-10, atol=1e-10 * np.abs(y).max(), err_msg=kind + '.' + key)
+
+
+def test_distributed_waiting(dataset, tmp_path):
+    job = prepare(dataset, tmp_path / 'job')
+    job._getPath(0, '.lock.1').write_text('busyWorker')  # claimed by a living worker
+
+    assert sorted(job.runWorker('w0')) == [1, 2, 3]
+    with pytest.raises(AssertionError, match=r'shards \[0\] are not processed'):
+        job.reduce(wait=False)
+    with pytest.raises(AssertionError, match='were not processed in'):
+        job.reduce(pollInterval=0.1, timeout=0.2)
+
+
+def test_distributed_failed_shard(dataset, tmp_path):
+    job = DistributedReduction(tmp_path / 'job')
+    integration = dict(dataset.integration, maskPath=os.path.join(dataset.root, 'missing.edf'), plotting=False)
+    job.prepare(dataset.logFiles, dataset.dataInDirs, integration=integration)
+    assert job.runWorker('w0') == []
+    assert job._getPath(0, '.failed').is_file() and job._getPath(1, '.failed').is_file()
+    with pytest.raises(AssertionError, match='failed'):
+        job.reduce()
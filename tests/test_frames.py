@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+from pytrx.scatdata import ScatData
+
+h5py = pytest.importorskip('h5py')
+
+layouts = {'gzip': dict(compression='gzip', shuffle=True, chunks=(1, 64, 64)),
+           'gzip4': dict(compression='gzip', chunks=(4, 64, 64)),
+           'contiguous': dict(),
+           'lzf': dict(compression='lzf', chunks=(2, 64, 64))}
+
+
+def writeContainers(dataset, root, layout):
+    ''' Writes the images of every scan of the dataset into two containers: the
+    first 15 frames into an Eiger-style master_a.h5 (data_000001, data_000002),
+    referred to implicitly, and the rest into a NeXus master_b.nxs, referred to
+    as master_b.nxs::<frame>. '''
+    logFiles, dataInDirs = [], []
+    for logFile, images in zip(dataset.logFiles, dataset.images):
+        scan = os.path.splitext(os.path.basename(logFile))[0]
+        directory = os.path.join(root, scan) + os.sep
+        os.makedirs(directory)
+        lines, i = [], 0
+        for line in open(logFile).read().splitlines():
+            if not line.startswith('#'):
+                parts = line.split('\t')
+                parts[-1] = 'master_a.h5' if i < 15 else 'master_b.nxs::%d' % (i - 15)
+                line = '\t'.join(parts)
+                i += 1
+            lines.append(line)
+        with open(directory + scan + '.log', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        with h5py.File(directory + 'master_a.h5', 'w') as f:
+            f.create_dataset('entry/data/data_000001', data=images[:8], **layouts[layout])
+            f.create_dataset('entry/data/data_000002', data=images[8:15], **layouts[layout])
+        with h5py.File(directory + 'master_b.nxs', 'w') as f:
+            f.attrs['default'] = 'entry'
+            entry = f.create_group('entry')
+            entry.attrs['NX_class'] = 'NXentry'
+            entry.attrs['default'] = 'detector'
+            detector = entry.create_group('detector')
+            detector.attrs['NX_class'] = 'NXdata'
+            detector.attrs['signal'] = 'frames'
+            detector.create_dataset('frames', data=images[15:], **layouts[layout])
+        logFiles.append(directory + scan + '.log')
+        dataInDirs.append(directory)
+    return logFiles, dataInDirs
+
+
+@pytest.fixture(scope='module')
+def reference(dataset):
+    data = dataset.getScatData()
+    data.integrate(useOperator=True, operatorDir=os.path.join(dataset.root, 'operators'), **dataset.integration)
+    return data
+
+
+@pytest.mark.parametrize('layout', list(layouts))
+@pytest.mark.parametrize('batchSize', [None, 4])
+def test_frames(dataset, reference, tmp_path, layout, batchSize):
+    logFiles, dataInDirs = writeContainers(dataset, str(tmp_path), layout)
+    data = ScatData(logFiles, dataInDir=dataInDirs)
+    assert data.nFiles == reference.nFiles
+    data.integrate(useOperator=True, operatorDir=os.path.join(dataset.root, 'operators'), batchSize=batchSize,
+                   **dataset.integration)
+    np.testing.assert_allclose(data.total.s_raw, reference.total.s_raw, rtol=1e-12)
+    np.testing.assert_allclose(data.imageAv, reference.imageAv, rtol=1e-6)
+
+
+def test_missing_frames_are_excluded(dataset, tmp_path):
+    logFiles, dataInDirs = writeContainers(dataset, str(tmp_path), 'gzip')
+    with h5py.File(dataInDirs[0] + 'master_a.h5', 'a') as f:
+        del f['entry/data/data_000002']  # frames 8-14 of run1
+    data = ScatData(logFiles, dataInDir=dataInDirs)
+    assert data.nFiles == sum(len(images) for images in dataset.images) - 7
+
+
+def test_frames_with_workers_and_prefetch(dataset, reference, tmp_path):
+    logFiles, dataInDirs = writeContainers(dataset, str(tmp_path), 'gzip4')
+    for kwargs in [dict(workers=2), dict(prefetch=4)]:
+        data = ScatData(logFiles, dataInDir=dataInDirs)
+        data.integrate(useOperator=True, operatorDir=os.path.join(dataset.root, 'operators'), **kwargs,
+                       **dataset.integration)
+        np.testing.assert_allclose(data.total.s_raw, reference.total.s_raw, rtol=1e-12)
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pytrx.scatdata import LazyArray, ScatData
+
+pytest.importorskip('h5py')
+
+
+@pytest.fixture
+def reduced(dataset):
+    data = dataset.getScatData()
+    data.integrate(**dataset.integration)
+    data.getTotalAverages(plotting=False)
+    data.getDifferences()
+    data.getDiffAverages(plotting=False)
+    return data
+
+
+@pytest.mark.parametrize('compression', ['gzip', None])
+@pytest.mark.parametrize('lazy', [False, True])
+def test_save_load_roundtrip(reduced, tmp_path, lazy, compression):
+    savePath = str(tmp_path / 'data.h5')
+    reduced.save(savePath, compression=compression)
+    loaded = ScatData(savePath, lazy=lazy)
+
+    assert isinstance(loaded.total.s, LazyArray) == lazy
+    assert isinstance(loaded.diff.s, LazyArray) == lazy
+    for key in ['s', 's_av', 'isOutlier', 'normInt']:
+        np.testing.assert_array_equal(np.asarray(getattr(loaded.total, key)), getattr(reduced.total, key))
+    for key in ['s', 's_av', 'covqq']:
+        np.testing.assert_array_equal(np.asarray(getattr(loaded.diff, key)), getattr(reduced.diff, key))
+    np.testing.assert_array_equal(loaded.diff.covii.toarray(), reduced.diff.covii.toarray())
+    np.testing.assert_array_equal(loaded.q, reduced.q)
+    assert list(loaded.t_str) == list(reduced.t_str)
+    pd.testing.assert_frame_equal(loaded.logData, reduced.logData)
+
+
+def test_lazy_arithmetic(reduced, tmp_path):
+    savePath = str(tmp_path / 'data.h5')
+    reduced.save(savePath)
+    s = ScatData(savePath, lazy=True).total.s
+    ref = reduced.total.s
+
+    np.testing.assert_array_equal(s + 1, ref + 1)
+    np.testing.assert_array_equal(s * 2, ref * 2)
+    np.testing.assert_array_equal(2 - s, 2 - ref)
+    np.testing.assert_array_equal(s / s[:, :1], ref / ref[:, :1])
+    np.testing.assert_array_equal(ref - s, np.zeros_like(ref))
+    np.testing.assert_array_equal(np.sqrt(s), np.sqrt(ref))
+    np.testing.assert_array_equal(np.mean(s, axis=1), np.mean(ref, axis=1))
+    s *= 3
+    assert isinstance(s, LazyArray)
+    np.testing.assert_allclose(s[:, 2:5], ref[:, 2:5] * 3)
+
+
+def test_save_without_pytables(reduced, tmp_path, monkeypatch):
+    def to_hdf(*args, **kwargs):
+        raise ImportError('Missing optional dependency pytables')
+    monkeypatch.setattr(pd.DataFrame, 'to_hdf', to_hdf)
+    savePath = str(tmp_path / 'data.h5')
+    reduced.save(savePath)
+    loaded = ScatData(savePath)
+    np.testing.assert_array_equal(loaded.diff.s, reduced.diff.s)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_partial_load(reduced, tmp_path, lazy):
+    savePath = str(tmp_path / 'data.h5')
+    reduced.save(savePath)
+    loaded = ScatData(savePath, lazy=lazy, delays=['100ps', '10ns'], scans=['run2'], qRange=[0.5, 1.5])
+
+    qSel = (reduced.q >= 0.5) & (reduced.q <= 1.5)
+    tSel = np.isin(reduced.t_str, ['100ps', '10ns'])
+    imageSel = np.isin(reduced.total.delay_str, ['100ps', '10ns']) & (reduced.total.scanStamp == 'run2')
+    assert loaded.nFiles == np.sum(imageSel) and loaded.nDelays == 2
+    np.testing.assert_array_equal(loaded.q, reduced.q[qSel])
+    assert list(loaded.t_str) == list(reduced.t_str[tSel])
+    np.testing.assert_array_equal(np.asarray(loaded.total.s), reduced.total.s[qSel][:, imageSel])
+    np.testing.assert_array_equal(np.asarray(loaded.diff.s_av), reduced.diff.s_av[qSel][:, tSel])
+    np.testing.assert_array_equal(loaded.diff.covqq, reduced.diff.covqq[np.ix_(qSel, qSel)])
+    np.testing.assert_array_equal(loaded.total.normInt, reduced.total.normInt[imageSel])
+    np.testing.assert_array_equal(loaded.diff.covii.toarray(), reduced.diff.covii.toarray()[np.ix_(imageSel, imageSel)])
+    pd.testing.assert_frame_equal(loaded.logData, reduced.logData[imageSel])
+
+    with pytest.raises(AssertionError, match='not in t_str'):
+        ScatData(savePath, delays=['3ns'])
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from pytrx.imageio import _mapEdfImage, _readImageData
+
+fabio = pytest.importorskip('fabio')
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.uint16, np.int32])
+def test_map_edf_image(tmp_path, dtype):
+    image = np.arange(12 * 10).reshape(12, 10).astype(dtype)
+    path = str(tmp_path / 'image.edf')
+    fabio.edfimage.EdfImage(data=image).write(path)
+    mapped = _mapEdfImage(path)
+    assert mapped is not None
+    assert mapped.dtype == image.dtype
+    np.testing.assert_array_equal(mapped, image)
+    mapped[0, 0] = 100  # copy-on-write: the file is not modified
+    np.testing.assert_array_equal(fabio.open(path).data, image)
+
+
+def test_map_edf_image_fallback(tmp_path):
+    path = str(tmp_path / 'image.edf')
+    fabio.edfimage.EdfImage(data=np.ones((4, 4), dtype=np.float32)).write(path)
+    with open(path, 'ab') as f:
+        f.write(b'\0' * 16)  # the size does not match the header
+    assert _mapEdfImage(path) is None
+    np.testing.assert_array_equal(_readImageData(path), np.ones((4, 4)))
+
+    path = str(tmp_path / 'image.tif')
+    fabio.tifimage.TifImage(data=np.ones((4, 4), dtype=np.float32)).write(path)
+    assert _mapEdfImage(path) is None
+    np.testing.assert_array_equal(_readImageData(path), np.ones((4, 4)))
+
+
+def test_memory_map_integration(dataset):
+    mapped = dataset.getScatData()
+    mapped.integrate(**dataset.integration)
+    read = dataset.getScatData()
+    read.integrate(memoryMap=False, **dataset.integration)
+    np.testing.assert_array_equal(mapped.total.s_raw, read.total.s_raw)
+    np.testing.assert_array_equal(mapped.imageAv, read.imageAv)
@@ -0,0 +1,18 @@
+import pytest
+
+from pytrx import utils
+
+
+def test_heavy_modules_are_not_imported():
+    importTimes = utils.benchmarkImportTime(modules=('pytrx.scatdata', 'pytrx.scatsim'), nRepeats=1)
+    assert set(importTimes) == {'pytrx.scatdata', 'pytrx.scatsim'}
+
+
+def test_utils_imports_only_numpy_and_scipy():
+    utils.benchmarkImportTime(modules=('pytrx.utils',), heavyModules=utils.heavy_modules + ['pandas', 'subprocess'],
+                              nRepeats=1)
+
+
+def test_heavy_module_is_reported():
+    with pytest.raises(AssertionError, match='numpy'):
+        utils.benchmarkImportTime(modules=('pytrx.utils',), heavyModules=['numpy'], nRepeats=1)
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope='module')
+def serial(dataset):
+    data = dataset.getScatData()
+    data.integrate(**dataset.integration)
+    return data
+
+
+def assertSameIntegration(data, reference):
+    np.testing.assert_array_equal(data.q, reference.q)
+    np.testing.assert_allclose(data.total.s_raw, reference.total.s_raw, rtol=1e-12)
+    np.testing.assert_allclose(data.total.s, reference.total.s, rtol=1e-12)
+    np.testing.assert_allclose(data.imageAv, reference.imageAv, rtol=1e-6)
+
+
+def test_workers(dataset, serial):
+    data = dataset.getScatData()
+    data.integrate(workers=2, **dataset.integration)
+    assertSameIntegration(data, serial)
+
+
+@pytest.mark.parametrize('readerThreads', [1, 3])
+def test_prefetch(dataset, serial, readerThreads):
+    data = dataset.getScatData()
+    data.integrate(prefetch=4, readerThreads=readerThreads, **dataset.integration)
+    assertSameIntegration(data, serial)
@@ -0,0 +1,71 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from pytrx.caches import LogCache
+from pytrx.scatdata import ScatData
+
+
+def copyScan(dataset, tmp_path):
+    directory = str(tmp_path / 'run1') + os.sep
+    shutil.copytree(dataset.dataInDirs[0], directory)
+    return os.path.join(directory, 'run1.log'), directory
+
+
+def test_cache_is_opt_in(dataset, tmp_path):
+    logFile, directory = copyScan(dataset, tmp_path)
+    ScatData(logFile, dataInDir=directory)
+    assert not os.path.exists(logFile + '.cache.npz')
+
+
+def test_cache_hit(dataset, tmp_path):
+    logFile, directory = copyScan(dataset, tmp_path)
+    parsed = ScatData(logFile, dataInDir=directory, logCache=True)
+    assert os.path.isfile(logFile + '.cache.npz')
+    cached = LogCache(logFile, 'biocars').load()
+    assert cached is not None
+    reference = ScatData(logFile, dataInDir=directory)._readLogFile(logFile)
+    pd.testing.assert_frame_equal(cached, reference)
+    again = ScatData(logFile, dataInDir=directory, logCache=True)
+    pd.testing.assert_frame_equal(again.logData, parsed.logData)
+
+
+def test_cache_invalidated_by_size(dataset, tmp_path):
+    logFile, directory = copyScan(dataset, tmp_path)
+    ScatData(logFile, dataInDir=directory, logCache=True)
+    with open(logFile) as f:
+        lastLine = f.read().splitlines()[-1]
+    with open(logFile, 'a') as f:
+        f.write(lastLine + '\n')
+    assert LogCache(logFile, 'biocars').load() is None
+    data = ScatData(logFile, dataInDir=directory, logCache=True)
+    assert data.nFiles == len(dataset.images[0]) + 1
+
+
+def test_cache_invalidated_by_mtime(dataset, tmp_path):
+    logFile, directory = copyScan(dataset, tmp_path)
+    ScatData(logFile, dataInDir=directory, logCache=True)
+    stat = os.stat(logFile)
+    os.utime(logFile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert LogCache(logFile, 'biocars').load() is None
+
+
+def test_cache_text_columns_with_missing_values(tmp_path):
+    logFile = str(tmp_path / 'x.log')
+    open(logFile, 'w').write('x')
+    logData = pd.DataFrame({'file': ['a.edf', np.nan, 'c.edf'], 'delay': [1e-9, 2e-9, np.nan]})
+    cache = LogCache(logFile, 'biocars')
+    cache.save(logData)
+    pd.testing.assert_frame_equal(LogCache(logFile, 'biocars').load(), logData)
+
+
+def test_unwritable_cache_is_ignored(dataset, tmp_path, monkeypatch):
+    logFile, directory = copyScan(dataset, tmp_path)
+
+    def fail(*args, **kwargs):
+        raise ImportError('no writer')
+    monkeypatch.setattr(np, 'savez', fail)
+    data = ScatData(logFile, dataInDir=directory, logCache=True)
+    assert data.nFiles == len(dataset.images[0])
@@ -0,0 +1,25 @@
+import os
+
+import numpy as np
+
+import pytrx.scatdata
+from conftest import writeScan
+
+
+def test_missing_files_are_excluded(tmp_path):
+    directory = str(tmp_path / 'run1') + os.sep
+    logFile, _ = writeScan(directory, 'run1', 10, np.random.default_rng(0))
+    os.remove(directory + 'img_0004.edf')
+    data = pytrx.scatdata.ScatData(logFile, dataInDir=directory)
+    assert data.nFiles == 9
+    assert 'img_0004.edf' not in list(data.logData['file'])
+
+
+def test_files_missing_from_listing_are_checked(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'run1') + os.sep
+    logFile, _ = writeScan(directory, 'run1', 10, np.random.default_rng(0))
+    os.remove(directory + 'img_0004.edf')
+    monkeypatch.setattr(pytrx.scatdata, '_listFiles', lambda directory: set())
+    data = pytrx.scatdata.ScatData(logFile, dataInDir=directory)
+    assert data.nFiles == 9
+    assert 'img_0004.edf' not in list(data.logData['file'])
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import pytrx.scatdata
+
+
+def test_batch_matches_single_images(dataset):
+    single = dataset.getScatData()
+    single.integrate(useOperator=True, **dataset.integration)
+    batch = dataset.getScatData()
+    batch.integrate(useOperator=True, batchSize=7, **dataset.integration)
+    np.testing.assert_array_equal(batch.q, single.q)
+    np.testing.assert_allclose(batch.total.s_raw, single.total.s_raw, rtol=1e-12)
+
+
+def test_batch_without_numba(dataset, monkeypatch):
+    batch = dataset.getScatData()
+    batch.integrate(useOperator=True, batchSize=7, **dataset.integration)
+
+    def _integrateStack(*args):
+        raise ImportError('No module named numba')
+    monkeypatch.setattr(pytrx.scatdata, '_integrateStack', _integrateStack)
+    fallback = dataset.getScatData()
+    fallback.integrate(useOperator=True, batchSize=7, **dataset.integration)
+    np.testing.assert_allclose(fallback.total.s_raw, batch.total.s_raw, rtol=1e-12)
+
+
+def test_operator_matches_pyfai(dataset, tmp_path):
+    pytest.importorskip('pyFAI')
+    fabio = pytest.importorskip('fabio')
+    image = dataset.images[0][0].astype(np.float64)
+    mask = fabio.open(dataset.maskPath).data
+    p = dataset.integration
+    aiGeometry = pytrx.scatdata.AIGeometry(p['energy'], p['distance'], p['pixelSize'], p['centerX'], p['centerY'],
+                                           p['qRange'], p['nqpt'])
+    aiGeometry.getOperator(image.shape, p['nqpt'], p['qRange'], mask, operatorDir=tmp_path)
+    assert aiGeometry.operator.dtype == np.float64
+    q, s = aiGeometry.integrate1d(image, p['nqpt'], p['qRange'], mask)
+
+    ref = aiGeometry.ai.integrate1d(image, p['nqpt'], radial_range=p['qRange'], correctSolidAngle=True,
+                                    polarization_factor=1, mask=mask, unit='q_A^-1', method=('bbox', 'csr', 'cython'))
+    np.testing.assert_allclose(q, ref.radial, rtol=1e-6)
+    np.testing.assert_allclose(s, ref.intensity, rtol=1e-6)  # pyFAI accumulates in float32
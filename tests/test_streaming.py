@@ -0,0 +1,126 @@
+import asyncio
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from pytrx.scatdata import getOutlierReference
+from pytrx.streaming import ScatDataStream, OutlierSketch
+
+
+def batchAverages(dataset, subtractFlag):
+    ''' Weighted averages of ScatDataStream computed from a batch reduction. '''
+    data = dataset.getScatData()
+    data.integrate(**dataset.integration)
+    data.getDifferences(subtractFlag=subtractFlag)
+    w = data.total.normInt
+    wd = 1 / np.diag(data.Adiff @ np.diag(1 / w) @ data.Adiff.T)
+    isValid = np.ravel(np.sum(data.Adiff, axis=1) <= 1e-6)
+    total, diff = [], []
+    for t in data.t_str:
+        sel = data.total.delay_str == t
+        total.append((data.total.s[:, sel] * w[sel]).sum(1) / w[sel].sum())
+        sel &= isValid
+        diff.append((data.diff.s[:, sel] * wd[sel]).sum(1) / wd[sel].sum())
+    return data, np.array(total).T, np.array(diff).T
+
+
+def writeLive(dataset, liveDir, delay=0.005):
+    ''' Writes the log lines (in two parts) and the images of the dataset into
+    liveDir as during a scan. '''
+    for logFile, dataInDir in zip(dataset.logFiles, dataset.dataInDirs):
+        scan = os.path.basename(dataInDir.rstrip(os.sep))
+        lines = open(logFile).read().splitlines()
+        header = [line for line in lines if line.startswith('#')]
+        with open(os.path.join(liveDir, scan, scan + '.log'), 'w') as f:
+            f.write('\n'.join(header) + '\n')
+            f.flush()
+            for line in lines[len(header):]:
+                f.write(line[:5])
+                f.flush()
+                time.sleep(delay)
+                f.write(line[5:] + '\n')
+                f.flush()
+                fileName = line.split('\t')[-1]
+                shutil.copy(os.path.join(dataInDir, fileName), os.path.join(liveDir, scan, fileName))
+
+
+def liveFiles(dataset, liveDir):
+    logFiles, dataInDirs = [], []
+    for scan in ['run1', 'run2']:
+        os.makedirs(os.path.join(liveDir, scan))
+        logFiles.append(os.path.join(liveDir, scan, scan + '.log'))
+        dataInDirs.append(os.path.join(liveDir, scan) + os.sep)
+    return logFiles, dataInDirs
+
+
+@pytest.mark.parametrize('subtractFlag', ['MovingAverage', 'Previous'])
+def test_stream_matches_batch(dataset, tmp_path, subtractFlag):
+    logFiles, dataInDirs = liveFiles(dataset, str(tmp_path))
+    writer = threading.Thread(target=writeLive, args=(dataset, str(tmp_path)))
+    writer.start()
+    integration = {k: v for k, v in dataset.integration.items() if k != 'plotting'}
+    stream = ScatDataStream(logFiles, dataInDirs, subtractFlag=subtractFlag, pollInterval=0.01, **integration)
+    asyncio.run(stream.run(idleTimeout=1))
+    writer.join()
+
+    data, total, diff = batchAverages(dataset, subtractFlag)
+    assert stream.data.nFiles == data.nFiles
+    assert list(stream.data.t_str) == list(data.t_str)
+    np.testing.assert_allclose(stream.data.total.s_av, total, rtol=1e-10)
+    np.testing.assert_allclose(stream.data.diff.s_av, diff, rtol=1e-8, atol=1e-12)
+
+
+def test_stream_excludes_missing_images(dataset, tmp_path):
+    logFiles, dataInDirs = liveFiles(dataset, str(tmp_path))
+    writeLive(dataset, str(tmp_path), delay=0)
+    os.remove(dataInDirs[0] + 'img_0003.edf')
+    integration = {k: v for k, v in dataset.integration.items() if k != 'plotting'}
+    stream = ScatDataStream(logFiles, dataInDirs, pollInterval=0.01, missingTimeout=0.1, **integration)
+    asyncio.run(stream.run(idleTimeout=0.5))
+    assert stream.data.nFiles == sum(len(images) for images in dataset.images) - 1
+
+
+def noisyCurves(n, q, rng):
+    return (np.exp(-q)[:, None] + 0.01 * rng.standard_normal((q.size, n))).T
+
+
+def test_outlier_sketch():
+    rng = np.random.default_rng(0)
+    q = np.linspace(0.1, 4, 100)
+    curves = noisyCurves(300, q, rng)
+    isOutlierTrue = np.zeros(300, dtype=bool)
+    isOutlierTrue[[10, 60, 150, 299]] = True
+    curves[isOutlierTrue] += 0.05
+
+    sketch = OutlierSketch(q, fraction=0.9, chisqThresh=5, nWarmup=20)
+    isOutlier = np.array([sketch.add(y)[0] for y in curves])
+    assert np.all(isOutlier[isOutlierTrue])
+    assert np.sum(isOutlier[~isOutlierTrue]) <= 3
+
+    # the histogram estimate of the trimmed statistics is close to the exact one
+    y_av, y_std = sketch.getReference()
+    y_avExact, y_stdExact = getOutlierReference(curves.T, 0.9)
+    np.testing.assert_allclose(y_av, y_avExact, atol=0.05 * y_stdExact.mean())
+    np.testing.assert_allclose(y_std, y_stdExact, rtol=0.05)
+
+
+def test_stream_outlier_rejection(dataset, tmp_path):
+    logFiles, dataInDirs = liveFiles(dataset, str(tmp_path))
+    writeLive(dataset, str(tmp_path), delay=0)
+    yy, xx = np.mgrid[0:64, 0:64]
+    ring = 300 * np.exp(-((np.hypot(yy - 32, xx - 32) - 15) / 2) ** 2)
+    image = (dataset.images[0][16] + ring).astype(np.float32)  # an outlier among the 100ps images
+    fabio = pytest.importorskip('fabio')
+    fabio.edfimage.EdfImage(data=image).write(dataInDirs[0] + 'img_0016.edf')
+    integration = {k: v for k, v in dataset.integration.items() if k != 'plotting'}
+    stream = ScatDataStream(logFiles, dataInDirs, pollInterval=0.01, rejectOutliers=True, nWarmup=4,
+                            **integration)
+    asyncio.run(stream.run(idleTimeout=0.5))
+    summary = stream.reconcile().set_index(['curves', 'delay'])
+    assert summary.loc[('total', '100ps'), 'online'] >= 1
+    assert summary.loc[('total', '100ps'), 'batch'] >= 1
+    assert stream.data.total.isOutlier.sum() == summary.loc['total', 'batch'].sum()
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from pytrx.utils import time_str2num, time_num2str, time_str2num_array, time_num2str_array, timestamp_str2num_array
+
+
+def test_time_conversion_arrays():
+    t_str = ['-5us', '100ps', '1ns', '-5us', '10ns', '2.5ms', '50fs', '0', 0.3, np.nan]
+    expected = np.array([time_str2num(x) for x in t_str])
+    np.testing.assert_array_equal(time_str2num_array(t_str), expected)
+    np.testing.assert_array_equal(time_str2num_array(pd.Series(t_str)), expected)
+
+    t = expected[:-2]
+    assert list(time_num2str_array(t)) == [time_num2str(x) for x in t]
+
+
+def test_timestamp_arrays():
+    stamps = ['01-Mar-20 10:00:00', '29-Feb-20 23:59:59', '31-Dec-99 00:00:07', '15-jul-21 12:30:45',
+              '01-Mar-20 10:00:00']
+    expected = [datetime.strptime(x, '%d-%b-%y %H:%M:%S').timestamp() for x in stamps]
+    np.testing.assert_array_equal(timestamp_str2num_array(stamps), expected)
+
+    fmt = '%Y-%m-%d %H:%M:%S'
+    stamps = ['2020-03-01 10:00:00', '2021-07-15 12:30:45']
+    expected = [datetime.strptime(x, fmt).timestamp() for x in stamps]
+    np.testing.assert_array_equal(timestamp_str2num_array(stamps, fmt=fmt), expected)